@@ -0,0 +1,311 @@
+# coding=utf-8
+"""
+Benchmarks of corpus processing, language model estimation and decoding on synthetic corpora.
+
+Synthetic corpora are written in the tagged corpus format, i.e. "<word>" cohort lines
+followed by \t"root" tags @dep reading lines, with a configurable number of tokens,
+vocabulary size and number of analyses per word, so that scaling can be measured far
+beyond the size of big_tagged_corpus. Results are written as JSON and can be compared
+with the results of an earlier run.
+
+Usage: python -m main.benchmark --sizes 1000,10000,100000 --output bench.json [--compare old.json]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from bisect import bisect_left
+from itertools import accumulate
+
+from main.segment import process_file, prepare_corpus, language_model, segment_ig
+from main.viterbi_bigram import BaselineModel, Viterbi, Tag
+
+# Tags of synthetic readings, roughly the most frequent analyses in big_tagged_corpus
+READING_TAGS = [
+    'n nom', 'n gen', 'n dat', 'n acc', 'n loc', 'n abl', 'n ins', 'n pl nom', 'n px3sp nom', 'n px3sp loc',
+    'n attr', 'n subst nom', 'np top nom', 'np ant nom', 'adj', 'adj advl', 'adv', 'num', 'post', 'cnjcoo',
+    'prn pers p3 sg nom', 'v iv gpr_past', 'v tv gpr_impf', 'v iv ger_perf nom', 'v tv ger_past acc',
+    'v iv prc_perf', 'v tv prc_impf', 'v iv aor p3 sg', 'v tv past p3 sg', 'v tv gna_cond',
+]
+DEPENDENCIES = ['nmod', 'nmod:poss', 'amod', 'advmod', 'obj', 'obl', 'nsubj', 'conj', 'acl', 'root']
+COPULA_READING = '"е" cop aor p3 sg'
+# Fraction of nominal readings followed by a copula reading
+COPULA_RATE = 0.05
+MIN_SENTENCE_LENGTH, MAX_SENTENCE_LENGTH = 3, 25
+
+
+class SyntheticCorpus:
+    """Generator of tagged corpora and lattices with a random lexicon and Zipfian word frequencies."""
+
+    def __init__(self, vocab_size=10000, ambiguity=2, seed=0):
+        """
+        Constructor.
+        :param vocab_size: int, number of distinct words
+        :param ambiguity: int, average number of analyses per word
+        :param seed: int, random seed, the same seed gives the same lexicon and corpora
+        """
+        self.vocab_size = vocab_size
+        self.ambiguity = ambiguity
+        self.seed = seed
+        rnd = random.Random(seed)
+        num_roots = max(1, vocab_size // 2)
+        # Every word has a list of (root, tags, has copula) analyses, the first one is used in the corpus
+        self.lexicon = []
+        for i in range(vocab_size):
+            analyses = []
+            for _ in range(rnd.randint(1, 2 * ambiguity - 1)):
+                tags = rnd.choice(READING_TAGS)
+                has_copula = tags.startswith('n ') and rnd.random() < COPULA_RATE
+                analyses.append(('r%d' % rnd.randrange(num_roots), tags, has_copula))
+            self.lexicon.append(('w%d' % i, analyses))
+        self._cum_weights = list(accumulate(1.0 / rank for rank in range(1, vocab_size + 1)))
+
+    def sentences(self, num_tokens, seed=None):
+        """
+        Generate sentences with Zipf distributed words until num_tokens words (including
+        sentence ends) are generated.
+        :param num_tokens: int
+        :param seed: int, random seed, defaults to the lexicon seed
+        :return: generator of lists of word indices, without the sentence end
+        """
+        rnd = random.Random(self.seed if seed is None else seed)
+        total = self._cum_weights[-1]
+        while num_tokens > 0:
+            length = min(rnd.randint(MIN_SENTENCE_LENGTH, MAX_SENTENCE_LENGTH), max(num_tokens - 1, 1))
+            yield [bisect_left(self._cum_weights, rnd.random() * total) for _ in range(length)]
+            num_tokens -= length + 1
+
+    def _cohorts(self, sentence, rnd):
+        lines = []
+        for i, index in enumerate(sentence):
+            word, analyses = self.lexicon[index]
+            root, tags, has_copula = analyses[0]
+            head = rnd.randint(0, len(sentence))
+            lines.append('"<%s>"\n\t"%s" %s @%s #%d->%d\n' % (word, root, tags, rnd.choice(DEPENDENCIES),
+                                                                i + 1, head))
+            if has_copula:
+                lines.append('\t\t%s @cop #%d->%d\n' % (COPULA_READING, i + 1, i + 1))
+        lines.append('"<.>"\n\t"." sent @punct #%d->0\n' % (len(sentence) + 1))
+        return ''.join(lines)
+
+    def write(self, corpus_dir, num_tokens, num_files=1):
+        """
+        Write a tagged corpus of about num_tokens tokens split into num_files files.
+        :param corpus_dir: output directory, created if it does not exist
+        :param num_tokens: int
+        :param num_files: int
+        :return: list of (file path, number of tokens) tuples
+        """
+        os.makedirs(corpus_dir, exist_ok=True)
+        rnd = random.Random(self.seed)
+        files = []
+        for k in range(num_files):
+            fpath = os.path.join(corpus_dir, 'synthetic%03d.txt' % k)
+            file_tokens = num_tokens // num_files + (k < num_tokens % num_files)
+            written = 0
+            with open(fpath, 'w', encoding='utf-8') as f:
+                for sentence in self.sentences(file_tokens, seed=self.seed + k + 1):
+                    f.write(self._cohorts(sentence, rnd))
+                    written += len(sentence) + 1
+            files.append((fpath, written))
+        return files
+
+    def tag(self, analysis):
+        """
+        Return Tag of an analysis as the corpus parser would segment it.
+        :param analysis: (root, tags, has copula) tuple
+        :rtype : Tag
+        """
+        root, tags, has_copula = analysis
+        igs = list(segment_ig(tags.replace(' ', '$')))
+        if has_copula:
+            igs.append(COPULA_READING.replace('"', '').replace(' ', '$'))
+        return Tag(root, igs)
+
+    def lattices(self, num_tokens, seed=None):
+        """
+        Return lattices of sentences with all analyses of every word, framed by the sentence tag.
+        :param num_tokens: int
+        :param seed: int, random seed of the sentences
+        :return: list of (lattice, word list) tuples as Viterbi expects
+        """
+        tags = {}
+        lattices = []
+        for sentence in self.sentences(num_tokens, seed=seed):
+            lattice, words = [[Tag('.', ['sent'])]], ['.']
+            for index in sentence:
+                if index not in tags:
+                    tags[index] = [self.tag(analysis) for analysis in self.lexicon[index][1]]
+                lattice.append(tags[index])
+                words.append(self.lexicon[index][0])
+            lattice.append([Tag('.', ['sent'])])
+            words.append('.')
+            lattices.append((lattice, words))
+        return lattices
+
+
+def _best_time(func, repeat):
+    """
+    Return the result of func and the shortest time of repeat calls in seconds.
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def _record(name, tokens, seconds):
+    return {'name': name, 'tokens': tokens, 'seconds': seconds,
+            'tokens_per_second': tokens / seconds if seconds > 0 else None}
+
+
+def run(sizes, vocab_size=10000, ambiguity=2, num_files=1, processes=1, decode_tokens=100000, repeat=3,
+        seed=0, work_dir=None, verbose=True):
+    """
+    Run all benchmarks for every corpus size.
+    :param sizes: list of numbers of corpus tokens
+    :param vocab_size: int
+    :param ambiguity: int, average number of analyses per word in decoded lattices
+    :param num_files: int, number of files the corpus is split into
+    :param processes: int, number of worker processes of prepare_corpus
+    :param decode_tokens: int, maximum number of tokens decoded with Viterbi
+    :param repeat: int, the best time of repeat runs is reported
+    :param seed: int
+    :param work_dir: directory for generated files, a temporary one is used and removed if not given
+    :param verbose: boolean, print results as they are measured
+    :return: list of result dicts with name, tokens, seconds and tokens_per_second
+    """
+    corpus = SyntheticCorpus(vocab_size, ambiguity, seed)
+    base_dir = work_dir or tempfile.mkdtemp(prefix='kaztagger-bench-')
+    results = []
+    try:
+        for size in sizes:
+            size_dir = os.path.join(base_dir, str(size))
+            corpus_dir, lm_dir = os.path.join(size_dir, 'corpus'), os.path.join(size_dir, 'lm')
+            os.makedirs(lm_dir, exist_ok=True)
+            files = corpus.write(corpus_dir, size, num_files)
+            size_results = []
+
+            first_file, first_tokens = files[0]
+            _, seconds = _best_time(lambda: process_file(first_file), repeat)
+            size_results.append(_record('process_file', first_tokens, seconds))
+
+            tokens = sum(n for _, n in files)
+            counters, seconds = _best_time(
+                lambda: prepare_corpus(ngram=2, processes=processes, corpus_dir=corpus_dir, lm_corpus_dir=lm_dir),
+                repeat)
+            size_results.append(_record('prepare_corpus', tokens, seconds))
+
+            (root_probs, ig_probs), seconds = _best_time(lambda: language_model(ngram=2, counters=counters),
+                                                         repeat)
+            size_results.append(_record('language_model', tokens, seconds))
+
+            root_counter, ig_counter = counters
+            model, seconds = _best_time(lambda: BaselineModel(root_counter.vocab, root_probs, ig_counter.vocab,
+                                                              ig_probs, is_prob_calculated=True), repeat)
+            size_results.append(_record('BaselineModel', tokens, seconds))
+
+            lattices = corpus.lattices(min(size, decode_tokens), seed=seed + 1)
+
+            def decode():
+                for lattice, words in lattices:
+                    Viterbi(lattice, words).train(model)
+
+            _, seconds = _best_time(decode, repeat)
+            size_results.append(_record('Viterbi.train', sum(len(words) - 1 for _, words in lattices), seconds))
+
+            for result in size_results:
+                result['corpus_tokens'] = size
+                if verbose:
+                    print('%-16s %10d tokens %10.4f s %14.0f tokens/s' % (
+                        result['name'], result['tokens'], result['seconds'], result['tokens_per_second'] or 0))
+            results.extend(size_results)
+            shutil.rmtree(size_dir)
+    finally:
+        if not work_dir:
+            shutil.rmtree(base_dir, ignore_errors=True)
+    return results
+
+
+def compare(old, new, tolerance=0.1):
+    """
+    Compare two runs and print the ratio of times for every benchmark measured in both.
+    :param old: dict loaded from an earlier JSON output
+    :param new: dict in the same format
+    :param tolerance: float, slowdowns by more than this fraction are reported as regressions
+    :return: list of (name, corpus tokens, ratio) tuples of regressions
+    """
+    old_results = {(r['name'], r['corpus_tokens']): r for r in old['results']}
+    regressions = []
+    for result in new['results']:
+        key = (result['name'], result['corpus_tokens'])
+        if key not in old_results:
+            continue
+        # Compare throughput, since the number of tokens of a benchmark may differ slightly
+        before, after = old_results[key]['tokens_per_second'], result['tokens_per_second']
+        if not before or not after:
+            continue
+        ratio = before / after
+        is_regression = ratio > 1 + tolerance
+        print('%-16s %10d %8.2fx %s' % (key[0], key[1], ratio, 'REGRESSION' if is_regression else ''))
+        if is_regression:
+            regressions.append((key[0], key[1], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark KazTagger on synthetic tagged corpora.')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated corpus sizes in tokens, e.g. 1e3,1e4,1e5,1e6,1e7')
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--ambiguity', type=int, default=2, help='average number of analyses per word')
+    parser.add_argument('--files', type=int, default=1, help='number of files the corpus is split into')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes of prepare_corpus')
+    parser.add_argument('--decode-tokens', type=int, default=100000,
+                        help='maximum number of tokens decoded with Viterbi')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help='directory for generated corpora, temporary if not given')
+    parser.add_argument('--output', help='JSON file to write results to')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown reported as regression')
+    args = parser.parse_args(argv)
+
+    sizes = [int(float(size)) for size in args.sizes.split(',')]
+    results = run(sizes, vocab_size=args.vocab_size, ambiguity=args.ambiguity, num_files=args.files,
+                  processes=args.processes, decode_tokens=args.decode_tokens, repeat=args.repeat, seed=args.seed,
+                  work_dir=args.work_dir)
+    output = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'vocab_size': args.vocab_size,
+            'ambiguity': args.ambiguity,
+            'files': args.files,
+            'processes': args.processes,
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(json.load(f), output, args.tolerance)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
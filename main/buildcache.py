@@ -0,0 +1,256 @@
+# coding=utf-8
+"""
+Content-addressed cache of the training pipeline.
+
+The pipeline of a tagged corpus directory has four stages, every one saved as an artifact:
+    sentences  parsed Sentence objects of a corpus file
+    counts     FileCounts of a corpus file, i.e. root and IG n-gram counts and corpus text
+    lm         root and IG backoff language models of the whole corpus, packed with lmstore
+    model      the BaselineModel scoring with them
+The key of an artifact is a hash of the contents of the files it depends on, the settings of
+its stage and CACHE_VERSION, so it is found again whenever the inputs are the same, wherever
+and whenever they were built. A warm start hashes the corpus files and loads the model
+directly; after a change only the stages and files whose inputs changed are built again.
+
+Artifacts are pickles at <cache dir>/<stage>/<key>.pickle, the cache directory is
+KAZTAGGER_CACHE_DIR or .build_cache in the project directory by default.
+
+Usage: python -m main.buildcache [--corpus-dir dir] [--ngram 2] [--smoothing kn] [--cache-dir dir]
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import time
+from multiprocessing import Pool
+
+from main import lmstore, metrics
+from main.incremental import file_digest
+from main.lm import NgramCounter
+from main.segment import (BASE_DIR, LM_CORPUS_DIR, SMALL_CORPUS, _srilm_language_models, build_language_models,
+                          count_sentences, process_file)
+from main.viterbi_bigram import BaselineModel
+
+# Version of the artifact formats, artifacts of other versions are not used. It must be bumped
+# whenever a pickled class changes its layout (e.g. __slots__) or the meaning of its data
+CACHE_VERSION = 5
+DEFAULT_CACHE_DIR = os.environ.get('KAZTAGGER_CACHE_DIR') or os.path.join(BASE_DIR, '.build_cache')
+STAGES = ('sentences', 'counts', 'lm', 'model')
+
+
+def artifact_key(stage, inputs, settings):
+    """
+    Return the key of an artifact.
+    :param stage: str, one of STAGES
+    :param inputs: list of keys or digests of the artifact inputs
+    :param settings: dict of settings of the stage, values must be JSON serializable
+    :rtype : str
+    """
+    text = json.dumps([CACHE_VERSION, stage, inputs, settings], sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class BuildCache:
+    """Directory of pipeline artifacts addressed by their keys."""
+
+    def __init__(self, cache_dir=None):
+        """
+        Constructor.
+        :param cache_dir: cache directory, DEFAULT_CACHE_DIR if not given
+        """
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        # Numbers of loaded and of built artifacts of every stage
+        self.hits = dict.fromkeys(STAGES, 0)
+        self.misses = dict.fromkeys(STAGES, 0)
+
+    def path(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key + '.pickle')
+
+    def load(self, stage, key):
+        """
+        Return the artifact of a stage with the given key, or None if it is not cached.
+        Unreadable artifacts, e.g. of classes that were renamed or moved, and artifacts of other
+        versions count as not cached.
+        """
+        try:
+            with open(self.path(stage, key), 'rb') as f:
+                version, data = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError, AttributeError, ImportError):
+            version, data = None, None
+        if version != CACHE_VERSION:
+            self.misses[stage] += 1
+            metrics.inc('build_cache_misses_total')
+            return None
+        self.hits[stage] += 1
+        metrics.inc('build_cache_hits_total')
+        return data
+
+    def save(self, stage, key, data):
+        """
+        Save an artifact. It is written to a temporary file and renamed, so that concurrent
+        builds never see a partial artifact.
+        """
+        fpath = self.path(stage, key)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (fpath, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((CACHE_VERSION, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, fpath)
+
+
+def _file_counts(args):
+    """
+    Return key and FileCounts of a corpus file, loading or building its sentences and counts.
+    :param args: tuple of file path, file digest, n-gram order and cache directory
+    """
+    fpath, digest, ngram, cache_dir = args
+    cache = BuildCache(cache_dir)
+    sentences_key = artifact_key('sentences', [digest], {})
+    counts_key = artifact_key('counts', [sentences_key], {'ngram': ngram})
+    counts = cache.load('counts', counts_key)
+    if counts is None:
+        sentences = cache.load('sentences', sentences_key)
+        if sentences is None:
+            sentences = process_file(fpath, ngram=ngram)
+            cache.save('sentences', sentences_key, sentences)
+        counts = count_sentences(sentences, ngram)
+        cache.save('counts', counts_key, counts)
+    return counts_key, counts, cache.hits, cache.misses
+
+
+class CachedBuild:
+    """Training pipeline of a tagged corpus directory with every stage cached."""
+
+    def __init__(self, corpus_dir=SMALL_CORPUS, ngram=2, smoothing='kn', use_srilm=False, cache_dir=None,
+                 lm_corpus_dir=LM_CORPUS_DIR):
+        """
+        Constructor.
+        :param corpus_dir: tagged corpus directory
+        :param ngram: int
+        :param smoothing: 'kn' for modified Kneser-Ney or 'wb' for Witten-Bell, not used with SRILM
+        :param use_srilm: boolean, estimate language models with SRILM ngram-count
+        :param cache_dir: cache directory, DEFAULT_CACHE_DIR if not given
+        :param lm_corpus_dir: directory roots.txt and igs.txt are written to for SRILM
+        """
+        self.corpus_dir = corpus_dir
+        self.ngram = ngram
+        self.smoothing = smoothing
+        self.use_srilm = use_srilm
+        self.lm_corpus_dir = lm_corpus_dir
+        self.cache = BuildCache(cache_dir)
+        self._digests = None
+
+    @property
+    def digests(self):
+        """
+        Return list of (file name, digest of contents) of the corpus files in file name order.
+        """
+        if self._digests is None:
+            self._digests = [(file_name, file_digest(os.path.join(self.corpus_dir, file_name)))
+                             for file_name in sorted(os.listdir(self.corpus_dir))]
+        return self._digests
+
+    def _counts_keys(self):
+        return [artifact_key('counts', [artifact_key('sentences', [digest], {})], {'ngram': self.ngram})
+                for _, digest in self.digests]
+
+    def _lm_key(self):
+        settings = {'ngram': self.ngram, 'smoothing': 'srilm' if self.use_srilm else self.smoothing}
+        return artifact_key('lm', self._counts_keys(), settings)
+
+    def _model_key(self):
+        return artifact_key('model', [self._lm_key()], {})
+
+    def file_counts(self, processes=1):
+        """
+        Return FileCounts of every corpus file in file name order. Files whose counts are not
+        cached are parsed in a pool of processes if processes > 1.
+        :param processes: int, number of worker processes
+        :rtype : list of FileCounts objects
+        """
+        tasks = [(os.path.join(self.corpus_dir, file_name), digest, self.ngram, self.cache.cache_dir)
+                 for file_name, digest in self.digests]
+        pool = Pool(processes) if processes > 1 and len(tasks) > 1 else None
+        results = pool.map(_file_counts, tasks) if pool else list(map(_file_counts, tasks))
+        if pool:
+            pool.close()
+            pool.join()
+        for _, _, hits, misses in results:
+            for stage in STAGES:
+                self.cache.hits[stage] += hits[stage]
+                self.cache.misses[stage] += misses[stage]
+        return [counts for _, counts, _, _ in results]
+
+    def language_model(self, processes=1):
+        """
+        Return root and IG language models of the corpus. They keep backoff weights, so that
+        models built from them score unseen n-grams like models of the same LMs stored with lmstore.
+        :param processes: int, number of worker processes parsing files
+        :return: tuple of root and IG lmstore.PackedLM objects
+        """
+        key = self._lm_key()
+        lm = self.cache.load('lm', key)
+        if lm is not None:
+            return lm
+        file_counts = self.file_counts(processes)
+        if self.use_srilm:
+            file_paths = [os.path.join(self.lm_corpus_dir, 'roots.txt'), os.path.join(self.lm_corpus_dir, 'igs.txt')]
+            with open(file_paths[0], 'w', encoding='utf-8') as fp_root, \
+                    open(file_paths[1], 'w', encoding='utf-8') as fp_ig:
+                for counts in file_counts:
+                    fp_root.write(counts.root_text)
+                    fp_ig.write(counts.ig_text)
+            lm = _srilm_language_models(file_paths, self.ngram)
+        else:
+            root_counter, ig_counter = NgramCounter(self.ngram), NgramCounter(self.ngram)
+            for counts in file_counts:
+                root_counter.update(counts.root_counter)
+                ig_counter.update(counts.ig_counter)
+            lm = tuple(lmstore.pack(model) for model in build_language_models(
+                self.ngram, counters=(root_counter, ig_counter), smoothing=self.smoothing))
+        self.cache.save('lm', key, lm)
+        return lm
+
+    def model(self, processes=1):
+        """
+        Return BaselineModel of the corpus, loaded directly if the corpus and settings are unchanged.
+        It scores like BaselineModel.from_lm of the language models written to binary files.
+        :param processes: int, number of worker processes parsing files
+        :rtype : BaselineModel
+        """
+        if self.ngram != 2:
+            raise ValueError('BaselineModel is a bigram model, got ngram=%d' % self.ngram)
+        key = self._model_key()
+        model = self.cache.load('model', key)
+        if model is not None:
+            return model
+        model = BaselineModel.from_lm(*self.language_model(processes))
+        self.cache.save('model', key, model)
+        return model
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the baseline model of a tagged corpus with cached stages.')
+    parser.add_argument('--corpus-dir', default=SMALL_CORPUS)
+    parser.add_argument('--ngram', type=int, default=2)
+    parser.add_argument('--smoothing', default='kn', choices=['kn', 'wb'])
+    parser.add_argument('--srilm', action='store_true', help='estimate language models with SRILM')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    build = CachedBuild(args.corpus_dir, args.ngram, args.smoothing, args.srilm, args.cache_dir)
+    if args.ngram == 2:
+        build.model(args.processes)
+    else:
+        # BaselineModel is a bigram model, other orders only build the language models
+        build.language_model(args.processes)
+    print('Built %s in %.3f s' % ('model' if args.ngram == 2 else 'language models', time.perf_counter() - start))
+    for stage in STAGES:
+        print('%-10s %4d cached %4d built' % (stage, build.cache.hits[stage], build.cache.misses[stage]))
+
+
+if __name__ == '__main__':
+    main()
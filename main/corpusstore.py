@@ -0,0 +1,302 @@
+# coding=utf-8
+"""
+Columnar store of a parsed tagged corpus.
+
+The sentences of all files of a corpus are held in NumPy arrays instead of Sentence and
+InflectionalGroup objects:
+    roots          root id of every root, in corpus order
+    igs            IG tag id of every IG of every IG group, in corpus order
+    ig_offsets     IGs of group g are igs[ig_offsets[g]:ig_offsets[g + 1]]
+    root_offsets   roots of sentence s are roots[root_offsets[s]:root_offsets[s + 1]]
+    group_offsets  IG groups of sentence s are groups group_offsets[s] to group_offsets[s + 1] - 1
+    file_offsets   sentences of file f are sentences file_offsets[f] to file_offsets[f + 1] - 1
+Roots and IG groups of a sentence are kept apart, as segment.count_sentences counts them
+apart. Root, IG and file name vocabularies are stored as UTF-8 bytes with offsets.
+
+N-gram counts, IG length statistics and the lines of roots.txt, igs.txt and stats.txt are
+computed with array operations over the whole corpus, and are the same as those of
+segment.prepare_corpus. A store is saved as a directory of .npy files, whose arrays are
+memory-mapped when it is loaded, or as one .npz file.
+
+Usage: python -m main.corpusstore [--corpus-dir dir] store.npz|store_dir [--lm-corpus-dir dir]
+"""
+import argparse
+import os
+import sys
+import time
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from main.lm import NgramCounter
+from main.segment import BIG_CORPUS, iter_sentences
+
+ARRAYS = ('roots', 'igs', 'ig_offsets', 'root_offsets', 'group_offsets', 'file_offsets')
+VOCABULARIES = ('root_vocab', 'ig_vocab', 'file_names')
+
+
+def _pack_strings(strings):
+    """
+    Return UTF-8 bytes of strings and their offsets as arrays.
+    :param strings: list of strings
+    :return: tuple of uint8 and int64 arrays
+    """
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_strings(data, offsets):
+    data = bytes(data)
+    offsets = offsets.tolist()
+    return [data[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _offsets(lengths):
+    return np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(lengths, dtype=np.int64)])
+
+
+def _count_rows(rows, vocab):
+    """
+    Count distinct rows of an id matrix.
+    :param rows: 2-D array of ids, one n-gram per row
+    :param vocab: list of strings of the ids
+    :return: dict of n-gram tuples to counts
+    """
+    n, k = rows.shape
+    if not n:
+        return {}
+    if len(vocab) ** k < 2 ** 63:
+        # One int64 key per row is much faster to sort than rows
+        keys = np.zeros(n, dtype=np.int64)
+        for j in range(k):
+            keys = keys * len(vocab) + rows[:, j]
+        keys, counts = np.unique(keys, return_counts=True)
+        grams = np.empty((len(keys), k), dtype=np.int64)
+        for j in range(k - 1, -1, -1):
+            keys, grams[:, j] = np.divmod(keys, len(vocab))
+    else:
+        grams, counts = np.unique(rows, axis=0, return_counts=True)
+    return {tuple(vocab[i] for i in gram): c for gram, c in zip(grams.tolist(), counts.tolist())}
+
+
+class CorpusStore:
+    """Parsed tagged corpus as columnar arrays, see the module docstring."""
+
+    def __init__(self, arrays, root_vocab, ig_vocab, file_names):
+        """
+        Constructor.
+        :param arrays: dict of the arrays in ARRAYS
+        :param root_vocab: list of root strings
+        :param ig_vocab: list of IG tag strings
+        :param file_names: list of corpus file names
+        """
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.root_vocab = root_vocab
+        self.ig_vocab = ig_vocab
+        self.file_names = file_names
+
+    @classmethod
+    def from_files(cls, files):
+        """
+        Build a store from parsed sentences.
+        :param files: iterable of (file name, iterable of Sentence objects) tuples
+        :rtype : CorpusStore
+        """
+        root_ids, ig_ids, file_names = {}, {}, []
+        roots, igs, ig_lengths, root_lengths, group_lengths, file_lengths = (array('l') for _ in range(6))
+        for file_name, sentences in files:
+            file_names.append(file_name)
+            num_sent = 0
+            for sentence in sentences:
+                roots.extend([root_ids.setdefault(root, len(root_ids)) for root in sentence.roots])
+                for ig in sentence.igs:
+                    igs.extend([ig_ids.setdefault(tag, len(ig_ids)) for tag in ig.group])
+                    ig_lengths.append(len(ig.group))
+                root_lengths.append(len(sentence.roots))
+                group_lengths.append(len(sentence.igs))
+                num_sent += 1
+            file_lengths.append(num_sent)
+        arrays = {
+            'roots': np.array(roots, dtype=np.int32),
+            'igs': np.array(igs, dtype=np.int32),
+            'ig_offsets': _offsets(ig_lengths),
+            'root_offsets': _offsets(root_lengths),
+            'group_offsets': _offsets(group_lengths),
+            'file_offsets': _offsets(file_lengths),
+        }
+        return cls(arrays, list(root_ids), list(ig_ids), file_names)
+
+    @classmethod
+    def from_corpus(cls, corpus_dir=BIG_CORPUS):
+        """
+        Parse all files of a tagged corpus directory in file name order into a store.
+        :rtype : CorpusStore
+        """
+        file_names = sorted(os.listdir(corpus_dir))
+        return cls.from_files((file_name, iter_sentences(os.path.join(corpus_dir, file_name)))
+                              for file_name in file_names)
+
+    def save(self, path):
+        """
+        Save the store as a directory of .npy files, or as one .npz file if path ends with .npz.
+        """
+        arrays = {name: getattr(self, name) for name in ARRAYS}
+        for name in VOCABULARIES:
+            arrays[name + '_data'], arrays[name + '_offsets'] = _pack_strings(getattr(self, name))
+        if path.endswith('.npz'):
+            np.savez(path, **arrays)
+            return
+        os.makedirs(path, exist_ok=True)
+        for name, values in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), values)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Load a store saved with save. Arrays of a directory are memory-mapped unless mmap_mode is None,
+        arrays of an .npz file are read into memory.
+        :param path: directory or .npz file
+        :param mmap_mode: mode of numpy.load
+        :rtype : CorpusStore
+        """
+        names = list(ARRAYS) + [name + suffix for name in VOCABULARIES for suffix in ('_data', '_offsets')]
+        if os.path.isdir(path):
+            arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in names}
+        else:
+            with np.load(path) as f:
+                arrays = {name: f[name] for name in names}
+        vocabularies = [_unpack_strings(arrays[name + '_data'], arrays[name + '_offsets']) for name in VOCABULARIES]
+        return cls(arrays, *vocabularies)
+
+    @property
+    def num_sentences(self):
+        return len(self.root_offsets) - 1
+
+    def ig_lengths(self):
+        """
+        Return number of IGs of every IG group.
+        :rtype : numpy array
+        """
+        return np.diff(self.ig_offsets)
+
+    def ig_length_counts(self):
+        """
+        Return number of words with every number of IGs, like the first item of segment.stats.
+        :rtype : Counter
+        """
+        counts = np.bincount(self.ig_lengths())
+        return Counter({n: c for n, c in enumerate(counts.tolist()) if c})
+
+    def ig_count_sequences(self):
+        """
+        Return list of numbers of IGs of the words of every sentence, like the second item of segment.stats.
+        :rtype : list of lists
+        """
+        lengths = self.ig_lengths().tolist()
+        offsets = self.group_offsets.tolist()
+        return [lengths[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def _file_ranges(self, offsets):
+        # Start and end of the items of every file, offsets are per sentence
+        return np.asarray(offsets)[np.asarray(self.file_offsets)]
+
+    def _root_rows(self, k):
+        """
+        Return matrix of the root k-grams of every file, one per row.
+        """
+        file_starts = self._file_ranges(self.root_offsets)
+        roots = np.asarray(self.roots)
+        if len(roots) < k:
+            return np.empty((0, k), dtype=np.int64)
+        file_of_root = np.repeat(np.arange(len(file_starts) - 1), np.diff(file_starts))
+        starts = np.flatnonzero(file_of_root[:len(roots) - k + 1] == file_of_root[k - 1:])
+        return np.stack([roots[starts + j] for j in range(k)], axis=1)
+
+    def ig_lines(self, ngram=2):
+        """
+        Return matrix of IG ids of the lines of igs.txt, i.e. every IG of a word after the last IGs
+        of the ngram - 1 previous words of its file. The last word of a file has no line.
+        :param ngram: int
+        :return: 2-D array with ngram columns
+        """
+        igs = np.asarray(self.igs)
+        ig_offsets = np.asarray(self.ig_offsets)
+        last_igs = igs[ig_offsets[1:] - 1]
+        file_starts = self._file_ranges(self.group_offsets)
+        file_lengths = np.diff(file_starts)
+        group_of_ig = np.repeat(np.arange(len(ig_offsets) - 1), np.diff(ig_offsets))
+        file_of_group = np.repeat(np.arange(len(file_lengths)), file_lengths)
+        position = np.arange(len(file_of_group)) - file_starts[file_of_group]
+        valid_groups = (position >= ngram - 1) & (position < file_lengths[file_of_group] - 1)
+        selected = np.flatnonzero(valid_groups[group_of_ig])
+        groups = group_of_ig[selected]
+        columns = [last_igs[groups - ngram + 1 + j] for j in range(ngram - 1)] + [igs[selected]]
+        return np.stack(columns, axis=1)
+
+    def ngram_counters(self, ngram=2):
+        """
+        Return root and IG n-gram counts, the same as those of segment.prepare_corpus.
+        :param ngram: int
+        :return: tuple of root and IG NgramCounter objects
+        """
+        root_counter, ig_counter = NgramCounter(ngram), NgramCounter(ngram)
+        lines = self.ig_lines(ngram)
+        for k in range(1, ngram + 1):
+            root_counter.counts[k].update(_count_rows(self._root_rows(k), self.root_vocab))
+            # Only the n-grams of a line of igs.txt that end with its last IG are counted
+            ig_counter.counts[k].update(_count_rows(lines[:, ngram - k:], self.ig_vocab))
+        return root_counter, ig_counter
+
+    def write_lm_corpus(self, lm_corpus_dir, ngram=2):
+        """
+        Write roots.txt, igs.txt and stats.txt of the corpus to a directory, like segment.prepare_corpus.
+        :param lm_corpus_dir: output directory
+        :param ngram: int
+        """
+        root_vocab, ig_vocab = self.root_vocab, self.ig_vocab
+        roots = [root_vocab[i] for i in np.asarray(self.roots).tolist()]
+        offsets = np.asarray(self.root_offsets).tolist()
+        file_offsets = np.asarray(self.file_offsets).tolist()
+        with open(os.path.join(lm_corpus_dir, 'roots.txt'), 'w', encoding='utf-8') as f:
+            for first, stop in zip(file_offsets[:-1], file_offsets[1:]):
+                f.write(''.join('%s ' % ' '.join(roots[offsets[s]:offsets[s + 1]]) for s in range(first, stop)) + '\n')
+        with open(os.path.join(lm_corpus_dir, 'igs.txt'), 'w', encoding='utf-8') as f:
+            f.write(''.join('%s\n' % ' '.join(ig_vocab[i] for i in line) for line in self.ig_lines(ngram).tolist()))
+        with open(os.path.join(lm_corpus_dir, 'stats.txt'), 'w', encoding='utf-8') as f:
+            f.write(''.join('%s\n' % ','.join(map(str, seq)) for seq in self.ig_count_sequences()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build a columnar store of a tagged corpus.')
+    parser.add_argument('store', help='output .npz file or directory of .npy files, loaded if it exists')
+    parser.add_argument('--corpus-dir', default=BIG_CORPUS)
+    parser.add_argument('--ngram', type=int, default=2)
+    parser.add_argument('--lm-corpus-dir', help='write roots.txt, igs.txt and stats.txt to this directory')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    if os.path.exists(args.store):
+        store = CorpusStore.load(args.store)
+        print('Loaded store in %.3f s' % (time.perf_counter() - start))
+    else:
+        store = CorpusStore.from_corpus(args.corpus_dir)
+        store.save(args.store)
+        print('Built store in %.3f s' % (time.perf_counter() - start))
+    start = time.perf_counter()
+    root_counter, ig_counter = store.ngram_counters(args.ngram)
+    print('Counted n-grams in %.3f s: %d root and %d IG n-grams' % (
+        time.perf_counter() - start, len(root_counter), len(ig_counter)))
+    print('Total # of sentences: ', store.num_sentences)
+    for key, val in sorted(store.ig_length_counts().items()):
+        print('Words with %d IG(s): %d' % (key, val))
+    if args.lm_corpus_dir:
+        store.write_lm_corpus(args.lm_corpus_dir, args.ngram)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,276 @@
+# coding=utf-8
+"""
+K-fold cross-validation of the baseline tagger against the gold analyses of a tagged corpus.
+
+Every corpus file is cut into k blocks of consecutive sentences, and fold i holds out the
+i-th block of every file. Root and IG n-grams and the analyses of every word are counted
+once per block, in a pool of processes, and added up to global counts. The model of a fold
+is derived from the global counts by subtracting the counts of its held-out blocks, instead
+of estimating language models from scratch for every fold. Folds are evaluated in a pool of
+processes as well.
+
+The tagged corpus has gold analyses only, so the candidates of a word are the analyses seen
+with it in the training blocks of a fold. Words not seen there get their gold analysis as the
+only candidate, so that their neighbours are decoded in context, and are reported as unknown.
+Unknown words and words whose gold analysis is not among their candidates are not counted in
+accuracy. The accuracy of the tagger is compared with a baseline that picks the most frequent
+analysis of every word.
+
+Usage: python -m main.evaluate [--folds 10] [--processes 4] [--corpus-dir dir] [--output cv.json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+from multiprocessing import Pool
+
+from main.lm import IncrementalLM
+from main.segment import BIG_CORPUS, count_sentences, process_file
+from main.viterbi_bigram import BaselineModel, Tag, best_path, make_tag
+
+SENTENCE_IG = 'sent'
+# Word counts of an evaluation: all tagged words, words counted in accuracy, words not seen in
+# training, seen words whose gold analysis was not seen with them, and correct words of the
+# tagger and of the baseline, overall and among ambiguous words
+COUNTERS = ('words', 'evaluated', 'unknown', 'gold_missing', 'correct', 'baseline_correct',
+            'ambiguous', 'ambiguous_correct', 'baseline_ambiguous_correct')
+
+
+class Fold:
+    """Counts and gold sentences of the blocks held out by a fold."""
+
+    def __init__(self):
+        # FileCounts of the held-out block of every file
+        self.counts = []
+        # Counter of (word, (root, IG tuple)) pairs
+        self.lexicon = Counter()
+        # Lists of (word, root, IG tuple) of every word of a sentence
+        self.sentences = []
+
+
+def gold_analyses(sentence):
+    """
+    Return list of (word, root, IG tuple) of every word of a sentence, or None if words
+    and analyses do not line up.
+    :type sentence: Sentence
+    """
+    if not len(sentence.words) == len(sentence.roots) == len(sentence.igs):
+        return None
+    return [(word, root, ig.group) for word, root, ig in zip(sentence.words, sentence.roots, sentence.igs)]
+
+
+def _count_file_blocks(args):
+    """
+    Parse a file and return a Fold with the counts and sentences of each of its blocks.
+    :param args: tuple of file path, n-gram order and number of folds
+    :rtype : list of Fold objects
+    """
+    file_path, ngram, num_folds = args
+    sentences = process_file(file_path, ngram=ngram)
+    blocks = []
+    for i in range(num_folds):
+        block = Fold()
+        block_sentences = sentences[len(sentences) * i // num_folds:len(sentences) * (i + 1) // num_folds]
+        block.counts.append(count_sentences(block_sentences, ngram))
+        for sentence in block_sentences:
+            analyses = gold_analyses(sentence)
+            if analyses is None:
+                continue
+            block.lexicon.update((word, (root, igs)) for word, root, igs in analyses)
+            block.sentences.append(analyses)
+        blocks.append(block)
+    return blocks
+
+
+# Global models, lexicon and folds of evaluation worker processes
+_state = None
+
+
+def _init_worker(state):
+    global _state
+    _state = state
+
+
+def evaluate_fold(index, root_lm, ig_lm, lexicon, fold, beam=None):
+    """
+    Tag the held-out sentences of a fold with the model of the other folds. The held-out counts
+    are subtracted from the global models for the time of the evaluation and added back afterwards.
+    :param index: int, fold number
+    :param root_lm: IncrementalLM of roots of all folds
+    :param ig_lm: IncrementalLM of IGs of all folds
+    :param lexicon: Counter of (word, analysis) pairs of all folds
+    :type fold: Fold
+    :param beam: int, number of best tags kept at each position, None keeps all
+    :return: dict with COUNTERS, accuracies of the tagger and the baseline, and seconds
+    """
+    start = time.perf_counter()
+    for counts in fold.counts:
+        root_lm.subtract(counts.root_counter)
+        ig_lm.subtract(counts.ig_counter)
+    try:
+        candidates = {}
+        for (word, analysis), count in (lexicon - fold.lexicon).items():
+            candidates.setdefault(word, []).append((-count, analysis))
+        for word, analyses in candidates.items():
+            # Most frequent analysis first, it wins ties
+            candidates[word] = [make_tag(root, igs) for _, (root, igs) in sorted(analyses)]
+        model = BaselineModel.from_lm(root_lm, ig_lm)
+        model_seconds = time.perf_counter() - start
+
+        result = dict.fromkeys(COUNTERS, 0)
+        result.update(fold=index, sentences=len(fold.sentences))
+        decode_start = time.perf_counter()
+        for sentence in fold.sentences:
+            words = sentence[:-1] if sentence[-1][2][-1] == SENTENCE_IG else sentence
+            if not words:
+                continue
+            lattice, gold = [[Tag('.', [SENTENCE_IG])]], []
+            for word, root, igs in words:
+                tag = make_tag(root, igs)
+                column = candidates.get(word)
+                if column is None:
+                    result['unknown'] += 1
+                    column = [tag]
+                elif tag not in column:
+                    result['gold_missing'] += 1
+                lattice.append(column)
+                gold.append(tag)
+            lattice.append([Tag('.', [SENTENCE_IG])])
+            path, _ = best_path(lattice, model, beam=beam)
+            for (word, _, _), column, tag, predicted in zip(words, lattice[1:-1], gold, path[1:-1]):
+                result['words'] += 1
+                if word not in candidates or tag not in column:
+                    continue
+                correct = predicted == tag
+                # Candidates are sorted by frequency, the first one is the baseline's choice
+                baseline_correct = column[0] == tag
+                result['evaluated'] += 1
+                result['correct'] += correct
+                result['baseline_correct'] += baseline_correct
+                if len(column) > 1:
+                    result['ambiguous'] += 1
+                    result['ambiguous_correct'] += correct
+                    result['baseline_ambiguous_correct'] += baseline_correct
+    finally:
+        for counts in fold.counts:
+            root_lm.add(counts.root_counter)
+            ig_lm.add(counts.ig_counter)
+    result.update(_accuracies(result))
+    result['model_seconds'] = model_seconds
+    result['decode_seconds'] = time.perf_counter() - decode_start
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def _accuracies(counts):
+    """
+    Return accuracies of the tagger and of the most frequent analysis baseline, over all
+    evaluated words and over the ambiguous ones, None where there are no such words.
+    :param counts: dict of COUNTERS
+    :rtype : dict
+    """
+    def ratio(numerator, denominator):
+        return counts[numerator] / counts[denominator] if counts[denominator] else None
+
+    return {'accuracy': ratio('correct', 'evaluated'),
+            'ambiguous_accuracy': ratio('ambiguous_correct', 'ambiguous'),
+            'baseline_accuracy': ratio('baseline_correct', 'evaluated'),
+            'baseline_ambiguous_accuracy': ratio('baseline_ambiguous_correct', 'ambiguous')}
+
+
+def _evaluate_fold(index):
+    root_lm, ig_lm, lexicon, folds, beam = _state
+    return evaluate_fold(index, root_lm, ig_lm, lexicon, folds[index], beam)
+
+
+def cross_validate(corpus_dir=BIG_CORPUS, num_folds=10, processes=1, ngram=2, smoothing='kn', beam=None):
+    """
+    Run k-fold cross-validation on a tagged corpus directory.
+    :param corpus_dir: tagged corpus directory
+    :param num_folds: int, number of folds
+    :param processes: int, number of worker processes
+    :param ngram: int
+    :param smoothing: 'kn' for modified Kneser-Ney or 'wb' for Witten-Bell
+    :param beam: int, number of best tags kept at each position, None keeps all
+    :return: dict with list of per fold results and totals
+    """
+    if num_folds < 2:
+        raise ValueError('At least 2 folds are needed: %d' % num_folds)
+    start = time.perf_counter()
+    tasks = [(os.path.join(corpus_dir, file_name), ngram, num_folds) for file_name in sorted(os.listdir(corpus_dir))]
+    pool = Pool(processes) if processes > 1 else None
+    results = pool.imap(_count_file_blocks, tasks) if pool else map(_count_file_blocks, tasks)
+    folds = [Fold() for _ in range(num_folds)]
+    root_lm, ig_lm, lexicon = IncrementalLM(ngram, smoothing), IncrementalLM(ngram, smoothing), Counter()
+    for blocks in results:
+        for fold, block in zip(folds, blocks):
+            for counts in block.counts:
+                root_lm.add(counts.root_counter)
+                ig_lm.add(counts.ig_counter)
+            lexicon.update(block.lexicon)
+            fold.counts.extend(block.counts)
+            fold.lexicon.update(block.lexicon)
+            fold.sentences.extend(block.sentences)
+    if pool:
+        pool.close()
+        pool.join()
+    count_seconds = time.perf_counter() - start
+
+    state = (root_lm, ig_lm, lexicon, folds, beam)
+    if processes > 1:
+        # Workers get the global counts once, forked ones share them copy-on-write
+        pool = Pool(min(processes, num_folds), initializer=_init_worker, initargs=(state,))
+        fold_results = pool.map(_evaluate_fold, range(num_folds))
+        pool.close()
+        pool.join()
+    else:
+        _init_worker(state)
+        fold_results = [_evaluate_fold(i) for i in range(num_folds)]
+        _init_worker(None)
+
+    results = {counter: sum(result[counter] for result in fold_results) for counter in COUNTERS}
+    results.update(_accuracies(results))
+    results.update(folds=fold_results, count_seconds=count_seconds, seconds=time.perf_counter() - start)
+    return results
+
+
+def _format(value):
+    return '%.4f' % value if value is not None else '-'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='K-fold cross-validation of KazTagger on a gold tagged corpus.')
+    parser.add_argument('--corpus-dir', default=BIG_CORPUS)
+    parser.add_argument('--folds', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--ngram', type=int, default=2)
+    parser.add_argument('--smoothing', default='kn', choices=['kn', 'wb'])
+    parser.add_argument('--beam', type=int, help='number of best tags kept at each position')
+    parser.add_argument('--output', help='JSON file to write results to')
+    args = parser.parse_args(argv)
+
+    results = cross_validate(args.corpus_dir, args.folds, args.processes, args.ngram, args.smoothing, args.beam)
+    print('%-5s %9s %6s %8s %8s %9s %10s %9s %10s %9s %9s' % (
+        'fold', 'sentences', 'words', 'unknown', 'missing', 'accuracy', 'ambiguous', 'baseline', 'b. ambig.',
+        'model s', 'decode s'))
+    for result in results['folds']:
+        print('%-5d %9d %6d %8d %8d %9s %10s %9s %10s %9.3f %9.3f' % (
+            result['fold'], result['sentences'], result['words'], result['unknown'], result['gold_missing'],
+            _format(result['accuracy']), _format(result['ambiguous_accuracy']), _format(result['baseline_accuracy']),
+            _format(result['baseline_ambiguous_accuracy']), result['model_seconds'], result['decode_seconds']))
+    print('Accuracy %s (ambiguous words %s) over %d of %d words, %d unknown, %d with gold analysis missing' % (
+        _format(results['accuracy']), _format(results['ambiguous_accuracy']), results['evaluated'], results['words'],
+        results['unknown'], results['gold_missing']))
+    print('Most frequent analysis baseline %s (ambiguous words %s); counting %.3f s, total %.3f s' % (
+        _format(results['baseline_accuracy']), _format(results['baseline_ambiguous_accuracy']),
+        results['count_seconds'], results['seconds']))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+# coding=utf-8
+"""
+Incremental root and IG models of a tagged corpus directory.
+
+Counts of every corpus file are kept together with a hash of its contents, so
+that when files are added, changed or removed only those files are parsed again,
+their old counts are subtracted and the new ones added to the language models.
+"""
+import hashlib
+import os
+import pickle
+from collections import Counter
+from multiprocessing import Pool
+
+from main.lm import IncrementalLM
+from main.segment import BIG_CORPUS, LM_CORPUS_DIR, _count_file_sentences
+from main.viterbi_bigram import BaselineModel
+
+
+def file_digest(fpath):
+    """
+    Return SHA-1 hex digest of file contents.
+    :param fpath: file path
+    :rtype : str
+    """
+    digest = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IncrementalCorpus:
+    """Root and IG language models and baseline model of a corpus directory, updated file by file."""
+
+    def __init__(self, corpus_dir=BIG_CORPUS, ngram=2, smoothing='kn'):
+        """
+        Constructor. Models are empty until update() is called.
+        :param corpus_dir: tagged corpus directory
+        :param ngram: int
+        :param smoothing: 'kn' for modified Kneser-Ney or 'wb' for Witten-Bell
+        """
+        self.corpus_dir = corpus_dir
+        self.ngram = ngram
+        # File name to (size, modification time, digest, FileCounts) of the last update
+        self.files = {}
+        self.num_sent = 0
+        self.ig_lengths = Counter()
+        self.root_lm = IncrementalLM(ngram, smoothing)
+        self.ig_lm = IncrementalLM(ngram, smoothing)
+        self.model = BaselineModel.from_lm(self.root_lm, self.ig_lm)
+
+    def _scan(self):
+        """
+        Return list of (file name, size, modification time, digest) of new and changed files,
+        and list of names of removed files. Files with unchanged size and modification time
+        are not read.
+        """
+        changed = []
+        names = sorted(os.listdir(self.corpus_dir))
+        for file_name in names:
+            st = os.stat(os.path.join(self.corpus_dir, file_name))
+            known = self.files.get(file_name)
+            if known and known[:2] == (st.st_size, st.st_mtime_ns):
+                continue
+            digest = file_digest(os.path.join(self.corpus_dir, file_name))
+            if known and known[2] == digest:
+                # Only touched, remember the new modification time
+                self.files[file_name] = (st.st_size, st.st_mtime_ns) + known[2:]
+                continue
+            changed.append((file_name, st.st_size, st.st_mtime_ns, digest))
+        removed = sorted(set(self.files) - set(names))
+        return changed, removed
+
+    def _remove(self, file_name):
+        counts = self.files.pop(file_name)[3]
+        self.root_lm.subtract(counts.root_counter)
+        self.ig_lm.subtract(counts.ig_counter)
+        self.num_sent -= counts.num_sent
+        self.ig_lengths -= counts.ig_lengths
+
+    def _add(self, file_name, size, mtime, digest, counts):
+        self.files[file_name] = (size, mtime, digest, counts)
+        self.root_lm.add(counts.root_counter)
+        self.ig_lm.add(counts.ig_counter)
+        self.num_sent += counts.num_sent
+        self.ig_lengths += counts.ig_lengths
+
+    def update(self, processes=1):
+        """
+        Parse new and changed files, and replace their counts in the models. Removed files
+        are dropped. Time taken is proportional to the size of the changed files.
+        :param processes: int, number of worker processes
+        :return: sorted list of names of added, changed and removed files
+        """
+        changed, removed = self._scan()
+        tasks = [(os.path.join(self.corpus_dir, file_name), self.ngram) for file_name, _, _, _ in changed]
+        pool = Pool(processes) if processes > 1 and len(tasks) > 1 else None
+        results = pool.imap(_count_file_sentences, tasks) if pool else map(_count_file_sentences, tasks)
+        for file_name in removed:
+            self._remove(file_name)
+        for (file_name, size, mtime, digest), counts in zip(changed, results):
+            if file_name in self.files:
+                self._remove(file_name)
+            self._add(file_name, size, mtime, digest, counts)
+        if pool:
+            pool.close()
+            pool.join()
+        if changed or removed:
+            self.model.clear_cache()
+        return sorted([file_name for file_name, _, _, _ in changed] + removed)
+
+    def write_corpus(self, lm_corpus_dir=LM_CORPUS_DIR):
+        """
+        Write roots.txt and igs.txt as prepare_corpus does, from the kept per file text.
+        :param lm_corpus_dir: output directory
+        """
+        with open(os.path.join(lm_corpus_dir, 'roots.txt'), 'w', encoding='utf-8') as fp_root, \
+                open(os.path.join(lm_corpus_dir, 'igs.txt'), 'w', encoding='utf-8') as fp_ig:
+            for file_name in sorted(self.files):
+                counts = self.files[file_name][3]
+                fp_root.write(counts.root_text)
+                fp_ig.write(counts.ig_text)
+
+    def save(self, fpath):
+        """
+        Save counts and models, so that a later run only parses the files changed in between.
+        :param fpath: file path
+        """
+        with open(fpath, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(fpath):
+        """
+        Load an IncrementalCorpus saved with save().
+        :param fpath: file path
+        :rtype : IncrementalCorpus
+        """
+        with open(fpath, 'rb') as f:
+            return pickle.load(f)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    state_path = os.path.join(LM_CORPUS_DIR, 'incremental.pickle')
+    corpus = IncrementalCorpus.load(state_path) if os.path.exists(state_path) else IncrementalCorpus()
+    start = time.time()
+    updated = corpus.update(processes=int(sys.argv[1]) if len(sys.argv) > 1 else 1)
+    print('Updated %d file(s) in %.3f s: %s' % (len(updated), time.time() - start, ' '.join(updated)))
+    print('Total # of sentences: ', corpus.num_sent)
+    corpus.save(state_path)
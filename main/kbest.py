@@ -0,0 +1,147 @@
+# coding=utf-8
+"""
+Ranked alternative paths and per-word confidence of ambiguous lattices.
+
+Both use the transition scores of BaselineModel as best_path does, i.e. scores of
+Pr(tag | previous tag) summed along a path, and score every lattice cell once:
+    iter_best_paths  paths in order of decreasing score, found lazily with heaps
+    posteriors       posterior probability of every candidate tag with the forward-backward algorithm
+"""
+import heapq
+import math
+
+
+def transition_scores(ambiguous_seq, model):
+    """
+    Return transition scores of all cells of a lattice.
+    :param ambiguous_seq: list of lists of Tag objects framed by the sentence tag
+    :type model: BaselineModel
+    :return: list where item pos is a list of lists, scores[pos][k][j] = score of tag k at pos after tag j at pos - 1
+    """
+    scores = [None]
+    for pos in range(1, len(ambiguous_seq)):
+        prev_column = ambiguous_seq[pos - 1]
+        scores.append([[model.baseline_model(prev_tag, tag) for prev_tag in prev_column]
+                       for tag in ambiguous_seq[pos]])
+    return scores
+
+
+def iter_best_paths(ambiguous_seq, model):
+    """
+    Generate paths through a lattice in order of decreasing score, with the lazy k-best algorithm
+    of Huang and Chiang (2005). Every tag keeps the list of best paths ending at it found so far,
+    and a heap of candidates for the next one, where candidate (j, r) extends the r-th best path
+    of tag j at the previous position. The next path of a tag is only searched for when it is
+    asked for, so after one Viterbi pass every further path costs O(n log w) for n positions of
+    at most w tags, however many paths have equal scores.
+    :param ambiguous_seq: list of lists of Tag objects framed by the sentence tag
+    :type model: BaselineModel
+    :return: generator of tuples of list of Tag objects and its score, the first one is the path of best_path
+    """
+    scores = transition_scores(ambiguous_seq, model)
+    # paths[pos][k] is a list of (score, j, r) of best paths ending at tag k of position pos, in order of
+    # decreasing score, candidates[pos][k] the heap of (-score, j, r) candidates, None once there are no more
+    paths = [[[(0.0, None, None)] for _ in ambiguous_seq[0]]]
+    candidates = [[None] * len(ambiguous_seq[0])]
+    for pos in range(1, len(ambiguous_seq)):
+        prev_paths = paths[-1]
+        paths.append([])
+        candidates.append([])
+        for row in scores[pos]:
+            heap = [(-(prev_paths[j][0][0] + score), j, 0) for j, score in enumerate(row)]
+            heapq.heapify(heap)
+            score, j, r = heapq.heappop(heap)
+            paths[pos].append([(-score, j, r)])
+            candidates[pos].append(heap)
+
+    def extend(pos, k):
+        # Find the next best path of tag k at pos, first those of the previous tags it needs
+        stack = [(pos, k)]
+        while stack:
+            pos, k = stack[-1]
+            _, j, r = paths[pos][k][-1]
+            prev_paths = paths[pos - 1][j]
+            if len(prev_paths) == r + 1 and candidates[pos - 1][j] is not None:
+                stack.append((pos - 1, j))
+                continue
+            stack.pop()
+            heap = candidates[pos][k]
+            if len(prev_paths) > r + 1:
+                heapq.heappush(heap, (-(prev_paths[r + 1][0] + scores[pos][k][j]), j, r + 1))
+            if heap:
+                score, j, r = heapq.heappop(heap)
+                paths[pos][k].append((-score, j, r))
+            else:
+                candidates[pos][k] = None
+
+    last = len(ambiguous_seq) - 1
+    ends = [(-tag_paths[0][0], k, 0) for k, tag_paths in enumerate(paths[last])]
+    heapq.heapify(ends)
+    while ends:
+        score, k, r = heapq.heappop(ends)
+        path = [None] * len(ambiguous_seq)
+        tag_index, rank = k, r
+        for pos in range(last, -1, -1):
+            path[pos] = ambiguous_seq[pos][tag_index]
+            _, tag_index, rank = paths[pos][tag_index][rank]
+        yield path, -score
+        if len(paths[last][k]) == r + 1 and candidates[last][k] is not None:
+            extend(last, k)
+        if len(paths[last][k]) > r + 1:
+            heapq.heappush(ends, (-paths[last][k][r + 1][0], k, r + 1))
+
+
+def k_best_paths(ambiguous_seq, model, k):
+    """
+    Return the k highest scoring paths through a lattice, see iter_best_paths.
+    :param ambiguous_seq: list of lists of Tag objects framed by the sentence tag
+    :type model: BaselineModel
+    :param k: int
+    :return: list of at most k tuples of list of Tag objects and its score, in order of decreasing score
+    """
+    paths = []
+    for item in iter_best_paths(ambiguous_seq, model):
+        if len(paths) == k:
+            break
+        paths.append(item)
+    return paths
+
+
+def _logsumexp(values):
+    top = max(values)
+    if top == -math.inf:
+        return top
+    return top + math.log(sum(math.exp(value - top) for value in values))
+
+
+def posteriors(ambiguous_seq, model, base=10.0):
+    """
+    Return posterior probability of every tag of a lattice, i.e. the probability mass of the
+    paths through the tag, where the weight of a path is base ** score. Forward and backward
+    sums are kept as natural logarithms, so that long sentences do not underflow.
+    :param ambiguous_seq: list of lists of Tag objects framed by the sentence tag
+    :type model: BaselineModel
+    :param base: float, base of the logarithms the model scores with, 10 for language models of main.lm
+    :return: tuple of list of lists of floats, posteriors[pos][k] of tag k at position pos,
+    and logarithm in the given base of the total weight of all paths
+    """
+    scale = math.log(base)
+    scores = [None] + [[[score * scale for score in row] for row in rows]
+                       for rows in transition_scores(ambiguous_seq, model)[1:]]
+
+    forward = [[0.0] * len(ambiguous_seq[0])]
+    for pos in range(1, len(ambiguous_seq)):
+        prev = forward[-1]
+        forward.append([_logsumexp([p + score for p, score in zip(prev, row)]) for row in scores[pos]])
+
+    backward = [None] * len(ambiguous_seq)
+    backward[-1] = [0.0] * len(ambiguous_seq[-1])
+    for pos in range(len(ambiguous_seq) - 1, 0, -1):
+        rows, after = scores[pos], backward[pos]
+        backward[pos - 1] = [_logsumexp([rows[k][j] + b for k, b in enumerate(after)])
+                             for j in range(len(ambiguous_seq[pos - 1]))]
+
+    log_z = _logsumexp(forward[-1])
+    marginals = [[math.exp(f + b - log_z) for f, b in zip(forward[pos], backward[pos])]
+                 for pos in range(len(ambiguous_seq))]
+    return marginals, log_z / scale
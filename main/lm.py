@@ -0,0 +1,544 @@
+# coding=utf-8
+"""
+In-process n-gram language model estimation.
+
+Counts n-grams from token sequences and estimates a backoff language model
+with Witten-Bell or modified Kneser-Ney smoothing, so that root and IG models
+can be built without running SRILM ngram-count.
+"""
+import math
+from collections import Counter, defaultdict
+
+# Log10 probability used in ARPA files for impossible events.
+LOG_ZERO = -99.0
+
+
+class NgramCounter:
+    """Counts of all n-grams up to a given order."""
+
+    def __init__(self, order=2):
+        """
+        Constructor.
+        :param order: int, highest n-gram order to count.
+        """
+        assert order >= 1
+        self.order = order
+        # counts[k] maps k-gram tuples to counts, counts[0] is unused.
+        self.counts = [None] + [Counter() for _ in range(order)]
+
+    def add_sequence(self, tokens, start=0):
+        """
+        Count all n-grams of a token sequence, e.g. one line of roots.txt or igs.txt.
+        :param tokens: list of strings
+        :param start: int, only n-grams ending at this position or later are counted, so that
+        a long sequence can be counted in parts that repeat the last order - 1 tokens of the previous one
+        """
+        tokens = tuple(tokens)
+        for k in range(1, self.order + 1):
+            counts = self.counts[k]
+            for i in range(max(start - k + 1, 0), len(tokens) - k + 1):
+                counts[tokens[i:i + k]] += 1
+
+    def update(self, other):
+        """
+        Add counts of another counter of the same order.
+        :type other: NgramCounter
+        """
+        assert other.order == self.order
+        for k in range(1, self.order + 1):
+            self.counts[k].update(other.counts[k])
+
+    def subtract(self, other):
+        """
+        Remove counts of another counter of the same order, e.g. of a file that changed.
+        N-grams whose count drops to zero are removed.
+        :type other: NgramCounter
+        """
+        assert other.order == self.order
+        for k in range(1, self.order + 1):
+            counts = self.counts[k]
+            for gram, c in other.counts[k].items():
+                left = counts[gram] - c
+                if left < 0:
+                    raise ValueError('Count of %s would become negative' % ' '.join(gram))
+                if left:
+                    counts[gram] = left
+                else:
+                    del counts[gram]
+
+    def __len__(self):
+        return sum(len(counts) for counts in self.counts[1:])
+
+    @property
+    def vocab(self):
+        """
+        Return sorted list of unigrams.
+        :rtype : list
+        """
+        return sorted(ngram[0] for ngram in self.counts[1])
+
+
+def count_file(fpath, order=2, last_only=False):
+    """
+    Count n-grams in a text file, treating every line as a separate sequence.
+    :param fpath: file path, e.g. roots.txt or igs.txt
+    :param order: int
+    :param last_only: boolean, only count the n-grams that end with the last token of a line,
+    e.g. of igs.txt, whose lines are an IG after the IGs it is conditioned on
+    :rtype : NgramCounter
+    """
+    counter = NgramCounter(order)
+    with open(fpath, encoding='utf-8') as f:
+        for line in f:
+            tokens = line.split()
+            if tokens:
+                counter.add_sequence(tokens, start=len(tokens) - 1 if last_only else 0)
+    return counter
+
+
+class BackoffModel:
+    """Backoff n-gram language model with log10 probabilities, as stored in ARPA files."""
+
+    def __init__(self, order):
+        """
+        Constructor.
+        :param order: int
+        """
+        self.order = order
+        # ngrams[k] maps k-gram tuples to [log10 prob, log10 backoff weight].
+        self.ngrams = [None] + [{} for _ in range(order)]
+
+    def logprob(self, ngram):
+        """
+        Return stored log10 probability of an n-gram or None if it is not in the model.
+        :type ngram: tuple
+        """
+        entry = self.ngrams[len(ngram)].get(ngram)
+        return entry[0] if entry else None
+
+    def backoff(self, context):
+        """
+        Return log10 backoff weight of a context, 0.0 if the context is not in the model.
+        :type context: tuple
+        """
+        if not context:
+            return 0.0
+        entry = self.ngrams[len(context)].get(context)
+        return entry[1] if entry else 0.0
+
+    def score(self, context, word):
+        """
+        Return log10 Pr(word | context) applying standard backoff.
+        :param context: sequence of strings, only the last order - 1 are used.
+        :param word: str
+        :rtype : float
+        """
+        context = tuple(context)[-(self.order - 1):] if self.order > 1 else ()
+        weight = 0.0
+        while True:
+            entry = self.ngrams[len(context) + 1].get(context + (word,))
+            if entry:
+                return weight + entry[0]
+            if not context:
+                return LOG_ZERO
+            weight += self.backoff(context)
+            context = context[1:]
+
+    def probs(self, ngram=2):
+        """
+        Return highest order probabilities as a nested dictionary, the format that
+        BaselineModel expects, e.g. {word1: {word2: log10 Pr(word2 | word1)}}.
+        Contexts longer than one word are tuples.
+        :param ngram: int
+        :rtype : dict
+        """
+        probs = defaultdict(dict)
+        for gram, (prob, _) in self.ngrams[ngram].items():
+            context = gram[0] if ngram == 2 else gram[:-1]
+            probs[context][gram[-1]] = prob
+        return dict(probs)
+
+    def write_arpa(self, fpath):
+        """
+        Write the model to a file in ARPA format.
+        :param fpath: file path
+        """
+        with open(fpath, 'w', encoding='utf-8') as f:
+            f.write('\n\\data\\\n')
+            for k in range(1, self.order + 1):
+                f.write('ngram %d=%d\n' % (k, len(self.ngrams[k])))
+            for k in range(1, self.order + 1):
+                f.write('\n\\%d-grams:\n' % k)
+                for gram in sorted(self.ngrams[k]):
+                    prob, bow = self.ngrams[k][gram]
+                    if k < self.order:
+                        f.write('%.6f\t%s\t%.6f\n' % (prob, ' '.join(gram), bow))
+                    else:
+                        f.write('%.6f\t%s\n' % (prob, ' '.join(gram)))
+            f.write('\n\\end\\\n')
+
+
+def _log10(p):
+    return math.log10(p) if p > 0 else LOG_ZERO
+
+
+def _kn_discounts(n):
+    """
+    Return modified Kneser-Ney discounts (D1, D2, D3+) for counts of one order
+    as in Chen & Goodman. Falls back to a single absolute discount when
+    count-of-counts are too sparse, e.g. on small corpora.
+    :param n: count-of-counts, i.e. mapping of count c to number of n-grams seen c times, c <= 4
+    :rtype : tuple
+    """
+    n1, n2, n3, n4 = n[1], n[2], n[3], n[4]
+    if n1 and n2:
+        y = n1 / (n1 + 2.0 * n2)
+        if n3 and n4:
+            d = (1 - 2 * y * n2 / n1, 2 - 3 * y * n3 / n2, 3 - 4 * y * n4 / n3)
+            if all(0 < d_i < i + 1 for i, d_i in enumerate(d)):
+                return d
+        return y, y, y
+    return 0.5, 0.5, 0.5
+
+
+def _continuation_counts(higher):
+    """
+    Return Kneser-Ney continuation counts N1+(. w) from counts of the next order.
+    :param higher: dict of (k + 1)-gram counts
+    :rtype : Counter
+    """
+    continuation = Counter()
+    for gram in higher:
+        continuation[gram[1:]] += 1
+    return continuation
+
+
+def _add_missing_contexts(model, k, contexts):
+    """
+    Add contexts of k-grams that are not (k - 1)-grams of a model, e.g. IGs before the first
+    IG transition of a file, with the probability the model gives them by backing off, as SRILM
+    does, so that they can keep backoff weights. Probabilities of the model do not change.
+    :type model: BackoffModel
+    :param k: int
+    :param contexts: iterable of (k - 1)-gram tuples
+    """
+    lower = model.ngrams[k - 1]
+    for context in contexts:
+        if context not in lower:
+            lower[context] = [model.score(context[:-1], context[-1]), 0.0]
+
+
+def estimate(counter, smoothing='kn'):
+    """
+    Estimate a backoff language model from n-gram counts.
+    Probabilities are interpolated with lower orders and stored together with
+    backoff weights, like SRILM does with -interpolate.
+    :param counter: NgramCounter
+    :param smoothing: 'kn' for modified Kneser-Ney or 'wb' for Witten-Bell
+    :rtype : BackoffModel
+    """
+    if smoothing not in ('kn', 'wb'):
+        raise ValueError('Unknown smoothing: %s' % smoothing)
+    order = counter.order
+    model = BackoffModel(order)
+    vocab_size = len(counter.counts[1])
+    if not vocab_size:
+        return model
+
+    for k in range(1, order + 1):
+        counts = counter.counts[k]
+        if smoothing == 'kn' and k < order:
+            # N-grams never seen with a left context (e.g. at the start of a sequence)
+            # keep their raw count, as SRILM does for n-grams starting with <s>.
+            continuation = _continuation_counts(counter.counts[k + 1])
+            counts = {gram: continuation[gram] or c for gram, c in counts.items()}
+        discounts = _kn_discounts(Counter(c for c in counts.values() if c <= 4)) if smoothing == 'kn' else None
+
+        # Per-context totals and number of distinct followers by count
+        totals = defaultdict(int)
+        followers = defaultdict(lambda: [0, 0, 0])
+        for gram, c in counts.items():
+            context = gram[:-1]
+            totals[context] += c
+            followers[context][min(c, 3) - 1] += 1
+
+        lower = model.ngrams[k - 1] if k > 1 else None
+        entries = model.ngrams[k]
+        for gram, c in counts.items():
+            context = gram[:-1]
+            total = totals[context]
+            n1, n2, n3 = followers[context]
+            p_lower = 10 ** lower[gram[1:]][0] if lower else 1.0 / vocab_size
+            if smoothing == 'kn':
+                d = discounts[min(c, 3) - 1]
+                gamma = (discounts[0] * n1 + discounts[1] * n2 + discounts[2] * n3) / total
+                p = max(c - d, 0.0) / total + gamma * p_lower
+            else:
+                types = n1 + n2 + n3
+                p = (c + types * p_lower) / (total + types)
+            entries[gram] = [_log10(p), 0.0]
+
+        if k > 1:
+            # Backoff weights of the contexts, so that Pr(. | context) sums to one
+            seen, seen_lower = defaultdict(float), defaultdict(float)
+            for gram, (prob, _) in entries.items():
+                seen[gram[:-1]] += 10 ** prob
+                seen_lower[gram[:-1]] += 10 ** lower[gram[1:]][0]
+            _add_missing_contexts(model, k, seen)
+            for context in seen:
+                numerator, denominator = 1.0 - seen[context], 1.0 - seen_lower[context]
+                if numerator <= 1e-12:
+                    bow = LOG_ZERO
+                elif denominator <= 1e-12:
+                    bow = 0.0
+                else:
+                    bow = math.log10(numerator / denominator)
+                lower[context][1] = bow
+    return model
+
+
+class IncrementalLM:
+    """
+    Interpolated backoff language model that follows changing n-gram counts.
+    The statistics estimate() aggregates over all n-grams (per context totals and
+    number of followers, count-of-counts and Kneser-Ney continuation counts) are
+    updated with every added or removed n-gram, and probabilities are computed
+    on demand from them. Updates take time proportional to the number of changed
+    n-grams, and probabilities are the ones estimate() gives for the current counts,
+    up to rounding of backoff weights.
+    """
+
+    def __init__(self, order=2, smoothing='kn'):
+        """
+        Constructor.
+        :param order: int
+        :param smoothing: 'kn' for modified Kneser-Ney or 'wb' for Witten-Bell
+        """
+        if smoothing not in ('kn', 'wb'):
+            raise ValueError('Unknown smoothing: %s' % smoothing)
+        self.order = order
+        self.smoothing = smoothing
+        self.counter = NgramCounter(order)
+        # continuation[k] maps k-grams to N1+(. gram), kept for k < order with Kneser-Ney
+        self.continuation = [None] + [Counter() for _ in range(order)]
+        # totals[k] and followers[k] map contexts to the sum of counts and to the numbers of
+        # followers seen once, twice and more often, count_of_counts[k] maps counts up to 4
+        # to the number of k-grams, all over the counts that order k is estimated from
+        self.totals = [None] + [{} for _ in range(order)]
+        self.followers = [None] + [{} for _ in range(order)]
+        self.count_of_counts = [None] + [Counter() for _ in range(order)]
+        # successors[k] maps contexts to followers at order k + 1 in order of appearance
+        self.successors = [None] + [{} for _ in range(order)]
+        self._logprobs = {}
+        self._backoffs = {}
+        self._discounts = [None] * (order + 1)
+
+    def _effective(self, k, gram):
+        c = self.counter.counts[k][gram]
+        if c and self.smoothing == 'kn' and k < self.order:
+            # As in estimate(), n-grams never seen with a left context keep their raw count
+            return self.continuation[k][gram] or c
+        return c
+
+    def _adjust(self, k, gram, old, new):
+        """
+        Replace contribution of a k-gram counted old times by new times in the statistics of order k.
+        """
+        if old == new:
+            return
+        context = gram[:-1]
+        totals, followers, count_of_counts = self.totals[k], self.followers[k], self.count_of_counts[k]
+        if old:
+            totals[context] -= old
+            followers[context][min(old, 3) - 1] -= 1
+            if old <= 4:
+                count_of_counts[old] -= 1
+            if not totals[context]:
+                del totals[context]
+                del followers[context]
+        if new:
+            totals[context] = totals.get(context, 0) + new
+            followers.setdefault(context, [0, 0, 0])[min(new, 3) - 1] += 1
+            if new <= 4:
+                count_of_counts[new] += 1
+
+    def _change(self, k, gram, delta):
+        counts = self.counter.counts[k]
+        old = counts[gram]
+        new = old + delta
+        if new < 0:
+            raise ValueError('Count of %s would become negative' % ' '.join(gram))
+        old_effective = self._effective(k, gram)
+        if new:
+            counts[gram] = new
+        else:
+            del counts[gram]
+        self._adjust(k, gram, old_effective, self._effective(k, gram))
+        if bool(old) == bool(new):
+            return
+        # The n-gram appeared or disappeared
+        if k > 1:
+            successors = self.successors[k - 1]
+            if new:
+                successors.setdefault(gram[:-1], {})[gram[-1]] = None
+            else:
+                del successors[gram[:-1]][gram[-1]]
+                if not successors[gram[:-1]]:
+                    del successors[gram[:-1]]
+            if self.smoothing == 'kn':
+                suffix = gram[1:]
+                old_effective = self._effective(k - 1, suffix)
+                self.continuation[k - 1][suffix] += 1 if new else -1
+                if not self.continuation[k - 1][suffix]:
+                    del self.continuation[k - 1][suffix]
+                self._adjust(k - 1, suffix, old_effective, self._effective(k - 1, suffix))
+
+    def _update(self, counter, sign):
+        assert counter.order == self.order
+        for k in range(1, self.order + 1):
+            for gram, c in counter.counts[k].items():
+                self._change(k, gram, sign * c)
+        self._logprobs.clear()
+        self._backoffs.clear()
+        self._discounts = [None] * (self.order + 1)
+
+    def add(self, counter):
+        """
+        Add n-gram counts.
+        :type counter: NgramCounter
+        """
+        self._update(counter, 1)
+
+    def subtract(self, counter):
+        """
+        Remove n-gram counts added before.
+        :type counter: NgramCounter
+        """
+        self._update(counter, -1)
+
+    def _discount(self, k, c):
+        if self._discounts[k] is None:
+            self._discounts[k] = _kn_discounts(self.count_of_counts[k])
+        return self._discounts[k][min(c, 3) - 1]
+
+    def logprob(self, ngram):
+        """
+        Return log10 probability of an n-gram or None if it is not in the model.
+        :type ngram: tuple
+        """
+        try:
+            return self._logprobs[ngram]
+        except KeyError:
+            pass
+        k = len(ngram)
+        c = self._effective(k, ngram)
+        if not c:
+            return None
+        context = ngram[:-1]
+        total = self.totals[k][context]
+        n1, n2, n3 = self.followers[k][context]
+        p_lower = 10 ** self.logprob(ngram[1:]) if k > 1 else 1.0 / len(self.counter.counts[1])
+        if self.smoothing == 'kn':
+            gamma = (self._discount(k, 1) * n1 + self._discount(k, 2) * n2 + self._discount(k, 3) * n3) / total
+            p = max(c - self._discount(k, c), 0.0) / total + gamma * p_lower
+        else:
+            types = n1 + n2 + n3
+            p = (c + types * p_lower) / (total + types)
+        self._logprobs[ngram] = _log10(p)
+        return self._logprobs[ngram]
+
+    def backoff(self, context):
+        """
+        Return log10 backoff weight of a context, 0.0 if the context is not in the model.
+        :type context: tuple
+        """
+        context = tuple(context)
+        if not 0 < len(context) < self.order or context not in self.successors[len(context)]:
+            return 0.0
+        try:
+            return self._backoffs[context]
+        except KeyError:
+            pass
+        seen, seen_lower = 0.0, 0.0
+        for word in self.successors[len(context)][context]:
+            seen += 10 ** self.logprob(context + (word,))
+            seen_lower += 10 ** self.logprob(context[1:] + (word,))
+        numerator, denominator = 1.0 - seen, 1.0 - seen_lower
+        if numerator <= 1e-12:
+            bow = LOG_ZERO
+        elif denominator <= 1e-12:
+            bow = 0.0
+        else:
+            bow = math.log10(numerator / denominator)
+        self._backoffs[context] = bow
+        return bow
+
+    def score(self, context, word):
+        """
+        Return log10 Pr(word | context) applying standard backoff.
+        :param context: sequence of strings, only the last order - 1 are used.
+        :param word: str
+        :rtype : float
+        """
+        context = tuple(context)[-(self.order - 1):] if self.order > 1 else ()
+        weight = 0.0
+        while True:
+            prob = self.logprob(context + (word,))
+            if prob is not None:
+                return weight + prob
+            if not context:
+                return LOG_ZERO
+            weight += self.backoff(context)
+            context = context[1:]
+
+    def probs(self, ngram=2):
+        """
+        Return probabilities of the given order as a nested dictionary, see BackoffModel.probs.
+        :param ngram: int
+        :rtype : dict
+        """
+        probs = defaultdict(dict)
+        for gram in self.counter.counts[ngram]:
+            context = gram[0] if ngram == 2 else gram[:-1]
+            probs[context][gram[-1]] = self.logprob(gram)
+        return dict(probs)
+
+    def to_model(self):
+        """
+        Return the current model as a BackoffModel, e.g. to write it in ARPA or binary format.
+        :rtype : BackoffModel
+        """
+        model = BackoffModel(self.order)
+        for k in range(1, self.order + 1):
+            model.ngrams[k] = {gram: [self.logprob(gram), self.backoff(gram)] for gram in self.counter.counts[k]}
+            if k > 1:
+                _add_missing_contexts(model, k, self.successors[k - 1])
+                for context in self.successors[k - 1]:
+                    model.ngrams[k - 1][context][1] = self.backoff(context)
+        return model
+
+
+def iter_arpa(fpath):
+    """
+    Read n-grams of every order from a file in ARPA format.
+    :param fpath: file path
+    :return: generator of (order, n-gram tuple, log10 prob, log10 backoff weight) tuples,
+    unigrams first. Backoff weight is 0.0 if it is not given.
+    """
+    order = 0
+    with open(fpath, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('\\'):
+                # Section header, e.g. \2-grams:, \data\ or \end\
+                order = int(line[1:line.index('-')]) if line.endswith('-grams:') else 0
+                continue
+            if not order:
+                continue
+            fields = line.split()
+            prob = float(fields[0])
+            words = tuple(fields[1:order + 1])
+            backoff = float(fields[order + 1]) if len(fields) > order + 1 else 0.0
+            yield order, words, prob, backoff
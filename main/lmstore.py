@@ -0,0 +1,368 @@
+# coding=utf-8
+"""
+Compact binary storage for backoff language models.
+
+The file holds a sorted vocabulary table followed by, for every order, packed
+arrays of n-gram keys, log10 probabilities and backoff weights. An n-gram key is
+(index of its context among the (n-1)-grams) * vocabulary size + word id, and keys
+are sorted, so every lookup is a binary search over memory-mapped arrays and
+nothing has to be deserialized at load time.
+
+Layout (native byte order, every section aligned to 8 bytes):
+    header      magic, version, byte order, order, vocabulary size, n-gram counts
+    vocabulary  uint64 offsets[V + 1], UTF-8 bytes of the sorted words
+    order 1     float32 log10 probs[V], float32 backoffs[V]
+    order k     uint64 keys[n_k], float32 log10 probs[n_k], float32 backoffs[n_k] (k < order)
+"""
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+from main.lm import LOG_ZERO, iter_arpa
+
+MAGIC = b'KZLM'
+VERSION = 1
+_HEADER = struct.Struct('<4sIII')
+_BYTE_ORDERS = {'little': 0, 'big': 1}
+
+
+def _pad(size):
+    return -size % 8
+
+
+class PackedLM:
+    """Backoff language model over sorted arrays of packed n-gram keys."""
+
+    def __init__(self, order, words, keys, logprobs, backoffs):
+        """
+        Constructor.
+        :param order: int
+        :param words: sorted sequence of vocabulary words, unigram i is words[i]
+        :param keys: list indexed by order of sorted sequences of n-gram keys, None for orders 0 and 1
+        :param logprobs: list indexed by order of sequences of log10 probabilities
+        :param backoffs: list indexed by order of sequences of log10 backoff weights, None for the highest order
+        """
+        self.order = order
+        self.words = words
+        self.keys = keys
+        self.logprobs = logprobs
+        self.backoffs = backoffs
+
+    @property
+    def vocab_size(self):
+        return len(self.words)
+
+    def word_id(self, word):
+        """
+        Return id of a word or None if it is not in the vocabulary.
+        :rtype : int
+        :type word: str
+        """
+        pos = bisect_left(self.words, word)
+        if pos < len(self.words) and self.words[pos] == word:
+            return pos
+        return None
+
+    def _index(self, ngram):
+        """
+        Return position of an n-gram in the arrays of its order, or -1 if it is not stored.
+        :type ngram: sequence of strings
+        """
+        index = -1
+        for k, word in enumerate(ngram, 1):
+            word_id = self.word_id(word)
+            if word_id is None:
+                return -1
+            if k == 1:
+                index = word_id
+                continue
+            keys = self.keys[k]
+            key = index * len(self.words) + word_id
+            index = bisect_left(keys, key)
+            if index == len(keys) or keys[index] != key:
+                return -1
+        return index
+
+    def logprob(self, ngram):
+        """
+        Return stored log10 probability of an n-gram or None if it is not in the model.
+        :type ngram: tuple
+        """
+        index = self._index(ngram)
+        return self.logprobs[len(ngram)][index] if index >= 0 else None
+
+    def backoff(self, context):
+        """
+        Return log10 backoff weight of a context, 0.0 if the context is not in the model.
+        :type context: tuple
+        """
+        if not context or len(context) >= self.order:
+            return 0.0
+        index = self._index(context)
+        return self.backoffs[len(context)][index] if index >= 0 else 0.0
+
+    def score(self, context, word):
+        """
+        Return log10 Pr(word | context) applying standard backoff.
+        :param context: sequence of strings, only the last order - 1 are used.
+        :param word: str
+        :rtype : float
+        """
+        context = tuple(context)[-(self.order - 1):] if self.order > 1 else ()
+        weight = 0.0
+        while True:
+            prob = self.logprob(context + (word,))
+            if prob is not None:
+                return weight + prob
+            if not context:
+                return LOG_ZERO
+            weight += self.backoff(context)
+            context = context[1:]
+
+    def ngram(self, k, index):
+        """
+        Return the words of the n-gram of order k at a position.
+        :rtype : tuple
+        """
+        gram = []
+        for order in range(k, 1, -1):
+            index, word_id = divmod(self.keys[order][index], len(self.words))
+            gram.append(self.words[word_id])
+        gram.append(self.words[index])
+        return tuple(reversed(gram))
+
+    def probs(self, ngram=2):
+        """
+        Return probabilities of an order as a nested dictionary, as BackoffModel.probs does,
+        e.g. {word1: {word2: log10 Pr(word2 | word1)}}. Contexts longer than one word are tuples.
+        :param ngram: int
+        :rtype : dict
+        """
+        probs = {}
+        for i, prob in enumerate(self.logprobs[ngram]):
+            gram = self.ngram(ngram, i)
+            context = gram[0] if ngram == 2 else gram[:-1]
+            probs.setdefault(context, {})[gram[-1]] = prob
+        return probs
+
+
+class _MappedWords:
+    """Sorted vocabulary stored as offsets into a block of UTF-8 bytes."""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+
+class MappedLM(PackedLM):
+    """
+    PackedLM backed by a memory-mapped binary file. Processes mapping the same file share its pages,
+    and it is pickled as the file path, so that e.g. pool workers map the file instead of copying it.
+    """
+
+    def __init__(self, fpath):
+        """
+        Constructor.
+        :param fpath: path to a file written by write_binary
+        """
+        self.fpath = fpath
+        with open(fpath, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+        magic, version, byte_order, order = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a binary language model file' % fpath)
+        if byte_order != _BYTE_ORDERS[sys.byteorder]:
+            raise ValueError('%s was written on a machine with different byte order' % fpath)
+        offset = _HEADER.size
+        counts = struct.unpack_from('<%dQ' % (order + 1), buf, offset)
+        offset += 8 * (order + 1)
+        vocab_size = counts[0]
+
+        def take(typecode, n):
+            nonlocal offset
+            size = n * struct.calcsize(typecode)
+            view = buf[offset:offset + size].cast(typecode)
+            offset += size + _pad(size)
+            return view
+
+        offsets = take('Q', vocab_size + 1)
+        words = _MappedWords(offsets, take('B', offsets[-1]))
+        keys, logprobs, backoffs = [None, None], [None], [None]
+        for k in range(1, order + 1):
+            if k > 1:
+                keys.append(take('Q', counts[k]))
+            logprobs.append(take('f', counts[k]))
+            backoffs.append(take('f', counts[k]) if k < order else None)
+        super().__init__(order, words, keys, logprobs, backoffs)
+
+    def __reduce__(self):
+        return MappedLM, (self.fpath,)
+
+
+def _permute(values, order, typecode):
+    return array(typecode, [values[i] for i in order])
+
+
+def pack(model):
+    """
+    Return a PackedLM with the n-grams of a model that keeps them in dictionaries.
+    :param model: BackoffModel, or any object with order and ngrams attributes, where
+    ngrams[k] maps k-gram tuples to (log10 prob, log10 backoff weight).
+    :rtype : PackedLM
+    """
+    order = model.order
+    words = sorted(gram[0] for gram in model.ngrams[1])
+    word_ids = {word: i for i, word in enumerate(words)}
+    keys, logprobs, backoffs = [None, None], [None], [None]
+    # Position of every n-gram of the previous order, to compute keys of the next one
+    positions = {}
+    for k in range(1, order + 1):
+        entries = []
+        for gram, (prob, backoff) in model.ngrams[k].items():
+            if k == 1:
+                key = word_ids[gram[0]]
+            else:
+                try:
+                    key = positions[gram[:-1]] * len(words) + word_ids[gram[-1]]
+                except KeyError:
+                    raise ValueError('N-gram %s has no context or word in lower orders' % ' '.join(gram))
+            entries.append((key, gram, prob, backoff))
+        entries.sort(key=lambda entry: entry[0])
+        if k > 1:
+            keys.append(array('Q', [entry[0] for entry in entries]))
+        logprobs.append(array('f', [entry[2] for entry in entries]))
+        backoffs.append(array('f', [entry[3] for entry in entries]) if k < order else None)
+        if k < order:
+            positions = {entry[1]: i for i, entry in enumerate(entries)}
+    return PackedLM(order, words, keys, logprobs, backoffs)
+
+
+def read_arpa(fpath):
+    """
+    Read a language model of any order from a file in ARPA format into sorted arrays.
+    N-grams are streamed from the file, so apart from the vocabulary no per n-gram
+    Python objects are kept.
+    :param fpath: file path, e.g. created by SRILM or BackoffModel.write_arpa
+    :rtype : PackedLM
+    """
+    words, word_ids = [], {}
+    keys, logprobs, backoffs = [None, None], [None, array('f')], [None, array('f')]
+    lm = PackedLM(0, words, keys, logprobs, backoffs)
+
+    def finish(k):
+        # Sort the arrays of order k by key and make the order available for lookups
+        if k == 1:
+            order = sorted(range(len(words)), key=words.__getitem__)
+            words[:] = [words[i] for i in order]
+            word_ids.clear()
+            word_ids.update((word, i) for i, word in enumerate(words))
+        else:
+            k_keys = keys[k]
+            if all(k_keys[i] < k_keys[i + 1] for i in range(len(k_keys) - 1)):
+                order = None
+            else:
+                order = sorted(range(len(k_keys)), key=k_keys.__getitem__)
+                keys[k] = _permute(k_keys, order, 'Q')
+        if order is not None:
+            logprobs[k] = _permute(logprobs[k], order, 'f')
+            backoffs[k] = _permute(backoffs[k], order, 'f')
+        lm.order = k
+
+    def context_index(context):
+        index = word_ids[context[0]]
+        for k in range(2, len(context) + 1):
+            key = index * len(words) + word_ids[context[k - 1]]
+            index = bisect_left(keys[k], key)
+            if index == len(keys[k]) or keys[k][index] != key:
+                raise KeyError(context)
+        return index
+
+    current = 1
+    # N-grams with the same context usually follow each other
+    last_context, last_index = None, -1
+    for k, gram, prob, backoff in iter_arpa(fpath):
+        if k != current:
+            finish(current)
+            current = k
+            keys.append(array('Q'))
+            logprobs.append(array('f'))
+            backoffs.append(array('f'))
+        if k == 1:
+            words.append(gram[0])
+        else:
+            context = gram[:-1]
+            try:
+                if context != last_context:
+                    last_context, last_index = context, context_index(context)
+                keys[k].append(last_index * len(words) + word_ids[gram[-1]])
+            except KeyError:
+                raise ValueError('N-gram %s has no context or word in lower orders' % ' '.join(gram))
+        logprobs[k].append(prob)
+        backoffs[k].append(backoff)
+    finish(current)
+    backoffs[lm.order] = None
+    return lm
+
+
+def write_binary(lm, fpath):
+    """
+    Write a backoff language model to a binary file.
+    :param lm: PackedLM, or BackoffModel which is packed first
+    :param fpath: file path
+    """
+    if not isinstance(lm, PackedLM):
+        lm = pack(lm)
+    encoded = [word.encode('utf-8') for word in lm.words]
+    offsets = array('Q', [0])
+    for word in encoded:
+        offsets.append(offsets[-1] + len(word))
+    sections = [offsets.tobytes(), b''.join(encoded)]
+    counts = [lm.vocab_size]
+    for k in range(1, lm.order + 1):
+        counts.append(len(lm.logprobs[k]))
+        if k > 1:
+            sections.append(bytes(lm.keys[k]))
+        sections.append(bytes(lm.logprobs[k]))
+        if k < lm.order:
+            sections.append(bytes(lm.backoffs[k]))
+
+    with open(fpath, 'wb') as f:
+        header = _HEADER.pack(MAGIC, VERSION, _BYTE_ORDERS[sys.byteorder], lm.order)
+        header += struct.pack('<%dQ' % (lm.order + 1), *counts)
+        f.write(header + b'\0' * _pad(len(header)))
+        for section in sections:
+            f.write(section + b'\0' * _pad(len(section)))
+
+
+def arpa_to_binary(arpa_path, fpath):
+    """
+    Convert a language model in ARPA format to a binary file.
+    :param arpa_path: path to ARPA file
+    :param fpath: path to binary file
+    """
+    write_binary(read_arpa(arpa_path), fpath)
+
+
+def load(fpath):
+    """
+    Memory-map a binary language model file.
+    :param fpath: file path
+    :rtype : MappedLM
+    """
+    return MappedLM(fpath)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python -m main.lmstore model.arpa model.bin')
+        sys.exit(1)
+    arpa_to_binary(sys.argv[1], sys.argv[2])
@@ -0,0 +1,233 @@
+# coding=utf-8
+"""
+Optional counters, gauges and timers of the tagging pipeline.
+
+Instrumented code checks the module level enabled flag before recording anything,
+so disabled metrics cost one attribute lookup per call site. Metrics are enabled
+with enable() or by setting the KAZTAGGER_METRICS environment variable, and can be
+exported as JSON or in the Prometheus text format, e.g. for the node exporter
+textfile collector. Only metrics recorded in the current process are kept, i.e. not
+the ones of pool workers.
+
+Usage:
+    from main import metrics
+    if metrics.enabled:
+        metrics.inc('parse_sentences_total')
+    with metrics.timer('lm_build_seconds'):
+        ...
+"""
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+PREFIX = 'kaztagger_'
+# Upper bounds of histogram buckets of timers in seconds
+TIME_BUCKETS = (1e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+# Upper bounds of histogram buckets of lattice sizes in tags
+SIZE_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+enabled = bool(os.environ.get('KAZTAGGER_METRICS'))
+
+
+class Histogram:
+    """Count, sum, extremes and bucket counts of observed values."""
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        """
+        Constructor.
+        :param buckets: sorted tuple of bucket upper bounds, an infinite bucket is implied
+        """
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Return upper bound of the bucket that contains quantile q, the maximum for the infinite bucket.
+        :param q: float between 0 and 1
+        :rtype : float
+        """
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'buckets': [[bound, count] for bound, count in zip(self.buckets + ('+Inf',), self.bucket_counts)]}
+
+
+class Registry:
+    """Named counters, gauges and histograms."""
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        """
+        Increase a counter.
+        :param name: str, e.g. 'parse_sentences_total'
+        :param value: int or float
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """
+        Set a gauge.
+        :param name: str, e.g. 'server_queue_depth'
+        :param value: int or float
+        """
+        self.gauges[name] = value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS):
+        """
+        Add a value to a histogram, created with the given buckets on first use.
+        :param name: str, e.g. 'viterbi_sentence_seconds'
+        :param value: float
+        """
+        try:
+            histogram = self.histograms[name]
+        except KeyError:
+            histogram = self.histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+    def reset(self):
+        self.counters.clear()
+        self.gauges.clear()
+        self.histograms.clear()
+
+    def to_dict(self):
+        return {'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                'histograms': {name: h.to_dict() for name, h in self.histograms.items()}}
+
+    def to_json(self):
+        """
+        :rtype : str
+        """
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        Return metrics in the Prometheus text exposition format.
+        :rtype : str
+        """
+        lines = []
+        for name in sorted(self.counters):
+            lines.append('# TYPE %s%s counter' % (PREFIX, name))
+            lines.append('%s%s %r' % (PREFIX, name, self.counters[name]))
+        for name in sorted(self.gauges):
+            lines.append('# TYPE %s%s gauge' % (PREFIX, name))
+            lines.append('%s%s %r' % (PREFIX, name, self.gauges[name]))
+        for name in sorted(self.histograms):
+            histogram, full_name = self.histograms[name], PREFIX + name
+            lines.append('# TYPE %s histogram' % full_name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.bucket_counts):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (full_name, bound, cumulative))
+            lines.append('%s_sum %r' % (full_name, histogram.sum))
+            lines.append('%s_count %d' % (full_name, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def inc(name, value=1):
+    """
+    Increase a counter of the default registry if metrics are enabled.
+    """
+    if enabled:
+        REGISTRY.inc(name, value)
+
+
+def set_gauge(name, value):
+    """
+    Set a gauge of the default registry if metrics are enabled.
+    """
+    if enabled:
+        REGISTRY.set(name, value)
+
+
+def observe(name, value, buckets=TIME_BUCKETS):
+    """
+    Add a value to a histogram of the default registry if metrics are enabled.
+    """
+    if enabled:
+        REGISTRY.observe(name, value, buckets)
+
+
+@contextmanager
+def timer(name):
+    """
+    Context manager that adds the time spent in its block to a histogram if metrics are enabled.
+    Meant for coarse stages, hot loops should check enabled and call observe themselves.
+    :param name: str, e.g. 'lm_build_seconds'
+    """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, time.perf_counter() - start)
+
+
+def reset():
+    REGISTRY.reset()
+
+
+def _write(fpath, text):
+    # Write to a temporary file and rename, so that readers never see a partial file
+    tmp_path = '%s.%d.tmp' % (fpath, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, fpath)
+
+
+def write_json(fpath):
+    """
+    Write metrics of the default registry as JSON.
+    :param fpath: file path
+    """
+    _write(fpath, REGISTRY.to_json())
+
+
+def write_prometheus(fpath):
+    """
+    Write metrics of the default registry in the Prometheus text format, e.g. to a *.prom file
+    of the node exporter textfile collector directory.
+    :param fpath: file path
+    """
+    _write(fpath, REGISTRY.to_prometheus())
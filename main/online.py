@@ -0,0 +1,181 @@
+# coding=utf-8
+"""
+Fixed-lag online decoding of a stream of ambiguous words.
+
+OnlineViterbi extends the trellis of best_path one word at a time, without waiting for the
+end of a sentence. After every word it traces the surviving hypotheses back: positions where
+all of them pass through the same tag are final, since no later word can change the best path
+there, and are emitted at once. A sentence tag in the stream has one candidate, so everything
+before it is emitted when it arrives. With a lag, the oldest undecided word is decided
+by the best hypothesis once more than lag words are undecided, and hypotheses that disagree
+with the decision are dropped, so memory and latency are bounded on unpunctuated streams.
+Without a lag and pruning, the emitted tags are those of best_path on the whole sequence.
+
+Usage:
+    decoder = OnlineViterbi(model, lag=8)
+    for column in columns:
+        emit(decoder.push(column))
+    emit(decoder.finish())
+"""
+from collections import deque
+
+from main import metrics
+from main.viterbi_bigram import Tag, prune_hypotheses
+
+
+class OnlineViterbi:
+    """Viterbi decoder that takes ambiguous words one at a time, see the module docstring."""
+
+    def __init__(self, model, lag=None, beam=None, threshold=None):
+        """
+        Constructor. The stream starts like a sentence, after the sentence tag.
+        :type model: BaselineModel
+        :param lag: int, maximum number of words not decided yet, None waits until all paths agree
+        :param beam: int, number of best tags kept at each position, None keeps all
+        :param threshold: float, tags scoring more than threshold below the best one at a position are dropped
+        """
+        if lag is not None and lag < 0:
+            raise ValueError('Lag must not be negative: %d' % lag)
+        self.model = model
+        self.lag = lag
+        self.beam = beam
+        self.threshold = threshold
+        self._sentence_tag = Tag('.', ['sent'])
+        # Number of words decided, and of words decided by the lag before all paths agreed on them
+        self.num_decided = 0
+        self.num_forced = 0
+        self._reset()
+
+    def _reset(self):
+        # columns[0] is the last decided position, every hypothesis passes through it, the others are
+        # undecided; pointers[i] maps tags of columns[i] to their best previous tag in columns[i - 1]
+        self._columns = deque([[self._sentence_tag]])
+        self._pointers = deque([None])
+        # Scores of the surviving tags of the newest position
+        self._scores = {0: 0.0}
+
+    @property
+    def pending(self):
+        """
+        Return number of words pushed but not decided yet.
+        :rtype : int
+        """
+        return len(self._columns) - 1
+
+    @property
+    def score(self):
+        """
+        Return score of the best hypothesis so far.
+        :rtype : float
+        """
+        return max(self._scores.values())
+
+    def push(self, column):
+        """
+        Add the candidate tags of the next word.
+        :param column: list of Tag objects
+        :return: list of Tag objects of the words decided, in order, possibly empty
+        """
+        if not column:
+            raise ValueError('A word must have at least one candidate tag')
+        prev_column = self._columns[-1]
+        scores, back = {}, {}
+        for k, tag in enumerate(column):
+            best_score, best_j = None, None
+            for j, score in self._scores.items():
+                cur_score = score + self.model.baseline_model(prev_column[j], tag)
+                if best_score is None or cur_score > best_score:
+                    best_score, best_j = cur_score, j
+            scores[k], back[k] = best_score, best_j
+        self._scores, _ = prune_hypotheses(scores, self.beam, self.threshold)
+        self._columns.append(column)
+        self._pointers.append(back)
+        return self._decide()
+
+    def _agreed(self):
+        """
+        Return newest position all surviving hypotheses pass through and their tag there, or None.
+        """
+        alive = set(self._scores)
+        for i in range(len(self._columns) - 1, 0, -1):
+            if len(alive) == 1:
+                return i, next(iter(alive))
+            pointers = self._pointers[i]
+            alive = {pointers[k] for k in alive}
+        return None
+
+    def _trace(self, k, start, stop):
+        """
+        Return indices of the tags of the path from tag k at position start back to position stop.
+        """
+        indices = [k]
+        for i in range(start, stop, -1):
+            k = self._pointers[i][k]
+            indices.append(k)
+        indices.reverse()
+        return indices
+
+    def _decide(self):
+        decided = self._agreed()
+        if decided is None and self.lag is not None and self.pending > self.lag:
+            # Decide the oldest words by the best hypothesis, and drop the hypotheses that disagree
+            newest = len(self._columns) - 1
+            i = newest - self.lag
+            best = max(self._scores, key=self._scores.get)
+            k = self._trace(best, newest, i)[0]
+            alive = {k}
+            for q in range(i + 1, newest + 1):
+                alive = {m for m, j in self._pointers[q].items() if j in alive}
+            self._scores = {m: score for m, score in self._scores.items() if m in alive}
+            self.num_forced += i
+            if metrics.enabled:
+                metrics.inc('online_forced_total', i)
+            decided = i, k
+        if decided is None:
+            return []
+        i, k = decided
+        indices = self._trace(k, i, 0)[1:]
+        tags = [self._columns[pos][index] for pos, index in zip(range(1, i + 1), indices)]
+        for _ in range(i):
+            self._columns.popleft()
+            self._pointers.popleft()
+        self._pointers[0] = None
+        self.num_decided += i
+        if metrics.enabled:
+            metrics.inc('online_decided_total', i)
+        return tags
+
+    def finish(self, close=True):
+        """
+        Decide all words pushed so far by the best hypothesis and start a new stream.
+        :param close: boolean, score the end of the stream as a sentence end, i.e. push the sentence tag
+        :return: list of Tag objects of the words decided, in order, without the closing sentence tag
+        """
+        tags = self.push([self._sentence_tag]) if close else []
+        if self.pending:
+            newest = len(self._columns) - 1
+            best = max(self._scores, key=self._scores.get)
+            indices = self._trace(best, newest, 0)[1:]
+            tags.extend(self._columns[pos][index] for pos, index in zip(range(1, newest + 1), indices))
+            self.num_decided += newest
+        if close:
+            tags.pop()
+            self.num_decided -= 1
+        self._reset()
+        return tags
+
+
+def decode_stream(columns, model, lag=None, beam=None, threshold=None):
+    """
+    Decode a stream of ambiguous words, yielding tags as soon as they are decided.
+    :param columns: iterable of lists of Tag objects, one per word, e.g. read from a live text stream
+    :type model: BaselineModel
+    :param lag: int, maximum number of words not decided yet, None waits until all paths agree
+    :param beam: int, number of best tags kept at each position, None keeps all
+    :param threshold: float, tags scoring more than threshold below the best one at a position are dropped
+    :return: generator of Tag objects, one per word
+    """
+    decoder = OnlineViterbi(model, lag, beam, threshold)
+    for column in columns:
+        yield from decoder.push(column)
+    yield from decoder.finish()
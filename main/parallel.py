@@ -0,0 +1,165 @@
+# coding=utf-8
+"""
+Decoding on several cores with one model shared by all worker processes.
+
+Viterbi is pure Python, so a process decodes on one core only. SharedModelPool spreads
+batches of sentences over a pool of processes without sending the model to each of them:
+the model is stored in a module global before the workers are forked, so they share its
+memory copy-on-write. Where fork is not available the model is pickled once per worker;
+memory-mapped lmstore models are pickled as their file paths, so workers map the same file.
+Results are returned in the order of the batches. No more processes than cores are used, and
+callers decode in their own process when that leaves one, since on one core a pool only adds
+the cost of sending batches and results between processes.
+
+Usage:
+    from main.parallel import decode
+    paths = decode(lattices, model, processes=4)
+"""
+import multiprocessing
+import os
+from collections import deque
+from functools import partial
+
+from main.viterbi_bigram import best_path
+
+# Number of lattices or sentences sent to a worker at once, large enough that sending them costs
+# little next to decoding them
+BATCH_SIZE = 512
+# Maximum number of batches queued per worker, so that memory use does not depend on the input size
+BATCHES_PER_WORKER = 4
+
+# Model of the pool workers, set in the parent process before they are forked
+_model = None
+
+
+def worker_count(processes=None):
+    """
+    Return number of worker processes to use, at most the number of cores.
+    :param processes: int, requested number of processes, the number of cores if None
+    :rtype : int
+    """
+    cores = os.cpu_count() or 1
+    return min(processes or cores, cores)
+
+
+def _init_worker(model):
+    global _model
+    _model = model
+
+
+def _call(func, batch):
+    return func(batch, _model)
+
+
+class SharedModelPool:
+    """Pool of worker processes that call functions with a model shared by all of them."""
+
+    def __init__(self, model, processes=None):
+        """
+        Constructor. Only one pool should be open at a time.
+        :type model: BaselineModel
+        :param processes: int, number of worker processes, the number of cores if None, see worker_count
+        """
+        self.processes = worker_count(processes)
+        if 'fork' in multiprocessing.get_all_start_methods():
+            # Forked workers inherit the model, it is not pickled
+            _init_worker(model)
+            self.pool = multiprocessing.get_context('fork').Pool(self.processes)
+        else:
+            self.pool = multiprocessing.Pool(self.processes, initializer=_init_worker, initargs=(model,))
+
+    def imap(self, func, batches):
+        """
+        Call func(batch, model) for every batch in a worker process.
+        :param func: module level function, or functools.partial of one
+        :param batches: iterable of picklable batches, consumed as the workers need them
+        :return: generator of results in the order of the batches
+        """
+        pending = deque()
+        for batch in batches:
+            pending.append(self.pool.apply_async(_call, (func, batch)))
+            if len(pending) >= self.processes * BATCHES_PER_WORKER:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        _init_worker(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
+            _init_worker(None)
+
+
+def iter_batches(items, batch_size=BATCH_SIZE):
+    """
+    Group items into lists of batch_size items.
+    :param items: iterable
+    :param batch_size: int
+    :return: generator of lists
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _decode_batch(lattices, model, beam=None):
+    """
+    Return list of (indices of the best tags, score) of every lattice, so that only
+    small integers are sent back to the parent process.
+    """
+    results = []
+    for lattice in lattices:
+        path, score = best_path(lattice, model, beam=beam)
+        results.append(([next(k for k, candidate in enumerate(column) if candidate is tag)
+                         for column, tag in zip(lattice, path)], score))
+    return results
+
+
+def imap_decode(lattices, model, processes=None, batch_size=BATCH_SIZE, beam=None):
+    """
+    Decode lattices with best_path in a pool of processes, or in this process if only one
+    would be used (see worker_count).
+    :param lattices: iterable of lists of lists of Tag objects framed by the sentence tag
+    :type model: BaselineModel
+    :param processes: int, number of worker processes, the number of cores if None
+    :param batch_size: int, number of lattices sent to a worker at once
+    :param beam: int, number of best tags kept at each position, None keeps all
+    :return: generator of (path, score) tuples in the order of the lattices
+    """
+    if worker_count(processes) == 1:
+        for lattice in lattices:
+            yield best_path(lattice, model, beam=beam)
+        return
+    sent = deque()
+
+    def batches():
+        for batch in iter_batches(lattices, batch_size):
+            sent.append(batch)
+            yield batch
+
+    with SharedModelPool(model, processes) as pool:
+        for results in pool.imap(partial(_decode_batch, beam=beam), batches()):
+            for lattice, (indices, score) in zip(sent.popleft(), results):
+                yield [column[k] for column, k in zip(lattice, indices)], score
+
+
+def decode(lattices, model, processes=None, batch_size=BATCH_SIZE, beam=None):
+    """
+    Decode lattices with best_path in a pool of processes, see imap_decode.
+    :return: list of (path, score) tuples in the order of the lattices
+    """
+    return list(imap_decode(lattices, model, processes, batch_size, beam))
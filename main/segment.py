@@ -1,8 +1,18 @@
 # coding=utf-8
 __author__ = 'Assulan Nurkas'
+import bz2
+import gzip
+import lzma
+import mmap
 import re
 import os
-from collections import Counter
+from collections import Counter, deque
+from itertools import chain
+from multiprocessing import Pool
+from main import metrics
+from main.lm import NgramCounter, count_file, estimate
+from main.lmstore import read_arpa
+from main.viterbi_bigram import IG_TABLE
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 LM_CMD = '/home/aseke/srilm/bin/i686-m64/ngram-count'
@@ -10,14 +20,16 @@ LM_CMD = '/home/aseke/srilm/bin/i686-m64/ngram-count'
 LM_CORPUS_DIR = os.path.join(BASE_DIR, 'lm_corpus')
 SMALL_CORPUS = os.path.join(BASE_DIR, 'small_tagged_corpus')
 BIG_CORPUS = os.path.join(BASE_DIR, 'big_tagged_corpus')
-root_corpus, ig_corpus = '', ''
 
 
 class Sentence:
+    __slots__ = ('words', 'roots', 'igs')
+
     def __init__(self):
         """
-        Sentence consists of list of roots (strings), and list of Inflectional Group objects.
+        Sentence consists of list of words and list of roots (strings), and list of Inflectional Group objects.
         """
+        self.words = []
         self.roots = []
         self.igs = []
 
@@ -39,17 +51,19 @@ class Sentence:
 
 
 class InflectionalGroup:
+    __slots__ = ('group',)
+
     def __init__(self, group):
         """
-        Inflectional Group is a list of tags.
-        :param group: list of strings.
+        Inflectional Group is a sequence of tags, kept as a tuple shared through IG_TABLE.
+        :param group: list or tuple of strings.
         """
-        assert isinstance(group, list)
-        self.group = group
+        assert isinstance(group, (list, tuple))
+        self.group = IG_TABLE.intern(group)[0]
 
     def add(self, ig):
         assert isinstance(ig, str)
-        self.group.append(ig)
+        self.group = IG_TABLE.intern(self.group + (ig,))[0]
 
     def __str__(self):
         return ' '.join(self.group)
@@ -65,6 +79,297 @@ class InflectionalGroup:
     def last(self):
         return self.group[-1]
 
+    @property
+    def ids(self):
+        """
+        Return tuple of IG ids in IG_TABLE.
+        :rtype : tuple
+        """
+        return IG_TABLE.intern(self.group)[1]
+
+
+# Matches a cohort line '"<word>"' or a reading line '\t"root" tags @dep' in tagged corpus,
+# the latter up to the dependency label
+LINE_PATTERN = re.compile(r'^(?:"<.*>"|\t.*?(?=\s@))', re.MULTILINE)
+# LINE_PATTERN for scanning the bytes of memory-mapped files
+BYTES_LINE_PATTERN = re.compile(LINE_PATTERN.pattern.encode('utf-8'), re.MULTILINE)
+SEGMENTATION_RULES = ['subst', 'attr', 'advl', 'ger_', 'gpr_', 'gna_', 'prc_']
+# Matches any segmentation rule, no rule can start inside a match of another one
+SEGMENTATION_PATTERN = re.compile('|'.join(re.escape(rule) for rule in SEGMENTATION_RULES))
+# Maximum number of distinct cohort and reading strings remembered while parsing a file
+EXTRACT_CACHE_SIZE = 100000
+# Maximum number of distinct IG strings whose segmentation is remembered by segment_ig
+SEGMENT_CACHE_SIZE = 100000
+# Number of characters read from a corpus file at once
+CHUNK_SIZE = 1 << 20
+# Approximate number of bytes of a part of a large corpus file parsed by one worker process
+PARSE_CHUNK_SIZE = 16 << 20
+# Magic bytes of compressed corpus files and functions that open them
+COMPRESSED_FORMATS = [(b'\x1f\x8b', gzip.open), (b'BZh', bz2.open), (b'\xfd7zXZ\x00', lzma.open)]
+
+
+class TokenType:
+    word = 1
+    root = 2
+    ig = 3
+
+
+def _extract(ret_val):
+    """
+    Extract word, root, or IG from a matched line in tagged corpus file.
+    :param ret_val: str, match of LINE_PATTERN
+    :return: tuple (word, None) or (root, IG) or (None, copula IG).
+    """
+    num_tabs = ret_val.count('\t')
+    if num_tabs >= 2:
+        # Case '\t\te cop aor p3 sg' or similar, i.e. part of IG
+        return None, ret_val.strip('\t').replace('"', '').replace(' ', '$')
+    elif num_tabs == 1:
+        # Case '\tжегіз v tv prc_perf', i.e. root followed by IG
+        ret_val = ret_val.strip('\t')
+        index = ret_val.rindex('"')
+        ret_val = ret_val.replace('"', '')
+        root = ret_val[:index].strip().replace(' ', '$')
+        ig = ret_val[index:].strip().replace(' ', '$')
+        return root, ig
+    # Case of just a word
+    return ret_val.replace('"', '').replace('<', '').replace('>', ''), None
+
+
+def _segment(my_ig):
+    """
+    Segment ig based on segmentation rules.
+    Every IG starts where a rule occurs, except for the rule the previous IG starts with,
+    which does not start a new IG anywhere in the rest of the string.
+    :param my_ig: str
+    :return: tuple of strings
+    """
+    ret_val = []
+    start = 0
+    while start < len(my_ig):
+        first = SEGMENTATION_PATTERN.match(my_ig, start)
+        first = first.group() if first else None
+        pos = len(my_ig)
+        for match in SEGMENTATION_PATTERN.finditer(my_ig, start + 1):
+            if match.group() != first:
+                pos = match.start()
+                break
+        ret_val.append(my_ig[start:pos].strip('$'))
+        start = pos
+    return tuple(ret_val)
+
+
+_segmentations = {}
+
+
+def segment_ig(my_ig):
+    """
+    Segment ig based on segmentation rules, e.g. 'v$tv$prc_perf$subst$nom' into
+    ('v$tv', 'prc_perf', 'subst$nom'). Segmentations are memoized, since few distinct IG
+    strings repeat throughout a corpus, and returned as tuples shared through IG_TABLE.
+    :param my_ig: str
+    :return: tuple of strings
+    """
+    try:
+        return _segmentations[my_ig]
+    except KeyError:
+        if metrics.enabled:
+            metrics.inc('segment_calls_total')
+        if len(_segmentations) >= SEGMENT_CACHE_SIZE:
+            _segmentations.clear()
+        group = _segmentations[my_ig] = IG_TABLE.intern(_segment(my_ig))[0]
+        return group
+
+
+def _iter_chunks(f, chunk_size=CHUNK_SIZE):
+    """
+    Read a file in large chunks and yield lists of cohort and reading lines (matches of LINE_PATTERN).
+    Chunks are cut at line boundaries, so memory use is bounded by the chunk size.
+    :param f: text file object
+    :param chunk_size: int, number of characters read at once
+    :return: generator of lists of strings
+    """
+    rest = ''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        end = chunk.rfind('\n') + 1
+        rest = chunk[end:]
+        lines = LINE_PATTERN.findall(chunk, 0, end)
+        if metrics.enabled:
+            metrics.inc('parse_lines_total', len(lines))
+        yield lines
+    if rest:
+        lines = LINE_PATTERN.findall(rest)
+        if metrics.enabled:
+            metrics.inc('parse_lines_total', len(lines))
+        yield lines
+
+
+def _iter_mapped_chunks(mm, start, end, chunk_size=CHUNK_SIZE):
+    """
+    Scan a byte range of a memory-mapped file and yield lists of cohort and reading lines
+    (matches of BYTES_LINE_PATTERN) as bytes. The range is scanned in place, in parts cut at
+    line boundaries, so the file is neither copied nor decoded as a whole.
+    :param mm: mmap object
+    :param start: int, offset of the first byte, at the start of a line
+    :param end: int, offset after the last byte
+    :param chunk_size: int, number of bytes scanned at once
+    :return: generator of lists of bytes
+    """
+    pos = start
+    while pos < end:
+        stop = min(pos + chunk_size, end)
+        if stop < end:
+            cut = mm.rfind(b'\n', pos, stop) + 1
+            stop = cut if cut > pos else (mm.find(b'\n', stop, end) + 1 or end)
+        lines = BYTES_LINE_PATTERN.findall(mm, pos, stop)
+        if metrics.enabled:
+            metrics.inc('parse_lines_total', len(lines))
+        yield lines
+        pos = stop
+
+
+def _compressed_opener(fpath):
+    """
+    Return function that opens a compressed corpus file, or None if the file is not compressed.
+    """
+    with open(fpath, 'rb') as f:
+        head = f.read(6)
+    for magic, opener in COMPRESSED_FORMATS:
+        if head.startswith(magic):
+            return opener
+    return None
+
+
+def _iter_file_lines(fpath, start=0, end=None):
+    """
+    Yield lists of cohort and reading lines of a corpus file, as strings if it is compressed
+    with gzip, bzip2 or xz, and as bytes of the memory-mapped file otherwise.
+    :param fpath: file path
+    :param start: int, byte offset to start at, 0 for compressed files
+    :param end: int, byte offset to stop at, None for the end of the file
+    :return: generator of lists of strings or bytes
+    """
+    opener = _compressed_opener(fpath)
+    if opener is not None:
+        if start or end is not None:
+            raise ValueError('Parts of compressed files cannot be read: %s' % fpath)
+        with opener(fpath, 'rt', encoding='utf-8') as f:
+            yield from _iter_chunks(f)
+        return
+    with open(fpath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from _iter_mapped_chunks(mm, start, end)
+
+
+def iter_sentences(fpath, ngram=2, start=0, end=None):
+    """
+    Process a file, and yield Sentence objects one at a time, so that
+    memory use does not depend on the file size.
+    Files compressed with gzip, bzip2 or xz are decompressed on the fly. Other files are
+    memory-mapped and scanned as bytes, and only distinct cohort and reading lines are decoded.
+    :param fpath: file path
+    :param ngram:
+    :param start: int, byte offset just after a sentence end to start at, see sentence_chunks
+    :param end: int, byte offset to stop at, None for the end of the file
+    :return: generator of Sentence objects
+    """
+    # Cohort and reading lines repeat a lot, so process each distinct one only once
+    extracted = {}
+    # A part of a file starts after a sentence end, i.e. after an IG
+    last = TokenType.ig if start else None
+    new_ig = InflectionalGroup.__new__
+    words, roots, igs = [], [], []
+    for key in chain.from_iterable(_iter_file_lines(fpath, start, end)):
+        try:
+            is_cohort, first, ig = extracted[key]
+        except KeyError:
+            if len(extracted) >= EXTRACT_CACHE_SIZE:
+                extracted.clear()
+            line = key.decode('utf-8') if isinstance(key, bytes) else key
+            is_cohort, first, ig = extracted[key] = (line[0] == '"',) + _extract(line)
+        if is_cohort:
+            # cohort line
+            if first:
+                words.append(first)
+                last = TokenType.word
+            continue
+        if first:
+            roots.append(first)
+            last = TokenType.root
+        if not ig:
+            continue
+        if last == TokenType.ig:
+            # the case of 'e cop ...' and the like, append to previous IG
+            igs[-1].add(ig)
+        else:
+            # segment_ig returns an interned tuple, so the constructor's checks are skipped
+            group = new_ig(InflectionalGroup)
+            group.group = segment_ig(ig)
+            igs.append(group)
+        last = TokenType.ig
+        if ig == 'sent':
+            sentence = Sentence()
+            sentence.words = words
+            sentence.roots = roots
+            sentence.igs = igs
+            if metrics.enabled:
+                metrics.inc('parse_sentences_total')
+            yield sentence
+            words, roots, igs = [], [], []
+
+
+def _sentence_ends(mm, pos, count):
+    """
+    Return offsets just after the lines of the first count sentence ends at or after a byte offset.
+    """
+    if pos and mm[pos - 1:pos] != b'\n':
+        pos = mm.find(b'\n', pos) + 1 or len(mm)
+    ends = []
+    for match in BYTES_LINE_PATTERN.finditer(mm, pos):
+        line = match.group().decode('utf-8')
+        if line[0] != '"' and _extract(line)[1] == 'sent':
+            ends.append(mm.find(b'\n', match.end()) + 1 or len(mm))
+            if len(ends) == count:
+                break
+    return ends
+
+
+def sentence_chunks(fpath, ngram=2, chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Cut an uncompressed corpus file into parts of about chunk_size bytes that end at sentence ends,
+    so that they can be parsed by several processes. Every part but the first comes with the
+    ngram - 1 sentences before it as context, from which the n-grams that cross into it are counted.
+    Compressed files are not cut.
+    :param fpath: file path
+    :param ngram: int
+    :param chunk_size: int
+    :return: list of (context start, start, end) byte offsets
+    """
+    size = os.path.getsize(fpath)
+    if size <= chunk_size or _compressed_opener(fpath) is not None:
+        return [(0, 0, size)]
+    chunks = []
+    context_start, start = 0, 0
+    with open(fpath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while start + chunk_size < size:
+            # A sentence end after the target, ngram - 1 sentences of context for the next part,
+            # and a sentence of the next part, as the last word of a file is not counted
+            ends = _sentence_ends(mm, start + chunk_size, ngram + 1)
+            if len(ends) <= ngram:
+                break
+            chunks.append((context_start, start, ends[ngram - 1]))
+            context_start, start = ends[0], ends[ngram - 1]
+    chunks.append((context_start, start, size))
+    return chunks
+
 
 def process_file(fpath, ngram=2):
     """
@@ -73,104 +378,9 @@ def process_file(fpath, ngram=2):
     :param ngram:
     :return: list of Sentence objects
     """
-
-    class TokenType:
-        word = 1
-        root = 2
-        ig = 3
-
-    def extract(category):
-        # Define regex patterns for word, root, and ig
-        """
-        Extract word, root, or IG from a line in tagged corpus file.
-        :param category: TokenType
-        :return: tuple (word, None) or (root, IG) or (None, copula IG).
-        """
-        pattern_word = r'"<(.*)>"'
-        pattern_root_ig = r'\t(.*?)(?=\s@)'
-        pattern = ''
-        if category == TokenType.word:
-            pattern = pattern_word
-        elif category == TokenType.root or category == TokenType.ig:
-            pattern = pattern_root_ig
-
-        match = re.match(pattern, line)
-        if match:
-            ret_val = match.group()
-            if ret_val.count('\t') >= 2:
-                # Case '\t\te cop aor p3 sg' or similar, i.e. part of IG
-                return None, ret_val.strip('\t').replace('"', '').replace(' ', '$')
-            elif ret_val.count('\t') == 1:
-                # Case '\tжегіз v tv prc_perf', i.e. root followed by IG
-                ret_val = ret_val.strip('\t')
-                index = ret_val.rindex('"')
-                ret_val = ret_val.replace('"', '')
-                root = ret_val[:index].strip().replace(' ', '$')
-                ig = ret_val[index:].strip().replace(' ', '$')
-                return root, ig
-            # Case of just a word
-            return ret_val.replace('"', '').replace('<', '').replace('>', ''), None
-        return None, None
-
-    def segment(my_ig):
-        """
-        Segment ig based on segmentation rules.
-        :param my_ig: str
-        :return: list of strings
-        """
-        segmentation_rules = ['subst', 'attr', 'advl', 'ger_', 'gpr_', 'gna_', 'prc_']
-        ret_val = []
-        while my_ig:
-            positions = sorted([my_ig.index(rule) for rule in segmentation_rules if rule in my_ig])
-            try:
-                pos = positions[0] if positions[0] > 0 else positions[1]
-            except IndexError:
-                # the last IG
-                pos = len(my_ig)
-            ret_val.append(my_ig[:pos].strip('$'))
-            my_ig = my_ig[pos:]
-        return ret_val
-
-    COPULA = 'COPULA'
-    sentences = []
-    last = None
-    with open(fpath, 'r', encoding='utf-8') as f:
-        words, roots, igs = [], [], []
-        for line in f:
-            # process line
-            word, _ = extract(TokenType.word)
-            root, ig = extract(TokenType.root)
-            if word:
-                words.append(word)
-                last = TokenType.word
-            if root:
-                roots.append(root)
-                last = TokenType.root
-            if ig:
-                if last == TokenType.ig:
-                    # the case of 'e cop ...' and the like
-                    igs.append('COPULA%s' % ig)
-                else:
-                    igs.append(ig)
-                last = TokenType.ig
-            if ig == 'sent':
-                # Create a sentence object and segment its IGs
-                sentence = Sentence()
-                for root in roots:
-                    sentence.add_root(root)
-                for the_ig in igs:
-                    assert isinstance(the_ig, str)
-                    if the_ig.startswith(COPULA):
-                        # Strip copula marker and append to previous IG
-                        the_ig = the_ig.replace(COPULA, '')
-                        sentence.add_copula_ig(the_ig)
-                    else:
-                        ig_group = segment(the_ig)
-                        inflectional_group = InflectionalGroup(ig_group)
-                        sentence.add_ig(inflectional_group)
-                sentences.append(sentence)
-                words, roots, igs = [], [], []
-    return sentences
+    metrics.inc('parse_files_total')
+    with metrics.timer('parse_file_seconds'):
+        return list(iter_sentences(fpath, ngram=ngram))
 
 
 def stats(sentences):
@@ -189,7 +399,7 @@ def stats(sentences):
     for sent in sentences:
         ig_count_sequences.append([ig.num for ig in sent.igs])
         for ig in sent.igs:
-            assert isinstance(ig.group, list)
+            assert isinstance(ig.group, tuple)
             num_ig = len(ig.group)
             if num_ig in ig_counts.keys():
                 ig_counts[num_ig] += 1
@@ -198,118 +408,270 @@ def stats(sentences):
     return Counter(ig_counts), ig_count_sequences
 
 
-def prepare_corpus(is_test=True, ngram=2):
+class FileCounts:
+    """Counts and corpus text extracted from one tagged corpus file."""
+
+    def __init__(self, ngram=2):
+        """
+        Constructor.
+        :param ngram: int
+        """
+        self.num_sent = 0
+        self.root_counter = NgramCounter(ngram)
+        self.ig_counter = NgramCounter(ngram)
+        self.ig_lengths = Counter()
+        # Lines of roots.txt, igs.txt and stats.txt contributed by the file
+        self.root_text = ''
+        self.ig_text = ''
+        self.stats_text = ''
+
+
+def count_file_sentences(file_path, ngram=2, chunk=None):
+    """
+    Extract root and IG corpus, n-gram counts and IG statistics from one tagged corpus file,
+    or from a part of it. The counts of the parts of a file add up to the counts of the file.
+    :param file_path: file path
+    :param ngram: int
+    :param chunk: tuple of (context start, start, end) byte offsets of a part, see sentence_chunks
+    :rtype : FileCounts
+    """
+    if chunk is None:
+        return count_sentences(process_file(file_path, ngram=ngram), ngram)
+    context_start, start, end = chunk
+    context = list(iter_sentences(file_path, ngram, context_start, start))
+    sentences = context + list(iter_sentences(file_path, ngram, start, end))
+    return count_sentences(sentences, ngram, context=len(context), last=end >= os.path.getsize(file_path))
+
+
+def count_sentences(sentences, ngram=2, context=0, last=True):
+    """
+    Extract root and IG corpus, n-gram counts and IG statistics from consecutive sentences,
+    counted as one sequence like the sentences of a file.
+    :param sentences: list of Sentence objects
+    :param ngram: int
+    :param context: int, number of leading sentences that only precede the n-grams counted
+    :param last: boolean, the sentences end their file, so the last word is not counted
+    :rtype : FileCounts
+    """
+    counts = FileCounts(ngram)
+    counts.num_sent = len(sentences) - context
+    all_igs = []
+    num_context_roots = sum(len(s.roots) for s in sentences[:context])
+    num_context_words = sum(len(s.igs) for s in sentences[:context])
+    counts.root_counter.add_sequence([root for s in sentences for root in s.roots], start=num_context_roots)
+    # roots.txt has one line per file, n-grams are not counted across files
+    counts.root_text = ''.join('%s ' % ' '.join(s.roots) for s in sentences[context:]) + ('\n' if last else '')
+    for s in sentences:
+        for ig in s.igs:
+            assert isinstance(ig, InflectionalGroup)
+            all_igs.append(ig)
+    ig_lines = []
+    for i in range(max(ngram - 1, num_context_words), len(all_igs) - 1 if last else len(all_igs)):
+        # Each IG of a word is conditioned on the last IGs of the ngram - 1 previous words, only
+        # the n-grams that end with the IG are counted, not those of the history alone
+        history = [previous.last for previous in all_igs[i - ngram + 1:i]]
+        for ig in all_igs[i].group:
+            ig_lines.append('%s\n' % ' '.join(history + [ig]))
+            counts.ig_counter.add_sequence(history + [ig], start=len(history))
+    counts.ig_text = ''.join(ig_lines)
+    counts.ig_lengths, count_sequences = stats(sentences[context:])
+    counts.stats_text = ''.join('%s\n' % ','.join([str(n) for n in seq]) for seq in count_sequences)
+    return counts
+
+
+def stream_counts(sentences, root_counter, ig_counter, ngram=2):
+    """
+    Add the root and IG n-grams count_sentences counts to counters, taking sentences one at a time,
+    e.g. from iter_sentences, so that memory use does not depend on the number of sentences.
+    :param sentences: iterable of Sentence objects of one file
+    :param root_counter: NgramCounter or another counter with add_sequence(tokens, start)
+    :param ig_counter: NgramCounter or another counter with add_sequence(tokens, start)
+    :param ngram: int
+    """
+    root_tail = []
+    # IGs of the last ngram words, a word is counted once the next one is seen, as count_sentences
+    # does not count the last word
+    window = deque(maxlen=ngram)
+    num_words = 0
+    for sentence in sentences:
+        tokens = root_tail + sentence.roots
+        root_counter.add_sequence(tokens, start=len(root_tail))
+        root_tail = tokens[-(ngram - 1):] if ngram > 1 else []
+        for ig in sentence.igs:
+            if num_words > ngram - 1:
+                history = [previous.last for previous in list(window)[:-1]]
+                for last_ig in window[-1].group:
+                    ig_counter.add_sequence(history + [last_ig], start=len(history))
+            window.append(ig)
+            num_words += 1
+
+
+def _count_file_sentences(args):
+    return count_file_sentences(*args)
+
+
+def _merge_file_counts(tagged_corpus_dir, ngram, processes, lm_corpus_dir):
+    """
+    Parse and count corpus files, write their roots.txt, igs.txt and stats.txt lines in file name order.
+    Large files are parsed in parts by several processes if processes > 1.
+    :return: tuple of root and IG NgramCounter objects, number of sentences and Counter of IG lengths
+    """
+    num_sent = 0
+    all_stats = Counter()
+    root_counter, ig_counter = NgramCounter(ngram), NgramCounter(ngram)
+    tasks = []
+    for file_name in sorted(os.listdir(tagged_corpus_dir)):
+        fpath = os.path.join(tagged_corpus_dir, file_name)
+        chunks = sentence_chunks(fpath, ngram) if processes > 1 else [None]
+        tasks.extend((fpath, ngram, chunk if len(chunks) > 1 else None) for chunk in chunks)
+    pool = Pool(processes) if processes > 1 else None
+    results = pool.imap(_count_file_sentences, tasks) if pool else map(_count_file_sentences, tasks)
+    with open(os.path.join(lm_corpus_dir, 'roots.txt'), 'w', encoding='utf-8') as fp_root, \
+            open(os.path.join(lm_corpus_dir, 'igs.txt'), 'w', encoding='utf-8') as fp_ig, \
+            open(os.path.join(lm_corpus_dir, 'stats.txt'), 'w', encoding='utf-8') as fp_stats:
+        # Merge per file results in file name order
+        for counts in results:
+            num_sent += counts.num_sent
+            fp_root.write(counts.root_text)
+            fp_ig.write(counts.ig_text)
+            fp_stats.write(counts.stats_text)
+            root_counter.update(counts.root_counter)
+            ig_counter.update(counts.ig_counter)
+            all_stats += counts.ig_lengths
+    if pool:
+        pool.close()
+        pool.join()
+    return root_counter, ig_counter, num_sent, all_stats
+
+
+def prepare_corpus(is_test=True, ngram=2, processes=1, corpus_dir=None, lm_corpus_dir=LM_CORPUS_DIR, store=None):
     """
     Go through all files in tagged corpus directory, and extract root and IG corpus, and
-    write them to files in LM_CORPUS_DIR. Set global variables root_corpus and ig_corpus.
+    write them to files in LM_CORPUS_DIR, together with the IG counts of every word in stats.txt.
     Uses small corpus directory if testing.
+    Files are parsed in a pool of processes if processes > 1, the output does not
+    depend on the number of processes.
     :param is_test: boolean
     :param ngram: int
+    :param processes: int, number of worker processes
+    :param corpus_dir: tagged corpus directory, overrides is_test
+    :param lm_corpus_dir: output directory for roots.txt, igs.txt and stats.txt
+    :param store: CorpusStore of the corpus, see main.corpusstore, used instead of parsing the corpus files
+    :return: tuple of root and IG NgramCounter objects
     """
-    global root_corpus, ig_corpus
-    tagged_corpus_dir = SMALL_CORPUS if is_test else BIG_CORPUS
-    num_sent = 0
-    all_stats = Counter()
-    count_sequences = []
-    # Clean the files first
-    open(os.path.join(LM_CORPUS_DIR, 'roots.txt'), 'w').close()
-    open(os.path.join(LM_CORPUS_DIR, 'igs.txt'), 'w').close()
-    fp_root = open(os.path.join(LM_CORPUS_DIR, 'roots.txt'), 'a')
-    fp_ig = open(os.path.join(LM_CORPUS_DIR, 'igs.txt'), 'a')
-    for file_name in os.listdir(tagged_corpus_dir):
-        # For each file do ...
-        file_path = os.path.join(tagged_corpus_dir, file_name)
-        sentences = process_file(file_path, ngram=ngram)
-        num_sent += len(sentences)
-        all_igs = []
-        for s in sentences:
-            root_corpus += '%s ' % ' '.join(s.roots)
-            fp_root.write('%s ' % (' '.join(s.roots)))
-            for ig in s.igs:
-                assert isinstance(ig, InflectionalGroup)
-                all_igs.append(ig)
-        for i in range(1, len(all_igs) - 1):
-            first = all_igs[i - 1]
-            second = all_igs[i]
-            for ig in second.group:
-                fp_ig.write('%s %s\n' % (first.last, ig))
-        ig_corpus += '%s ' % ' '.join([str(ig) for ig in all_igs])
-        cur_stats, cur_count_sequences = stats(sentences)
-        all_stats += cur_stats
-        count_sequences += cur_count_sequences
-    fp_root.close()
-    fp_ig.close()
+    tagged_corpus_dir = corpus_dir or (SMALL_CORPUS if is_test else BIG_CORPUS)
+    with metrics.timer('prepare_corpus_seconds'):
+        if store is not None:
+            store.write_lm_corpus(lm_corpus_dir, ngram)
+            root_counter, ig_counter = store.ngram_counters(ngram)
+            num_sent, all_stats = store.num_sentences, store.ig_length_counts()
+        else:
+            root_counter, ig_counter, num_sent, all_stats = _merge_file_counts(
+                tagged_corpus_dir, ngram, processes, lm_corpus_dir)
     print('Total # of sentences: ', num_sent)
     for key, val in all_stats.items():
         print('Words with %d IG(s): %d' % (key, val))
-    with open('stats.txt', 'w') as f:
-        for counts in count_sequences:
-            f.write('%s\n' % ','.join([str(n) for n in counts]))
     print('Created root and IG bigram corpus. Done.')
+    return root_counter, ig_counter
 
 
-def language_model(ngram=2):
+def build_language_models(ngram=2, counters=None, smoothing='kn', arpa=False):
+    """
+    Estimate root and IG language models in-process from n-gram counts.
+    :param ngram: int
+    :param counters: tuple of root and IG NgramCounter objects as returned by prepare_corpus.
+    If not given, roots.txt and igs.txt in LM_CORPUS_DIR are counted, which gives the same counts:
+    roots.txt has one line with the roots of each file and igs.txt one line with every IG after its
+    history, of which only the n-grams ending with the IG are counted.
+    :param smoothing: 'kn' for modified Kneser-Ney or 'wb' for Witten-Bell
+    :param arpa: boolean, write roots.arpa and igs.arpa to LM_CORPUS_DIR
+    :return: tuple of root and IG BackoffModel objects
+    """
+    file_paths = [os.path.join(LM_CORPUS_DIR, 'roots.txt'), os.path.join(LM_CORPUS_DIR, 'igs.txt')]
+    with metrics.timer('lm_build_seconds'):
+        if counters is None:
+            counters = [count_file(fp, order=ngram, last_only=fp.endswith('igs.txt')) for fp in file_paths]
+        models = []
+        for fp, counter in zip(file_paths, counters):
+            model = estimate(counter, smoothing=smoothing)
+            if arpa:
+                model.write_arpa(fp.replace('.txt', '.arpa'))
+            models.append(model)
+    return tuple(models)
+
+
+def language_model(ngram=2, counters=None, smoothing='kn', arpa=False, use_srilm=False):
     """
     Return dictionary with root and IG probabilities.
-    Uses SRILM ngram-count to build LM and calculate probabilities.
-    :param ngram:
-    :return: dict
+    Estimates the LM in-process from n-gram counts, or uses SRILM ngram-count if use_srilm is set.
+    :param ngram: int
+    :param counters: tuple of root and IG NgramCounter objects as returned by prepare_corpus.
+    If not given, roots.txt and igs.txt in LM_CORPUS_DIR are counted, see build_language_models.
+    :param smoothing: 'kn' for modified Kneser-Ney or 'wb' for Witten-Bell
+    :param arpa: boolean, write roots.arpa and igs.arpa to LM_CORPUS_DIR
+    :param use_srilm: boolean
+    :return: tuple of dicts
     """
+    if use_srilm:
+        file_paths = [os.path.join(LM_CORPUS_DIR, 'roots.txt'), os.path.join(LM_CORPUS_DIR, 'igs.txt')]
+        return _srilm_language_model(file_paths, ngram)
+    root_model, ig_model = build_language_models(ngram, counters=counters, smoothing=smoothing, arpa=arpa)
+    return root_model.probs(ngram), ig_model.probs(ngram)
 
-    def get_ngram_probs():
-        """
-        Process .arpa file created by SRILM ngram-count and extract bigrams.
-        :return:
-        """
-        # TODO make it work for general case of ngrams. Now works only for bigrams.
-        probs = {}
-        to_process = False
-        with open(fp_arpa) as f:
-            for line in f:
-                line = line.strip('\n')
-                if ('\%d-grams:' % ngram) in line:
-                    # The start of ngrams of interest
-                    to_process = True
-                    continue
-                elif to_process and not line:
-                    # finish
-                    return probs
-                elif to_process and line:
-                    line = line.strip('\n').split()
-                    # TODO this works only for bigrams now.
-                    prob, first_word, second_word = float(line[0]), line[1], line[2]
-                    if first_word not in probs.keys():
-                        probs[first_word] = {second_word: prob}
-                    else:
-                        probs[first_word][second_word] = prob
-        return probs
+
+def _srilm_language_models(file_paths, ngram=2):
+    """
+    Return root and IG language models estimated by SRILM ngram-count.
+    :param file_paths: paths to roots.txt and igs.txt
+    :param ngram:
+    :return: tuple of root and IG lmstore.PackedLM objects read from the .arpa files
+    """
 
     # Run SRILM ngram-count on roots.txt and igs.txt files.
-    import subprocess, signal
-    file_paths = [os.path.join(LM_CORPUS_DIR, 'roots.txt'), os.path.join(LM_CORPUS_DIR, 'igs.txt')]
-    root_probs, ig_probs = {}, {}
-    for i, fp in enumerate(file_paths):
+    import subprocess
+    models = []
+    for fp in file_paths:
         fp_arpa = fp.replace('.txt', '.arpa')
         open(fp_arpa, 'w').close()
-        base_cmd = '%s -order %d -no-sos -no-eos -text %s -lm %s 2>/dev/null' % (LM_CMD, ngram, fp, fp_arpa)
+        source = '-text %s' % fp
+        if fp.endswith('igs.txt'):
+            # Only the n-grams ending with the IG of a line are counted, so SRILM reads the counts
+            fp_counts = fp.replace('.txt', '.counts')
+            counter = count_file(fp, order=ngram, last_only=True)
+            with open(fp_counts, 'w', encoding='utf-8') as f:
+                for k in range(1, ngram + 1):
+                    f.writelines('%s\t%d\n' % (' '.join(gram), c) for gram, c in counter.counts[k].items())
+            source = '-read %s' % fp_counts
+        base_cmd = '%s -order %d -no-sos -no-eos %s -lm %s 2>/dev/null' % (LM_CMD, ngram, source, fp_arpa)
         subprocess.check_call([base_cmd], shell=True)
-        if i == 0:
-            root_probs = get_ngram_probs()
-        else:
-            ig_probs = get_ngram_probs()
-    return root_probs, ig_probs
+        models.append(read_arpa(fp_arpa))
+    return tuple(models)
+
+
+def _srilm_language_model(file_paths, ngram=2):
+    """
+    Return dictionary with root and IG probabilities.
+    Uses SRILM ngram-count to build LM and calculate probabilities, and reads the n-grams
+    of the given order back from the .arpa files.
+    :param file_paths: paths to roots.txt and igs.txt
+    :param ngram:
+    :return: tuple of dicts
+    """
+    return tuple(model.probs(ngram) for model in _srilm_language_models(file_paths, ngram))
 
 
 if __name__ == '__main__':
-    from main.viterbi_bigram import BaselineModel, Viterbi
+    from main.buildcache import CachedBuild
+    from main.viterbi_bigram import Viterbi
     from main.sentences import ambiguous_sentences
-    prepare_corpus(is_test=True, ngram=2)
-    root_probs, ig_probs = language_model(ngram=2)
-    print(root_probs)
-    print(ig_probs)
+    # Stages whose inputs did not change since the last run are loaded from the build cache
+    build = CachedBuild(SMALL_CORPUS, ngram=2)
+    root_lm, ig_lm = build.language_model()
+    print(root_lm.probs(2))
+    print(ig_lm.probs(2))
     print('\nBaseline model ... \n')
     # Build baseline model
-    bigram_model = BaselineModel(root_corpus.split(), root_probs, ig_corpus.split(), ig_probs, is_prob_calculated=True)
+    bigram_model = build.model()
 
     for amb_seq, word_seq in ambiguous_sentences:
         # Build Viterbi tagger
@@ -318,4 +680,4 @@ if __name__ == '__main__':
         print('Sentence: %s' % word_seq)
         print('Viterbi probability: %f' % viterbi.probability)
         print('Viterbi path: %s' % viterbi.path)
-        print('-' * 20)
\ No newline at end of file
+        print('-' * 20)
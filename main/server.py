@@ -0,0 +1,312 @@
+# coding=utf-8
+"""
+Tagging server that keeps a baseline model in memory.
+
+Listens on localhost over HTTP (TCP or a Unix socket) and decodes ambiguous lattices.
+Requests that arrive together are collected into micro-batches and decoded at once
+with viterbi_batch.
+
+    POST /tag      {"lattice": [[[root, [ig, ...]], ...], ...]}  or  {"lattices": [lattice, ...]}
+                   Every column holds the readings of one word. The sentence tags that frame
+                   a lattice are added by the server.
+                   Response: {"path": [[root, [ig, ...]], ...], "probability": p} for each lattice
+    GET /stats     queue depth, batch sizes and request latency percentiles as JSON
+    GET /metrics   main.metrics in the Prometheus text format
+
+Usage: python -m main.server [--root-lm roots.bin --ig-lm igs.bin] [--port 8642 | --unix path]
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from main import metrics
+from main.tagger import load_model
+from main.viterbi_batch import viterbi_batch
+from main.viterbi_bigram import Tag, make_tag
+
+DEFAULT_PORT = 8642
+# Maximum number of lattices decoded in one batch
+MAX_BATCH = 64
+# Seconds the batcher waits for more requests after the first one of a batch
+MAX_WAIT = 0.002
+# Number of most recent request latencies percentiles are computed from
+LATENCY_WINDOW = 10000
+# Maximum size of a request body in bytes
+MAX_BODY = 16 << 20
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+            500: 'Internal Server Error'}
+
+
+def lattice_from_json(columns):
+    """
+    Return lattice framed by sentence tags from a list of columns of [root, [ig, ...]] readings.
+    :rtype : list of lists of Tag objects
+    """
+    if not isinstance(columns, list) or not all(isinstance(column, list) and column for column in columns):
+        raise ValueError('Lattice must be a list of non-empty lists of readings')
+    lattice = [[Tag('.', ['sent'])]]
+    for column in columns:
+        lattice.append([reading_from_json(reading) for reading in column])
+    lattice.append([Tag('.', ['sent'])])
+    return lattice
+
+
+def reading_from_json(reading):
+    """
+    Return Tag of a [root, [ig, ...]] reading with a string root and a non-empty list of string IGs.
+    :rtype : Tag
+    """
+    if not (isinstance(reading, list) and len(reading) == 2 and isinstance(reading[0], str)
+            and isinstance(reading[1], list) and reading[1] and all(isinstance(ig, str) for ig in reading[1])):
+        raise ValueError('Reading must be [root, [ig, ...]] with a string root and a non-empty list of string IGs,'
+                         ' got %s' % json.dumps(reading, ensure_ascii=False))
+    return make_tag(reading[0], reading[1])
+
+
+def path_to_json(path):
+    """
+    Return best path without the framing sentence tags as a list of [root, [ig, ...]] readings.
+    """
+    return [[tag.root, list(tag.igs)] for tag in path[1:-1]]
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+
+
+class TaggingServer:
+    """Micro-batching decoder behind an asyncio HTTP server."""
+
+    def __init__(self, model, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        """
+        Constructor.
+        :type model: BaselineModel
+        :param max_batch: int, maximum number of lattices decoded at once
+        :param max_wait: float, seconds to wait for more requests before decoding a batch that is not full
+        """
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = None
+        # Batches are decoded one at a time in a worker thread, so that the event loop keeps accepting requests
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_batches = 0
+        self.num_batched = 0
+        self.max_queue_depth = 0
+
+    def _decode(self, lattices):
+        """
+        Return list of (path, probability) tuples, one per lattice. If the batch fails, its lattices
+        are decoded one at a time, and the exception of a lattice that fails takes its place, so
+        that one bad lattice does not fail the other requests of its batch.
+        """
+        try:
+            return viterbi_batch(lattices, self.model)
+        except Exception:
+            if len(lattices) == 1:
+                raise
+        results = []
+        for lattice in lattices:
+            try:
+                results.append(viterbi_batch([lattice], self.model)[0])
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.max_wait and self.queue.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.max_wait)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            metrics.set_gauge('server_queue_depth', self.queue.qsize())
+            self.num_batches += 1
+            self.num_batched += len(batch)
+            metrics.inc('server_batches_total')
+            metrics.observe('server_batch_size', len(batch), metrics.SIZE_BUCKETS)
+            try:
+                results = await loop.run_in_executor(self._executor, self._decode, [item[0] for item in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def tag(self, lattice):
+        """
+        Queue a lattice for decoding and return its (path, probability) tuple.
+        :param lattice: list of lists of Tag objects framed by the sentence tag
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((lattice, future))
+        depth = self.queue.qsize()
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        metrics.set_gauge('server_queue_depth', depth)
+        return await future
+
+    async def _tag_request(self, body):
+        request = json.loads(body.decode('utf-8'))
+        single = 'lattice' in request
+        lattices = [lattice_from_json(columns) for columns in ([request['lattice']] if single
+                                                                else request['lattices'])]
+        outcomes = await asyncio.gather(*[self.tag(lattice) for lattice in lattices], return_exceptions=True)
+        results = []
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                self.num_errors += 1
+                metrics.inc('server_errors_total')
+                results.append({'error': '%s: %s' % (type(outcome).__name__, outcome)})
+            else:
+                path, probability = outcome
+                results.append({'path': path_to_json(path), 'probability': probability})
+        return results[0] if single else {'results': results}
+
+    def stats(self):
+        """
+        Return request, batch, queue depth and latency statistics.
+        :rtype : dict
+        """
+        ordered = sorted(self.latencies)
+        return {
+            'requests': self.num_requests,
+            'errors': self.num_errors,
+            'batches': self.num_batches,
+            'mean_batch_size': self.num_batched / self.num_batches if self.num_batches else None,
+            'queue_depth': self.queue.qsize() if self.queue else 0,
+            'max_queue_depth': self.max_queue_depth,
+            'latency_seconds': {'p50': _percentile(ordered, 0.5), 'p90': _percentile(ordered, 0.9),
+                                'p99': _percentile(ordered, 0.99), 'max': ordered[-1] if ordered else None},
+        }
+
+    async def _route(self, method, path, body):
+        """
+        Return (status, content type, payload bytes) of a request.
+        """
+        if method == 'POST' and path == '/tag':
+            start = time.perf_counter()
+            self.num_requests += 1
+            metrics.inc('server_requests_total')
+            try:
+                result = await self._tag_request(body)
+            except (ValueError, KeyError, TypeError) as e:
+                self.num_errors += 1
+                metrics.inc('server_errors_total')
+                return 400, 'application/json', json.dumps({'error': str(e)}).encode('utf-8')
+            latency = time.perf_counter() - start
+            self.latencies.append(latency)
+            metrics.observe('server_request_seconds', latency)
+            return 200, 'application/json', json.dumps(result, ensure_ascii=False).encode('utf-8')
+        if method == 'GET' and path == '/stats':
+            return 200, 'application/json', json.dumps(self.stats()).encode('utf-8')
+        if method == 'GET' and path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', metrics.REGISTRY.to_prometheus().encode('utf-8')
+        return 404, 'application/json', b'{"error": "not found"}'
+
+    async def _handle(self, reader, writer):
+        """
+        Serve HTTP/1.1 requests of one connection, keeping it alive unless the client closes it.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path = request_line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, content_type, payload = 413, 'application/json', b'{"error": "request too large"}'
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    try:
+                        status, content_type, payload = await self._route(method, path, body)
+                    except Exception as e:
+                        status, content_type, payload = 500, 'application/json', json.dumps(
+                            {'error': str(e)}).encode('utf-8')
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s\r\n' % (
+                    status, _REASONS[status], content_type, len(payload),
+                    '' if keep_alive else 'Connection: close\r\n')).encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            print(json.dumps(self.stats()), file=sys.stderr, flush=True)
+
+    async def serve(self, host='127.0.0.1', port=DEFAULT_PORT, unix_path=None, report_interval=None):
+        """
+        Serve until cancelled.
+        :param host: str, address to listen on, localhost by default
+        :param port: int
+        :param unix_path: path of a Unix socket to listen on instead of TCP
+        :param report_interval: float, seconds between statistics printed to stderr, None disables them
+        """
+        self.queue = asyncio.Queue()
+        tasks = [asyncio.ensure_future(self._batcher())]
+        if report_interval:
+            tasks.append(asyncio.ensure_future(self._report(report_interval)))
+        if unix_path:
+            server = await asyncio.start_unix_server(self._handle, unix_path)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._executor.shutdown(wait=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the baseline tagger over HTTP on localhost.')
+    parser.add_argument('--root-lm', help='binary root language model, see main.lmstore')
+    parser.add_argument('--ig-lm', help='binary IG language model, see main.lmstore')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--max-wait', type=float, default=MAX_WAIT, help='seconds to wait to fill a batch')
+    parser.add_argument('--report-interval', type=float, default=60.0,
+                        help='seconds between statistics printed to stderr, 0 disables them')
+    args = parser.parse_args(argv)
+
+    metrics.enable()
+    server = TaggingServer(load_model(args.root_lm, args.ig_lm), args.max_batch, args.max_wait)
+    print('Serving on %s' % (args.unix or 'http://%s:%d' % (args.host, args.port)), file=sys.stderr)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix, args.report_interval or None))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
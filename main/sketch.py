@@ -0,0 +1,312 @@
+# coding=utf-8
+"""
+Bounded-memory n-gram counting for corpora whose n-gram counts do not fit in memory.
+
+SketchCounter counts n-grams of order 2 and higher in a fixed amount of memory, and can be used
+wherever an NgramCounter is, e.g. by lm.estimate and segment.build_language_models:
+    - frequent n-grams are kept in a table with their counts, n-grams that fall out of it are
+      added to a count-min sketch of the order, i.e. depth rows of width counters indexed by
+      hashes of the n-gram, updated conservatively
+    - an n-gram that is not in the table is admitted to it when its sketch estimate plus one
+      exceeds the smallest count kept by the last pruning of the table; its count is exact if the
+      sketch estimate was zero, otherwise it overestimates by at most that estimate
+    - the table grows to twice its capacity and is then pruned to its capacity most frequent n-grams
+Unigrams are always counted exactly, they are the vocabulary. N-grams not kept in the tables are
+unseen for the language model, like n-grams below a count cutoff.
+
+The count-min estimate of an n-gram exceeds its count by at most e / width * N, with probability
+1 - exp(-depth), where N is the number of n-grams added to the sketch.
+
+Usage: python -m main.sketch [--corpus-dir dir] [--max-mb 64] [--ngram 2] [--compare]
+"""
+import argparse
+import math
+import os
+import sys
+import time
+from array import array
+from collections import Counter
+
+from main.lm import NgramCounter
+from main.segment import BIG_CORPUS, build_language_models, iter_sentences, stream_counts
+
+DEFAULT_MAX_BYTES = 64 << 20
+DEFAULT_DEPTH = 4
+# Share of the memory of an order given to its count-min sketch, the rest holds the table
+SKETCH_SHARE = 0.5
+# Approximate size in bytes of a table entry: dict slot, key tuple and count
+ENTRY_BYTES = 160
+
+
+class CountMinSketch:
+    """Count-min sketch with conservative update."""
+
+    def __init__(self, width, depth=DEFAULT_DEPTH):
+        """
+        Constructor.
+        :param width: int, number of counters of a row
+        :param depth: int, number of rows
+        """
+        self.width = width
+        self.depth = depth
+        self.table = array('Q', bytes(8 * width * depth))
+        # Sum of all counts added
+        self.total = 0
+
+    def _cells(self, key):
+        # Double hashing: row i uses h1 + i * h2, h2 is odd
+        h = hash(key)
+        h1, h2 = h & 0xffffffff, ((h >> 32) & 0xffffffff) | 1
+        width = self.width
+        return [(h1 + i * h2) % width + i * width for i in range(self.depth)]
+
+    def estimate(self, key):
+        """
+        Return estimate of the count of a key, never less than its count.
+        :rtype : int
+        """
+        table = self.table
+        return min(table[cell] for cell in self._cells(key))
+
+    def add(self, key, count=1):
+        """
+        Add count to a key. Only counters below the new estimate are raised.
+        """
+        table = self.table
+        cells = self._cells(key)
+        value = min(table[cell] for cell in cells) + count
+        for cell in cells:
+            if table[cell] < value:
+                table[cell] = value
+        self.total += count
+
+    def error_bound(self):
+        """
+        Return maximum overestimate of a count with probability 1 - exp(-depth).
+        :rtype : float
+        """
+        return math.e / self.width * self.total
+
+    @property
+    def nbytes(self):
+        return self.table.itemsize * len(self.table)
+
+
+class SketchCounter:
+    """Counts of n-grams up to a given order in bounded memory, see the module docstring."""
+
+    def __init__(self, order=2, max_bytes=DEFAULT_MAX_BYTES, depth=DEFAULT_DEPTH):
+        """
+        Constructor.
+        :param order: int, highest n-gram order to count
+        :param max_bytes: int, memory for n-grams of order 2 and higher, shared equally by the orders
+        :param depth: int, number of rows of the count-min sketches
+        """
+        assert order >= 1
+        self.order = order
+        self.max_bytes = max_bytes
+        order_bytes = max_bytes / max(order - 1, 1)
+        width = max(1, int(order_bytes * SKETCH_SHARE / (8 * depth)))
+        # Number of n-grams of an order kept after pruning, the table holds up to twice as many
+        self.capacity = max(1, int(order_bytes * (1 - SKETCH_SHARE) / (2 * ENTRY_BYTES)))
+        self.unigrams = Counter()
+        # tables[k] maps kept k-grams to counts, errors[k] the kept k-grams whose count may be too
+        # high to the count of the sketch they were admitted with, items 0 and 1 are unused
+        self.tables = [None, None] + [Counter() for _ in range(2, order + 1)]
+        self.errors = [None, None] + [{} for _ in range(2, order + 1)]
+        self.sketches = [None, None] + [CountMinSketch(width, depth) for _ in range(2, order + 1)]
+        # Smallest count kept by the last pruning of an order, 0 before the first one
+        self.thresholds = [0] * (order + 1)
+        # Number of n-grams of every order added
+        self.totals = [0] * (order + 1)
+        self._counts = None
+
+    def add_sequence(self, tokens, start=0):
+        """
+        Count all n-grams of a token sequence, see NgramCounter.add_sequence.
+        :param tokens: list of strings
+        :param start: int, only n-grams ending at this position or later are counted
+        """
+        tokens = tuple(tokens)
+        self._counts = None
+        for i in range(start, len(tokens)):
+            self.unigrams[tokens[i:i + 1]] += 1
+            self.totals[1] += 1
+            for k in range(2, min(self.order, i + 1) + 1):
+                self._add(k, tokens[i - k + 1:i + 1])
+
+    def _add(self, k, gram):
+        self.totals[k] += 1
+        table = self.tables[k]
+        if gram in table:
+            table[gram] += 1
+            return
+        sketch = self.sketches[k]
+        seen = sketch.estimate(gram) if sketch.total else 0
+        if seen + 1 <= self.thresholds[k]:
+            sketch.add(gram)
+            return
+        table[gram] = seen + 1
+        if seen:
+            self.errors[k][gram] = seen
+        if len(table) >= 2 * self.capacity:
+            self._prune(k)
+
+    def _prune(self, k):
+        """
+        Keep the capacity most frequent k-grams in the table and add the counts of the others
+        to the sketch, except for the part that came from the sketch when they were admitted.
+        """
+        table, errors, sketch = self.tables[k], self.errors[k], self.sketches[k]
+        ranked = sorted(table.items(), key=lambda item: item[1], reverse=True)
+        for gram, c in ranked[self.capacity:]:
+            sketch.add(gram, c - errors.pop(gram, 0))
+            del table[gram]
+        self.thresholds[k] = ranked[self.capacity - 1][1]
+
+    def count(self, gram):
+        """
+        Return count of an n-gram, the sketch estimate if it is not kept.
+        :param gram: tuple of strings
+        :rtype : int
+        """
+        k = len(gram)
+        if k == 1:
+            return self.unigrams[gram]
+        return self.tables[k][gram] if gram in self.tables[k] else self.sketches[k].estimate(gram)
+
+    @property
+    def counts(self):
+        """
+        Return list where item k maps the kept k-grams to their counts, like NgramCounter.counts.
+        A k-gram is only kept if its last k - 1 tokens are, as interpolation with the lower order
+        needs them; contexts that are not kept are added by lm.estimate.
+        """
+        if self._counts is None:
+            self._counts = [None, self.unigrams]
+            for k in range(2, self.order + 1):
+                lower = self._counts[k - 1]
+                self._counts.append(self.tables[k] if k == 2 else
+                                    {gram: c for gram, c in self.tables[k].items() if gram[1:] in lower})
+        return self._counts
+
+    def __len__(self):
+        return sum(len(counts) for counts in self.counts[1:])
+
+    @property
+    def vocab(self):
+        """
+        Return sorted list of unigrams.
+        :rtype : list
+        """
+        return sorted(ngram[0] for ngram in self.unigrams)
+
+    def memory_bytes(self):
+        """
+        Return approximate memory used by the n-grams of order 2 and higher, and by the unigrams.
+        :return: tuple of ints
+        """
+        ngram_bytes = 0
+        for k in range(2, self.order + 1):
+            ngram_bytes += (self.sketches[k].nbytes + sys.getsizeof(self.tables[k]) +
+                            sys.getsizeof(self.errors[k]) + sum(map(sys.getsizeof, self.tables[k])))
+        unigram_bytes = sys.getsizeof(self.unigrams) + sum(map(sys.getsizeof, self.unigrams))
+        return ngram_bytes, unigram_bytes
+
+    def report(self):
+        """
+        Return memory use and error bounds of the counts.
+        :return: dict with memory in bytes, and for every order the number of n-grams added, kept and
+        kept exactly, the largest possible overestimate of a kept count, and the error bound of the
+        sketch estimate with its probability
+        """
+        ngram_bytes, unigram_bytes = self.memory_bytes()
+        orders = {1: {'added': self.totals[1], 'kept': len(self.unigrams), 'exact': len(self.unigrams),
+                      'max_error': 0}}
+        counts = self.counts
+        for k in range(2, self.order + 1):
+            errors, sketch = self.errors[k], self.sketches[k]
+            kept = counts[k]
+            kept_errors = [errors[gram] for gram in errors if gram in kept]
+            orders[k] = {'added': self.totals[k], 'kept': len(kept), 'exact': len(kept) - len(kept_errors),
+                         'max_error': max(kept_errors, default=0),
+                         'sketch_error': sketch.error_bound(), 'confidence': 1 - math.exp(-sketch.depth)}
+        return {'max_bytes': self.max_bytes, 'ngram_bytes': ngram_bytes, 'unigram_bytes': unigram_bytes,
+                'orders': orders}
+
+
+def count_corpus(corpus_dir=BIG_CORPUS, ngram=2, max_bytes=DEFAULT_MAX_BYTES, depth=DEFAULT_DEPTH):
+    """
+    Count root and IG n-grams of a tagged corpus directory, streaming its sentences file by file.
+    The counts are those of segment.prepare_corpus when nothing is pruned.
+    :param corpus_dir: tagged corpus directory
+    :param ngram: int
+    :param max_bytes: int, memory for n-grams of order 2 and higher, shared equally by roots and IGs
+    :param depth: int, number of rows of the count-min sketches
+    :return: tuple of root and IG SketchCounter objects, to be passed as counters to build_language_models
+    """
+    root_counter = SketchCounter(ngram, max_bytes // 2, depth)
+    ig_counter = SketchCounter(ngram, max_bytes // 2, depth)
+    for file_name in sorted(os.listdir(corpus_dir)):
+        stream_counts(iter_sentences(os.path.join(corpus_dir, file_name), ngram), root_counter, ig_counter, ngram)
+    return root_counter, ig_counter
+
+
+def _compare(counter, exact):
+    """
+    Return number of n-grams of order 2 and higher that are missing or whose count differs from the exact one,
+    and the largest difference.
+    """
+    missing, wrong, max_diff = 0, 0, 0
+    for k in range(2, exact.order + 1):
+        kept = counter.counts[k]
+        for gram, c in exact.counts[k].items():
+            if gram not in kept:
+                missing += 1
+            elif kept[gram] != c:
+                wrong += 1
+                max_diff = max(max_diff, kept[gram] - c)
+    return missing, wrong, max_diff
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Count n-grams of a tagged corpus in bounded memory.')
+    parser.add_argument('--corpus-dir', default=BIG_CORPUS)
+    parser.add_argument('--ngram', type=int, default=2)
+    parser.add_argument('--max-mb', type=float, default=DEFAULT_MAX_BYTES / (1 << 20),
+                        help='memory for n-grams of order 2 and higher in MB')
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH)
+    parser.add_argument('--smoothing', default='kn', choices=['kn', 'wb'])
+    parser.add_argument('--compare', action='store_true', help='compare with exact counts')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    counters = count_corpus(args.corpus_dir, args.ngram, int(args.max_mb * (1 << 20)), args.depth)
+    count_seconds = time.perf_counter() - start
+    build_language_models(args.ngram, counters=counters, smoothing=args.smoothing)
+    print('Counted in %.3f s, estimated language models in %.3f s' % (
+        count_seconds, time.perf_counter() - start - count_seconds))
+    exact = None
+    if args.compare:
+        exact = NgramCounter(args.ngram), NgramCounter(args.ngram)
+        for file_name in sorted(os.listdir(args.corpus_dir)):
+            stream_counts(iter_sentences(os.path.join(args.corpus_dir, file_name), args.ngram), exact[0], exact[1],
+                          args.ngram)
+    for i, (name, counter) in enumerate(zip(('roots', 'IGs'), counters)):
+        report = counter.report()
+        print('%s: %.1f MB of n-grams, %.1f MB of unigrams' % (
+            name, report['ngram_bytes'] / (1 << 20), report['unigram_bytes'] / (1 << 20)))
+        for k, order in sorted(report['orders'].items()):
+            line = '  %d-grams %10d added %9d kept %9d exact, max error %d' % (
+                k, order['added'], order['kept'], order['exact'], order['max_error'])
+            if k > 1:
+                line += ', sketch error <= %.1f with probability %.3f' % (order['sketch_error'], order['confidence'])
+            print(line)
+        if exact:
+            print('  compared with exact counts: %d n-grams missing, %d wrong by at most %d' %
+                  _compare(counter, exact[i]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
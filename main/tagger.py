@@ -0,0 +1,423 @@
+# coding=utf-8
+"""
+Streaming tagger for morphological analyzer output in the CG cohort format.
+
+Every cohort ("<word>" line) may carry several readings (\t"root" tags lines, optionally
+followed by \t\t sub-readings such as copulas). Sentences are read one at a time, the
+lattice of their readings is decoded with Viterbi, and every cohort is written back
+with its best reading only (see viterbi_bigram.best_path), so memory use does not depend on the input size.
+With --online or --lag cohorts are decoded one at a time instead (see main.online) and written as
+soon as their reading is decided, e.g. to tag a live stream.
+
+Usage: python -m main.tagger [input] [-o output] [--root-lm roots.bin --ig-lm igs.bin] [--processes 4 | --lag 8]
+"""
+import argparse
+import io
+import sys
+import time
+from collections import deque
+from contextlib import redirect_stdout
+from functools import partial
+
+from main import parallel
+from main.online import OnlineViterbi
+from main.segment import segment_ig
+from main.viterbi_bigram import Tag, best_path, make_tag
+
+# Sentences without a sentence end reading are cut after this many cohorts
+MAX_SENTENCE_LENGTH = 500
+SENTENCE_IG = 'sent'
+
+
+def _tags(text):
+    # Drop dependency labels and relations, e.g. '@nmod #4->7'
+    return [tag for tag in text.split() if tag[0] not in '@#']
+
+
+def parse_reading(line):
+    """
+    Return root and IG string of a reading line, as the corpus parser extracts them.
+    :param line: str, e.g. '\t"жақсы көр" v tv aor p3 pl @root #5->0'
+    :return: tuple (root, IG), e.g. ('жақсы$көр', 'v$tv$aor$p3$pl')
+    """
+    line = line.strip('\t\r\n')
+    index = line.rindex('"')
+    root = line[:index].replace('"', '').strip().replace(' ', '$')
+    return root, '$'.join(_tags(line[index + 1:]))
+
+
+def parse_subreading(line):
+    """
+    Return IG of a sub-reading line, e.g. 'е$cop$aor$p3$sg' for '\t\t"е" cop aor p3 sg @cop'.
+    :rtype : str
+    """
+    return '$'.join(_tags(line.strip('\t\r\n').replace('"', '')))
+
+
+class Cohort:
+    """A word with its readings, kept with their input lines so they can be written back unchanged."""
+
+    def __init__(self, line, before=()):
+        """
+        Constructor.
+        :param line: str, cohort line, e.g. '"<сот>"', or None for an input without cohorts
+        :param before: list of other lines, e.g. blank ones, that precede the cohort line in the input
+        """
+        self.line = line
+        # Lists of (root, list of IGs, list of input lines) of every reading
+        self.readings = []
+        # Lines that are neither cohorts nor readings are written back around the cohort, in input order
+        self.before = list(before)
+        self.after = []
+
+    def add_reading(self, line):
+        root, ig = parse_reading(line)
+        self.readings.append((root, list(segment_ig(ig)) if ig else [''], [line]))
+
+    def add_subreading(self, line):
+        if self.readings:
+            self.readings[-1][1].append(parse_subreading(line))
+            self.readings[-1][2].append(line)
+
+    @property
+    def ends_sentence(self):
+        return any(igs[-1] == SENTENCE_IG for _, igs, _ in self.readings)
+
+    def tags(self):
+        """
+        Return Tag of every reading.
+        :rtype : list of Tag objects
+        """
+        return [make_tag(root, igs) for root, igs, _ in self.readings]
+
+
+def _reading_ends_sentence(line):
+    # IGs other than the first one start with a segmentation rule, so the last IG is the sentence IG
+    # only if it is the only one
+    return SENTENCE_IG in line and _tags(line[line.rindex('"') + 1:]) == [SENTENCE_IG]
+
+
+def _subreading_ends_sentence(line):
+    return SENTENCE_IG in line and parse_subreading(line) == SENTENCE_IG
+
+
+def _is_other_line(line, in_cohort):
+    # Lines that are neither cohorts nor readings of a cohort, e.g. blank lines between sentences
+    return not line.startswith('"<') and (not in_cohort or not line.startswith('\t') or '"' not in line)
+
+
+def _add_trailing_lines(sentence, other_lines):
+    # Lines after the last cohort of the input follow it, an input without cohorts gets a cohort without a line
+    if other_lines:
+        if not sentence:
+            sentence.append(Cohort(None))
+        sentence[-1].after.extend(other_lines)
+
+
+def iter_sentence_lines(lines, max_length=MAX_SENTENCE_LENGTH):
+    """
+    Group lines of CG cohort format into the sentences iter_cohort_sentences gives, without
+    parsing readings, so that sentences can be cut quickly and parsed elsewhere, e.g. in
+    worker processes. Other lines go with the sentence of the next cohort, or with the last sentence.
+    :param lines: iterable of lines, e.g. a file object
+    :param max_length: int
+    :return: generator of lists of lines without line ends
+    """
+    sentence, num_cohorts, other_lines = [], 0, []
+    # Whether the last IG of each reading of the current cohort is the sentence IG
+    ends = None
+    for line in lines:
+        if _is_other_line(line, ends is not None):
+            other_lines.append(line.rstrip('\r\n'))
+            continue
+        if line.startswith('"<'):
+            if (ends is not None and any(ends)) or num_cohorts >= max_length:
+                yield sentence
+                sentence, num_cohorts = [], 0
+            sentence.extend(other_lines)
+            other_lines = []
+            ends = []
+            num_cohorts += 1
+        elif line.startswith('\t\t'):
+            if not ends:
+                continue
+            ends[-1] = _subreading_ends_sentence(line)
+        else:
+            ends.append(_reading_ends_sentence(line))
+        sentence.append(line.rstrip('\r\n'))
+    sentence.extend(other_lines)
+    if sentence:
+        yield sentence
+
+
+def cohorts(sentence_lines):
+    """
+    Return Cohort objects of the lines of a sentence.
+    :param sentence_lines: list of lines as grouped by iter_sentence_lines
+    :rtype : list of Cohort objects
+    """
+    return [cohort for sentence in iter_cohort_sentences(sentence_lines) for cohort in sentence]
+
+
+def iter_cohort_sentences(lines, max_length=MAX_SENTENCE_LENGTH):
+    """
+    Group lines of CG cohort format into sentences. A sentence ends with a cohort that has a
+    sentence end reading, or after max_length cohorts. Other lines, e.g. blank ones, are kept
+    with the next cohort (see Cohort.before), or with the last one at the end of the input.
+    :param lines: iterable of lines, e.g. a file object
+    :param max_length: int
+    :return: generator of lists of Cohort objects
+    """
+    sentence, cohort, other_lines = [], None, []
+    for line in lines:
+        if _is_other_line(line, cohort is not None):
+            other_lines.append(line.rstrip('\r\n'))
+        elif line.startswith('"<'):
+            if (cohort is not None and cohort.ends_sentence) or len(sentence) >= max_length:
+                yield sentence
+                sentence = []
+            cohort = Cohort(line.rstrip('\r\n'), other_lines)
+            other_lines = []
+            sentence.append(cohort)
+        elif line.startswith('\t\t'):
+            cohort.add_subreading(line.rstrip('\r\n'))
+        else:
+            cohort.add_reading(line.rstrip('\r\n'))
+    _add_trailing_lines(sentence, other_lines)
+    if sentence:
+        yield sentence
+
+
+def tag_sentence(sentence, model, beam=None):
+    """
+    Return index of the best reading of every cohort of a sentence. The final cohort, if it ends
+    the sentence, and cohorts without readings get index 0.
+    :param sentence: list of Cohort objects
+    :type model: BaselineModel
+    :param beam: int, number of best readings kept at each position, None keeps all
+    :rtype : list of ints
+    """
+    words = sentence[:-1] if sentence[-1].ends_sentence else sentence
+    positions = [i for i, cohort in enumerate(words) if cohort.readings]
+    choice = [0] * len(sentence)
+    if not positions:
+        return choice
+    lattice = [[Tag('.', [SENTENCE_IG])]] + [sentence[i].tags() for i in positions] + [[Tag('.', [SENTENCE_IG])]]
+    path, _ = best_path(lattice, model, beam=beam)
+    for i, column, tag in zip(positions, lattice[1:-1], path[1:-1]):
+        choice[i] = next(k for k, candidate in enumerate(column) if candidate is tag)
+    return choice
+
+
+def write_sentence(sentence, choice, out):
+    """
+    Write cohorts of a sentence with their chosen readings, and the other lines around them.
+    """
+    lines = []
+    for cohort, k in zip(sentence, choice):
+        lines.extend(cohort.before)
+        if cohort.line is not None:
+            lines.append(cohort.line)
+        if cohort.readings:
+            lines.extend(cohort.readings[k][2])
+        lines.extend(cohort.after)
+    out.write('\n'.join(lines) + '\n')
+
+
+def _tag_sentences(batch, model, beam=None):
+    """
+    Tag sentences and return the disambiguated cohorts as text, and numbers of sentences,
+    cohorts and ambiguous cohorts.
+    :param batch: list of sentence lines as grouped by iter_sentence_lines
+    :type model: BaselineModel
+    """
+    out = io.StringIO()
+    counts = [0, 0, 0]
+    for sentence_lines in batch:
+        sentence = cohorts(sentence_lines)
+        write_sentence(sentence, tag_sentence(sentence, model, beam), out)
+        counts[0] += 1
+        counts[1] += len(sentence)
+        counts[2] += sum(len(cohort.readings) > 1 for cohort in sentence)
+    return out.getvalue(), counts
+
+
+def tag_stream(lines, out, model, beam=None, progress=None, processes=1, batch_size=None):
+    """
+    Tag CG cohort format lines and write the disambiguated cohorts.
+    :param lines: iterable of lines
+    :param out: text file object
+    :type model: BaselineModel
+    :param beam: int, number of best readings kept at each position, None keeps all
+    :param progress: float, seconds between throughput reports on stderr, None disables them
+    :param processes: int, number of worker processes that parse and tag batches of sentences,
+    at most the number of cores (see parallel.worker_count), output is the same for any number
+    :param batch_size: int, number of sentences sent to a worker at once
+    :return: dict with numbers of sentences, cohorts, ambiguous cohorts and seconds
+    """
+    stats = {'sentences': 0, 'cohorts': 0, 'ambiguous': 0}
+    start = last_report = time.perf_counter()
+    if parallel.worker_count(processes) > 1:
+        # Workers parse and tag batches of sentences, only cutting the input into sentences is left here
+        batches = parallel.iter_batches(iter_sentence_lines(lines), batch_size or parallel.BATCH_SIZE)
+        with parallel.SharedModelPool(model, processes) as pool:
+            for text, counts in pool.imap(partial(_tag_sentences, beam=beam), batches):
+                out.write(text)
+                for key, count in zip(('sentences', 'cohorts', 'ambiguous'), counts):
+                    stats[key] += count
+                if progress and time.perf_counter() - last_report >= progress:
+                    last_report = time.perf_counter()
+                    print(_throughput(stats, last_report - start), file=sys.stderr, flush=True)
+        stats['seconds'] = time.perf_counter() - start
+        return stats
+    for sentence in iter_cohort_sentences(lines):
+        choice = tag_sentence(sentence, model, beam)
+        write_sentence(sentence, choice, out)
+        stats['sentences'] += 1
+        stats['cohorts'] += len(sentence)
+        stats['ambiguous'] += sum(len(cohort.readings) > 1 for cohort in sentence)
+        if progress and time.perf_counter() - last_report >= progress:
+            last_report = time.perf_counter()
+            print(_throughput(stats, last_report - start), file=sys.stderr, flush=True)
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def iter_cohorts(lines):
+    """
+    Read lines of CG cohort format and yield every cohort once its last reading is read,
+    i.e. when the next cohort starts or the input ends. Other lines are kept with the next
+    cohort, or with the last one at the end of the input, as in iter_cohort_sentences.
+    :param lines: iterable of lines, e.g. a file object
+    :return: generator of Cohort objects
+    """
+    cohort, other_lines = None, []
+    for line in lines:
+        if _is_other_line(line, cohort is not None):
+            other_lines.append(line.rstrip('\r\n'))
+        elif line.startswith('"<'):
+            if cohort is not None:
+                yield cohort
+            cohort = Cohort(line.rstrip('\r\n'), other_lines)
+            other_lines = []
+        elif line.startswith('\t\t'):
+            cohort.add_subreading(line.rstrip('\r\n'))
+        else:
+            cohort.add_reading(line.rstrip('\r\n'))
+    last = [cohort] if cohort is not None else []
+    _add_trailing_lines(last, other_lines)
+    if last:
+        yield last[0]
+
+
+def tag_online(lines, out, model, lag=None, beam=None, progress=None):
+    """
+    Tag CG cohort format lines with the online decoder, writing every cohort as soon as its reading
+    is decided. Sentence end cohorts get their first reading and are decoded as the sentence tag, like
+    in tag_sentence, so without lag the output is that of tag_stream, except that sentences are never cut.
+    :param lines: iterable of lines
+    :param out: text file object, flushed after every write
+    :type model: BaselineModel
+    :param lag: int, maximum number of cohorts waiting for a decision, None waits until all paths agree
+    :param beam: int, number of best readings kept at each position, None keeps all
+    :param progress: float, seconds between throughput reports on stderr, None disables them
+    :return: dict with numbers of sentences, cohorts, ambiguous cohorts and seconds
+    """
+    stats = {'sentences': 0, 'cohorts': 0, 'ambiguous': 0}
+    start = last_report = time.perf_counter()
+    decoder = OnlineViterbi(model, lag=lag, beam=beam)
+    sentence_column = [Tag('.', [SENTENCE_IG])]
+    # Cohorts not written yet as [cohort, column pushed to the decoder or None, chosen reading or None]
+    queue = deque()
+
+    def write_decided(tags):
+        waiting = (item for item in queue if item[2] is None)
+        for tag, item in zip(tags, waiting):
+            item[2] = next(k for k, candidate in enumerate(item[1]) if candidate is tag)
+        written = False
+        while queue and queue[0][2] is not None:
+            cohort, _, k = queue.popleft()
+            write_sentence([cohort], [k], out)
+            written = True
+        if written:
+            out.flush()
+
+    for cohort in iter_cohorts(lines):
+        stats['cohorts'] += 1
+        stats['ambiguous'] += len(cohort.readings) > 1
+        if cohort.ends_sentence:
+            stats['sentences'] += 1
+            column = sentence_column
+        else:
+            column = cohort.tags() if cohort.readings else None
+        queue.append([cohort, column, None if column else 0])
+        write_decided(decoder.push(column) if column else [])
+        if progress and time.perf_counter() - last_report >= progress:
+            last_report = time.perf_counter()
+            print(_throughput(stats, last_report - start), file=sys.stderr, flush=True)
+    write_decided(decoder.finish())
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def _throughput(stats, seconds):
+    return '%d sentences, %d cohorts (%d ambiguous) in %.1f s: %.0f cohorts/s, %.0f sentences/s' % (
+        stats['sentences'], stats['cohorts'], stats['ambiguous'], seconds,
+        stats['cohorts'] / seconds if seconds else 0, stats['sentences'] / seconds if seconds else 0)
+
+
+def load_model(root_lm=None, ig_lm=None):
+    """
+    Return BaselineModel of memory-mapped binary language models, or one built from the big
+    tagged corpus if they are not given, loaded from the build cache if the corpus did not change.
+    :param root_lm: path of root model written by lmstore
+    :param ig_lm: path of IG model written by lmstore
+    :rtype : BaselineModel
+    """
+    if root_lm and ig_lm:
+        from main import lmstore
+        from main.viterbi_bigram import BaselineModel
+        return BaselineModel.from_lm(lmstore.load(root_lm), lmstore.load(ig_lm))
+    from main.buildcache import CachedBuild
+    from main.segment import BIG_CORPUS
+    return CachedBuild(BIG_CORPUS, ngram=2).model()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Disambiguate morphological analyses in CG cohort format.')
+    parser.add_argument('input', nargs='?', default='-', help='input file, - for stdin')
+    parser.add_argument('-o', '--output', default='-', help='output file, - for stdout')
+    parser.add_argument('--root-lm', help='binary root language model, see main.lmstore')
+    parser.add_argument('--ig-lm', help='binary IG language model, see main.lmstore')
+    parser.add_argument('--beam', type=int, help='number of best readings kept at each position')
+    parser.add_argument('--processes', type=int, default=1, help='number of worker processes, at most the number of cores')
+    parser.add_argument('--online', action='store_true',
+                        help='decode cohorts one at a time and write each one as soon as it is decided')
+    parser.add_argument('--lag', type=int, help='decide every cohort after at most this many more, implies --online')
+    parser.add_argument('--progress', type=float, default=10.0,
+                        help='seconds between throughput reports on stderr, 0 disables them')
+    args = parser.parse_args(argv)
+
+    # Nothing may be printed to stdout while the model is built, it may be the output
+    with redirect_stdout(sys.stderr):
+        model = load_model(args.root_lm, args.ig_lm)
+    fin = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    fout = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        if args.online or args.lag is not None:
+            stats = tag_online(fin, fout, model, lag=args.lag, beam=args.beam, progress=args.progress or None)
+        else:
+            stats = tag_stream(fin, fout, model, beam=args.beam, progress=args.progress or None,
+                               processes=args.processes)
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+        if fout is not sys.stdout:
+            fout.close()
+        else:
+            fout.flush()
+    print(_throughput(stats, stats['seconds']), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+import time
+
+import numpy as np
+
+from main import metrics
+from main.lm import LOG_ZERO
+from main.lmstore import PackedLM
+
+# Maximum number of cells of the padded transition score array of a batch, see viterbi_batch
+MAX_CELLS = 1 << 18
+
+
+def _id_map(tokens, lookup):
+    """
+    Return dictionary of ids of distinct tokens, -1 for tokens lookup returns None for.
+    """
+    ids = {}
+    for token in tokens:
+        if token not in ids:
+            token_id = lookup(token)
+            ids[token] = -1 if token_id is None else token_id
+    return ids
+
+
+def _lm_scores(lm, contexts, words):
+    """
+    Return array of lm.score((context,), word) for arrays of word ids of contexts and words.
+    :type lm: PackedLM
+    """
+    known = words >= 0
+    words = np.where(known, words, 0)
+    unigram = np.asarray(lm.logprobs[1])[words].astype(np.float64)
+    if lm.order == 1:
+        return np.where(known, unigram, LOG_ZERO)
+    known_context = contexts >= 0
+    contexts = np.where(known_context, contexts, 0)
+    keys = np.asarray(lm.keys[2])
+    key = (contexts * lm.vocab_size + words).astype(np.uint64)
+    pos = np.minimum(np.searchsorted(keys, key), max(len(keys) - 1, 0))
+    found = known & known_context & (keys[pos] == key) if len(keys) else np.zeros(len(key), dtype=bool)
+    bigram = np.asarray(lm.logprobs[2])[pos].astype(np.float64) if len(keys) else unigram
+    backoff = np.where(known_context, np.asarray(lm.backoffs[1])[contexts].astype(np.float64), 0.0)
+    return np.where(found, bigram, np.where(known, backoff + unigram, LOG_ZERO))
+
+
+def _matrix_scores(matrix, rows, cols, default):
+    """
+    Return array of matrix.get(row, col, default) for arrays of row and column ids, default
+    where either is -1. Columns are binary searched in all rows at once.
+    :type matrix: SparseMatrix
+    """
+    known = (rows >= 0) & (cols >= 0)
+    indptr, indices = np.asarray(matrix.indptr), np.asarray(matrix.indices)
+    rows = np.where(known, rows, 0)
+    lo, hi = indptr[rows], indptr[rows + 1]
+    while True:
+        searching = lo < hi
+        if not searching.any():
+            break
+        mid = (lo + hi) // 2
+        right = searching & (indices[np.minimum(mid, len(indices) - 1)] < cols)
+        lo = np.where(right, mid + 1, lo)
+        hi = np.where(searching & ~right, mid, hi)
+    pos = np.minimum(lo, max(len(indices) - 1, 0))
+    found = known & (lo < indptr[rows + 1]) & (indices[pos] == cols) if len(indices) else known & False
+    return np.where(found, np.asarray(matrix.data)[pos] if len(indices) else default, default)
+
+
+def transition_scores(model, firsts, seconds, first_index, second_index):
+    """
+    Return array of model.baseline_model(firsts[i], seconds[j]) for the pairs (i, j) of two index
+    arrays. Scores of matrix models and of models of PackedLM language models (memory-mapped ones
+    too) are looked up for all pairs at once with array indexing, adding the same floating point
+    numbers in the same order as BaselineModel, so that they are identical. Other models are
+    called per pair.
+    :type model: BaselineModel
+    :param firsts: list of Tag objects
+    :param seconds: list of Tag objects
+    :param first_index: array of indices into firsts
+    :param second_index: array of indices into seconds
+    :rtype : numpy.ndarray
+    """
+    if model.root_lm is None:
+        root_ids, ig_ids = model.root_vocab.get, model.ig_vocab.get
+    elif isinstance(model.root_lm, PackedLM) and isinstance(model.ig_lm, PackedLM):
+        root_ids, ig_ids = model.root_lm.word_id, model.ig_lm.word_id
+    else:
+        transition = model.baseline_model
+        pairs = zip(first_index.tolist(), second_index.tolist())
+        return np.array([transition(firsts[i], seconds[j]) for i, j in pairs], dtype=np.float64)
+    root_id = _id_map([tag.root for tags in (firsts, seconds) for tag in tags], root_ids)
+    ig_id = _id_map([tag.igs[-1] for tag in firsts] + [ig for tag in seconds for ig in tag.igs], ig_ids)
+    roots1 = np.array([root_id[tag.root] for tag in firsts], dtype=np.int64)[first_index]
+    roots2 = np.array([root_id[tag.root] for tag in seconds], dtype=np.int64)[second_index]
+    last_igs = np.array([ig_id[tag.igs[-1]] for tag in firsts], dtype=np.int64)[first_index]
+    # IG ids of the second tags, one row per tag padded with -1
+    num_igs = np.array([len(tag.igs) for tag in seconds], dtype=np.intp)
+    has_ig = np.arange(num_igs.max(initial=0)) < num_igs[:, np.newaxis]
+    igs = np.full(has_ig.shape, -1, dtype=np.int64)
+    igs[has_ig] = [ig_id[ig] for tag in seconds for ig in tag.igs]
+    igs, has_ig = igs[second_index], has_ig[second_index]
+    if model.root_lm is not None:
+        score = _lm_scores(model.root_lm, roots1, roots2)
+        for i in range(igs.shape[1]):
+            score = np.where(has_ig[:, i], score + _lm_scores(model.ig_lm, last_igs, igs[:, i]), score)
+        return score
+    unseen = model.unseen_score
+    ig_score = np.full(len(first_index), 1.0)
+    for i in range(igs.shape[1]):
+        ig_score = np.where(has_ig[:, i], ig_score + _matrix_scores(model.ig_matrix, last_igs, igs[:, i], unseen),
+                            ig_score)
+    return _matrix_scores(model.root_matrix, roots1, roots2, unseen) + ig_score
+
+
+class BatchViterbi:
+    """
+    Viterbi decoder over a batch of ambiguous sentences at once.
+    Lattices are padded into arrays and the max-plus recursion and the backtrace run
+    as NumPy operations across the whole batch, and transition scores are looked up for all
+    cells at once, see transition_scores. Paths and scores are identical to running best_path
+    on every sentence separately, ties included.
+    """
+
+    def __init__(self, ambiguous_seqs):
+        """
+        Constructor.
+        :param ambiguous_seqs: list of lattices, i.e. lists of lists of Tag objects, each framed
+        by the sentence tag like the ones in sentences.ambiguous_sentences.
+        """
+        self.ambiguous_seqs = ambiguous_seqs
+        self.lengths = np.array([len(seq) for seq in ambiguous_seqs], dtype=np.intp)
+        self.max_len = int(self.lengths.max()) if len(ambiguous_seqs) else 0
+        self.max_tags = max((max(map(len, seq), default=0) for seq in ambiguous_seqs), default=0)
+        self.num_cells = 0
+        self.delta = None
+        self.psi = None
+
+    def _cells(self):
+        """
+        Return the cells of all transitions of the batch, i.e. arrays of the index of the tag at
+        the previous position, of the tag at the position, and of the cell in the padded score
+        array. Tags are indexed in the order of the flattened lattices.
+        """
+        width = self.max_tags
+        sizes = np.array([len(column) for seq in self.ambiguous_seqs for column in seq], dtype=np.intp)
+        starts = np.cumsum(sizes) - sizes
+        seqs = np.repeat(np.arange(len(self.ambiguous_seqs)), self.lengths)
+        positions = np.arange(len(sizes)) - np.repeat(np.cumsum(self.lengths) - self.lengths, self.lengths)
+        # Columns with a previous column, i.e. transitions
+        columns = np.flatnonzero(positions > 0)
+        num_prev, num_cur = sizes[columns - 1], sizes[columns]
+        cells = num_prev * num_cur
+        # Cells of a transition are laid out tag by tag, previous tags varying fastest
+        transition = np.repeat(np.arange(len(columns)), cells)
+        offset = np.arange(int(cells.sum())) - np.repeat(np.cumsum(cells) - cells, cells)
+        prev, cur = np.divmod(offset, num_prev[transition])[::-1]
+        columns = columns[transition]
+        base = (seqs[columns] * self.max_len + positions[columns]) * width * width
+        return starts[columns - 1] + prev, starts[columns] + cur, base + cur * width + prev
+
+    def _scores(self, model):
+        """
+        Return array of transition scores, scores[b, pos, k, j] = model.baseline_model(tag_j, tag_k)
+        for tag_k at position pos and tag_j at position pos - 1 of sentence b, -inf for padding.
+        A transition score only depends on the root and last IG of the first tag and the root and
+        IGs of the second one, so tags get ids of these keys, the cells get pairs of ids with array
+        indexing, and every distinct pair is scored once.
+        :type model: BaselineModel
+        """
+        tags = [tag for seq in self.ambiguous_seqs for column in seq for tag in column]
+        keys = [(tag.root, tag.igs) for tag in tags]
+        second_ids = {key: i for i, key in enumerate(dict.fromkeys(keys))}
+        tag_second = np.array([second_ids[key] for key in keys], dtype=np.int64)
+        seconds = [tags[i] for i in np.unique(tag_second, return_index=True)[1].tolist()]
+        first_ids = {}
+        second_first = np.array([first_ids.setdefault((tag.root, tag.igs[-1]), len(first_ids)) for tag in seconds],
+                                dtype=np.int64)
+        firsts = [seconds[i] for i in np.unique(second_first, return_index=True)[1].tolist()]
+        tag_first = second_first[tag_second] if len(tags) else tag_second
+        prev, cur, index = self._cells()
+        self.num_cells = len(index)
+        pairs = tag_first[prev] * len(seconds) + tag_second[cur]
+        pairs, inverse = np.unique(pairs, return_inverse=True)
+        pair_firsts, pair_seconds = np.divmod(pairs, max(len(seconds), 1))
+        pair_scores = transition_scores(model, firsts, seconds, pair_firsts, pair_seconds)
+        scores = np.full(len(self.ambiguous_seqs) * self.max_len * self.max_tags * self.max_tags, -np.inf)
+        if self.num_cells:
+            scores[index] = pair_scores[inverse.ravel()]
+        return scores.reshape((len(self.ambiguous_seqs), self.max_len, self.max_tags, self.max_tags))
+
+    def train(self, model):
+        """
+        :type model:BaselineModel
+        """
+        start = time.perf_counter() if metrics.enabled else None
+        num_seqs = len(self.ambiguous_seqs)
+        scores = self._scores(model)
+        self.delta = np.full((num_seqs, self.max_len, self.max_tags), -np.inf)
+        self.psi = np.zeros((num_seqs, self.max_len, self.max_tags), dtype=np.intp)
+        first_sizes = np.array([len(seq[0]) if seq else 0 for seq in self.ambiguous_seqs], dtype=np.intp)
+        self.delta[:, 0][np.arange(self.max_tags) < first_sizes[:, np.newaxis]] = 0.0
+        for pos in range(1, self.max_len):
+            cur_delta = self.delta[:, pos - 1, np.newaxis, :] + scores[:, pos]
+            # argmax picks the first best previous tag, as best_path does
+            self.psi[:, pos] = cur_delta.argmax(axis=2)
+            self.delta[:, pos] = cur_delta.max(axis=2)
+        if start is not None:
+            metrics.inc('viterbi_batches_total')
+            metrics.inc('viterbi_sentences_total', num_seqs)
+            metrics.inc('viterbi_cells_total', self.num_cells)
+            metrics.observe('viterbi_batch_seconds', time.perf_counter() - start)
+
+    def _last_index(self):
+        """
+        Return index of the best tag of the last position of every sentence.
+        """
+        if not self.max_tags:
+            return np.zeros(len(self.ambiguous_seqs), dtype=np.intp)
+        rows = np.arange(len(self.ambiguous_seqs))
+        return self.delta[rows, np.maximum(self.lengths - 1, 0)].argmax(axis=1)
+
+    @property
+    def paths(self):
+        """
+        Return list of best paths, one list of Tag objects per sentence.
+        """
+        num_seqs = len(self.ambiguous_seqs)
+        rows = np.arange(num_seqs)
+        # choice[b, pos] is the index of the tag of the best path at pos
+        choice = np.zeros((num_seqs, self.max_len), dtype=np.intp)
+        last = index = self._last_index()
+        for pos in range(self.max_len - 1, -1, -1):
+            index = np.where(pos == self.lengths - 1, last, index)
+            choice[:, pos] = index
+            if pos:
+                index = self.psi[rows, pos, index]
+        return [[column[k] for column, k in zip(seq, choice[b].tolist())]
+                for b, seq in enumerate(self.ambiguous_seqs)]
+
+    @property
+    def probabilities(self):
+        """
+        Return list of scores of the best paths, one per sentence.
+        """
+        rows = np.arange(len(self.ambiguous_seqs))
+        scores = self.delta[rows, np.maximum(self.lengths - 1, 0), self._last_index()]
+        return scores.tolist()
+
+
+def batches(ambiguous_seqs, max_cells=MAX_CELLS):
+    """
+    Split lattices into batches of similar width and length, so that little of the padded
+    arrays of a batch is padding. Lattices are sorted by their largest number of tags at a
+    position and by length, and a batch is closed when its padded score array would have more
+    than max_cells cells. A lattice larger than that is decoded alone.
+    :param ambiguous_seqs: list of lattices
+    :param max_cells: int
+    :return: generator of lists of indices of lattices
+    """
+    widths = [max(map(len, seq), default=0) for seq in ambiguous_seqs]
+    order = sorted(range(len(ambiguous_seqs)), key=lambda i: (widths[i], len(ambiguous_seqs[i])))
+    batch, max_len, max_tags = [], 0, 0
+    for i in order:
+        length, width = max(max_len, len(ambiguous_seqs[i])), max(max_tags, widths[i])
+        if batch and (len(batch) + 1) * length * width * width > max_cells:
+            yield batch
+            batch, length, width = [], len(ambiguous_seqs[i]), widths[i]
+        batch.append(i)
+        max_len, max_tags = length, width
+    if batch:
+        yield batch
+
+
+def viterbi_batch(ambiguous_seqs, model, max_cells=MAX_CELLS):
+    """
+    Decode ambiguous sentences and return list of (path, probability) tuples in input order.
+    Sentences are decoded in batches of similar ones, see batches.
+    :param ambiguous_seqs: list of lattices
+    :type model: BaselineModel
+    :param max_cells: int, maximum number of cells of the padded score array of a batch
+    """
+    results = [None] * len(ambiguous_seqs)
+    for batch in batches(ambiguous_seqs, max_cells):
+        viterbi = BatchViterbi([ambiguous_seqs[i] for i in batch])
+        viterbi.train(model)
+        for i, result in zip(batch, zip(viterbi.paths, viterbi.probabilities)):
+            results[i] = result
+    return results
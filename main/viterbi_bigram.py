@@ -1,58 +1,45 @@
 import math
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
 
+from main import metrics
+from main.lm import LOG_ZERO
 
-class Token:
-    """Class to represent a root or IG token."""
-
-    def __init__(self, word):
-        """
-        Constructor.
-        :rtype : Token
-        :type word: str
-        """
-        self.token = word
-        self.probabilities = {}
-
-    def prob_given(self, word):
-        """
-        Return Pr(self.token | word).
-        :rtype : float
-        :param word:
-        :type word: str
-        """
-        try:
-            return self.probabilities[word]
-        except KeyError:
-            return 0.0
-
-    def set_prob(self, word, p):
-        """
-        Set Pr(self.token | word) = p.
-        :type p: float
-        :type word: str
-        """
-        self.probabilities[word] = p
-
-    def __str__(self):
-        return 'TOKEN: %s, PROBS: %s' % (self.token, str(self.probabilities))
+# Maximum number of memoized transition scores in BaselineModel, None means unbounded.
+TRANSITION_CACHE_SIZE = 1 << 16
+# Maximum number of tags shared by make_tag
+TAG_CACHE_SIZE = 100000
+# Maximum number of IG sequences or IG strings in IG_TABLE, so that tagging a stream or serving
+# clients does not keep every IG ever read
+IG_TABLE_SIZE = 100000
 
 
 class Tag:
-    """Class to represent a tag with root word and IG list."""
+    """
+    Class to represent a tag with root word and IG list. Tags are immutable, their IG sequences
+    are interned in IG_TABLE and their hash is computed once, so that equal tags share memory
+    and can be used in sets and as dictionary keys.
+    """
+    __slots__ = ('root', 'igs', 'ig_ids', '_hash')
 
     def __init__(self, root, ig_list):
         """
         Constructor.
         :param root: str
-        :param ig_list: list of lists, e.g. [[ig1, ig2], [ig3], ...]
+        :param ig_list: list or tuple of IG strings, e.g. ['n', 'px3sp', 'loc']
         """
         assert isinstance(root, str)
-        self.root = root
-        assert isinstance(ig_list, list)
-        self.igs = ig_list
+        self.root = sys.intern(root)
+        assert isinstance(ig_list, (list, tuple))
+        # Shared tuples of IG strings and of their ids in IG_TABLE
+        self.igs, self.ig_ids = IG_TABLE.intern(ig_list)
+        self._hash = hash((self.root, self.igs))
 
     def __str__(self):
-        return 'ROOT:%s, IGs:%s' % (self.root, str(self.igs))
+        return 'ROOT:%s, IGs:%s' % (self.root, str(list(self.igs)))
 
     @property
     def last_ig(self):
@@ -81,93 +68,323 @@ class Tag:
         return len(self.igs)
 
     def __hash__(self):
-        return hash((self.root, ) + tuple(self.igs))
+        return self._hash
 
     def __eq__(self, other):
-        return self.root == other.root and any(map(lambda v: v in self.igs, other.igs))
+        try:
+            return self is other or (self._hash == other._hash and self.root == other.root
+                                     and self.igs == other.igs)
+        except AttributeError:
+            return NotImplemented
+
+    def __reduce__(self):
+        # IG ids are specific to the IG_TABLE of a process, so they are interned again on unpickling
+        return Tag, (self.root, self.igs)
 
     def __repr__(self):
         return '%s+%s ' % (self.root, '+'.join(self.igs))
 
 
+_shared_tags = {}
+
+
+def make_tag(root, ig_list):
+    """
+    Return a Tag that is shared by all calls with the same root and IGs, e.g. to build lattices
+    where the same readings repeat, without creating a new object for every occurrence.
+    :param root: str
+    :param ig_list: list or tuple of IG strings
+    :rtype : Tag
+    """
+    key = (root, tuple(ig_list))
+    try:
+        return _shared_tags[key]
+    except KeyError:
+        if len(_shared_tags) >= TAG_CACHE_SIZE:
+            _shared_tags.clear()
+        _shared_tags[key] = Tag(root, key[1])
+        return _shared_tags[key]
+
+
+class Vocabulary:
+    """Class to intern root or IG strings to consecutive integer ids."""
+
+    def __init__(self, tokens=()):
+        """
+        Constructor.
+        :param tokens: iterable of strings, duplicates are interned once.
+        """
+        self.ids = {}
+        self.tokens = []
+        for token in tokens:
+            self.add(token)
+
+    def add(self, token):
+        """
+        Intern a token and return its id.
+        :rtype : int
+        :type token: str
+        """
+        try:
+            return self.ids[token]
+        except KeyError:
+            self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+            return self.ids[token]
+
+    def get(self, token):
+        """
+        Return id of a token or None if it is not in the vocabulary.
+        :rtype : int
+        :type token: str
+        """
+        return self.ids.get(token)
+
+    def __contains__(self, token):
+        return token in self.ids
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+class IGTable:
+    """
+    Class to intern IG sequences, so that equal sequences share one tuple of IG strings
+    and one tuple of integer IG ids. The table starts over once it holds max_size sequences
+    or IG strings, so IG ids are only comparable between sequences interned since then;
+    tuples interned before stay valid and equal to the new ones.
+    """
+
+    def __init__(self, max_size=IG_TABLE_SIZE):
+        """
+        Constructor.
+        :param max_size: int, maximum number of IG sequences or IG strings, None means unbounded
+        """
+        self.max_size = max_size
+        self.vocab = Vocabulary()
+        self._sequences = {}
+
+    def intern(self, igs):
+        """
+        Return the shared tuple of IG strings and tuple of IG ids of an IG sequence.
+        :param igs: list or tuple of IG strings
+        :rtype : tuple
+        """
+        key = tuple(igs)
+        try:
+            return self._sequences[key]
+        except KeyError:
+            if self.max_size is not None and max(len(self._sequences), len(self.vocab)) >= self.max_size:
+                self.vocab = Vocabulary()
+                self._sequences = {}
+            ids = tuple(self.vocab.add(ig) for ig in key)
+            strings = tuple(self.vocab.tokens[i] for i in ids)
+            self._sequences[key] = (strings, ids)
+            return self._sequences[key]
+
+    def __len__(self):
+        return len(self._sequences)
+
+
+# IG sequences of all Tag and InflectionalGroup objects
+IG_TABLE = IGTable()
+
+
+class SparseMatrix:
+    """Class to represent a sparse matrix of floats in compressed sparse row (CSR) format."""
+
+    def __init__(self, num_rows, entries):
+        """
+        Constructor. Build time is linear in the number of entries.
+        :param num_rows: int
+        :param entries: iterable of (row, column, value) tuples with unique (row, column) pairs.
+        """
+        rows = [[] for _ in range(num_rows)]
+        for row, col, value in entries:
+            rows[row].append((col, value))
+        self.indptr = array('l', [0])
+        self.indices = array('l')
+        self.data = array('d')
+        for row in rows:
+            row.sort()
+            self.indices.extend(col for col, _ in row)
+            self.data.extend(value for _, value in row)
+            self.indptr.append(len(self.indices))
+
+    def get(self, row, col, default=0.0):
+        """
+        Return the value at (row, col) or default if it is not stored.
+        :rtype : float
+        :type row: int
+        :type col: int
+        """
+        lo, hi = self.indptr[row], self.indptr[row + 1]
+        pos = bisect_left(self.indices, col, lo, hi)
+        if pos < hi and self.indices[pos] == col:
+            return self.data[pos]
+        return default
+
+    @property
+    def num_rows(self):
+        return len(self.indptr) - 1
+
+    @property
+    def nnz(self):
+        """
+        Return the number of stored entries.
+        :rtype : int
+        """
+        return len(self.data)
+
+
 class BaselineModel:
     """Class to represent bi-gram baseline model."""
 
-    def __init__(self, root_list, root_counts, ig_list, ig_counts, is_prob_calculated=False):
+    def __init__(self, root_list, root_counts, ig_list, ig_counts, is_prob_calculated=False,
+                 cache_size=TRANSITION_CACHE_SIZE):
         """
         Constructor.
-        :type root_list: list of root strings
-        :type ig_list: list of IG strings
+        :type root_list: list of root strings, may contain repetitions
+        :type ig_list: list of IG strings, may contain repetitions
         :type root_counts: dictionary of dictionary, e.g. {root1: {root1: count, root2: count, ...}, ...}
         :type ig_counts: dictionary of dictionary, e.g. {ig1: {ig1: count, ig2: count, ...}, ...}
+        :param cache_size: int, maximum number of memoized transition scores, None means unbounded
+        """
+        self.cache_size = cache_size
+        self.build(root_list, root_counts, ig_list, ig_counts, is_prob_calculated)
+
+    def build(self, root_list, root_counts, ig_list, ig_counts, is_prob_calculated=False):
+        """
+        (Re)build vocabularies and matrices, memoized transition scores are dropped.
+        Arguments are the same as the constructor's.
         """
-        assert isinstance(root_list, list)
-        self.roots = root_list
-        assert isinstance(ig_list, list)
-        self.igs = ig_list
-        assert isinstance(root_counts, dict)
-        self.root_tokens = BaselineModel._build_tokens(root_list, root_counts, is_prob_calculated)
-        assert isinstance(ig_counts, dict)
-        self.ig_tokens = BaselineModel._build_tokens(ig_list, ig_counts, is_prob_calculated)
+        with metrics.timer('model_build_seconds'):
+            assert isinstance(root_list, list)
+            self.root_vocab = Vocabulary(root_list)
+            assert isinstance(ig_list, list)
+            self.ig_vocab = Vocabulary(ig_list)
+            assert isinstance(root_counts, dict)
+            self.root_matrix = BaselineModel._build_matrix(self.root_vocab, root_counts, is_prob_calculated)
+            assert isinstance(ig_counts, dict)
+            self.ig_matrix = BaselineModel._build_matrix(self.ig_vocab, ig_counts, is_prob_calculated)
+        # Score of unseen bigrams and of tokens out of vocabulary: a log10 probability of an unseen
+        # bigram is not known without backoff weights, so it is LOG_ZERO, -ln costs keep 0.0
+        self.unseen_score = LOG_ZERO if is_prob_calculated else 0.0
+        # Language models scoring transitions instead of the matrices, see from_lm
+        self.root_lm = self.ig_lm = None
+        self.clear_cache()
+
+    @classmethod
+    def from_lm(cls, root_lm, ig_lm, cache_size=TRANSITION_CACHE_SIZE):
+        """
+        Create a model that scores with log10 Pr(word | previous word) of root and IG language
+        models directly, e.g. memory-mapped ones from lmstore.load, without building matrices.
+        Unseen bigrams are scored with backoff weights and unigram probabilities.
+        :param root_lm: language model with score(context, word) method, e.g. lmstore.PackedLM
+        :param ig_lm: language model with score(context, word) method, e.g. lmstore.PackedLM
+        :param cache_size: int, maximum number of memoized transition scores, None means unbounded
+        :rtype : BaselineModel
+        """
+        model = cls.__new__(cls)
+        model.cache_size = cache_size
+        model.root_vocab = model.root_matrix = model.ig_vocab = model.ig_matrix = None
+        model.unseen_score = LOG_ZERO
+        model.root_lm, model.ig_lm = root_lm, ig_lm
+        model.clear_cache()
+        return model
+
+    def clear_cache(self):
+        """
+        Drop memoized transition scores and reset hit and miss counters. It must be called
+        whenever vocabularies or matrices are modified in place.
+        """
+        self._transition_score = lru_cache(maxsize=self.cache_size)(self._score_tags)
+
+    def cache_info(self):
+        """
+        Return statistics of memoized transition scores.
+        :return: named tuple (hits, misses, maxsize, currsize) as in functools.lru_cache
+        """
+        return self._transition_score.cache_info()
+
+    def __getstate__(self):
+        # The cache holds a bound method and is rebuilt empty after unpickling
+        state = self.__dict__.copy()
+        del state['_transition_score']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clear_cache()
 
     @staticmethod
-    def _build_tokens(token_list, token_counts, is_prob_calculated):
+    def _build_matrix(vocab, token_counts, is_prob_calculated):
         """
-        Create and return a list of Token objects.
-        :param token_list: list of strings, e.g. roots or IGs
+        Create and return a sparse matrix with -ln[Pr(token2 | token1)] (or the given probability
+        if is_prob_calculated) at row token1 and column token2. Bigrams with tokens out of
+        vocabulary are skipped.
+        :param vocab: Vocabulary of roots or IGs
         :param token_counts: dictionary of dictionary with token counts,
-        :return: list of Token objects.
-        """
-        ret_list = []
-        assert isinstance(token_list, list)
-        for token1 in token_list:
-            root = Token(token1)
-            for token2 in token_list:
-                assert isinstance(token_counts, dict)
-                try:
+        :return: SparseMatrix
+        """
+
+        def entries():
+            for token1, counts in token_counts.items():
+                row = vocab.get(token1)
+                if row is None:
+                    continue
+                total = float(sum(counts.values()))
+                for token2, count in counts.items():
+                    col = vocab.get(token2)
+                    if col is None:
+                        continue
                     if not is_prob_calculated:
-                        prob = -math.log(float(token_counts[token2][token1]) / float(sum(token_counts[token2].values())))
-                    elif is_prob_calculated:
-                        prob = token_counts[token2][token1]
-                    root.set_prob(token2, prob)
-                    # print('-ln[Pr(%s | %s)] = %s' % (token1, token2, root.prob_given(token2)))
-                except KeyError:
-                    pass
-            ret_list.append(root)
-        return ret_list
-
-    def _get_token(self, tag, is_root=True, pos=0):
-        """
-        Return token at position that corresponds to tag.
-        :param tag: Tag object
-        :param is_root: boolean
-        :param pos: int, position
-        :return: Token or None
-        """
-        tokens = self.root_tokens if is_root else self.ig_tokens
-        for token in tokens:
-            if is_root and token.token == tag.root:
-                return token
-            elif not is_root and token.token == tag.get_ig(pos):
-                return token
-        return None
+                        prob = -math.log(float(count) / total)
+                    else:
+                        prob = count
+                    yield row, col, prob
+
+        return SparseMatrix(len(vocab), entries())
+
+    def _score_tags(self, root1, last_ig, root2, igs):
+        """
+        Return transition score of a pair of tags.
+        :type root1: str
+        :param last_ig: str, the last IG of the first tag
+        :type root2: str
+        :param igs: tuple of IGs of the second tag
+        :rtype : float
+        """
+        if self.root_lm is not None:
+            score = self.root_lm.score((root1,), root2)
+            for ig in igs:
+                score += self.ig_lm.score((last_ig,), ig)
+            return score
+        unseen = self.unseen_score
+        root_prob, ig_prob = unseen, 1.0
+        root2 = self.root_vocab.get(root2)
+        if root2 is not None:
+            root1 = self.root_vocab.get(root1)
+            if root1 is not None:
+                root_prob = self.root_matrix.get(root1, root2, unseen)
+        ig_get = self.ig_vocab.get
+        last_ig = ig_get(last_ig)
+        for ig in igs:
+            ig = ig_get(ig)
+            if last_ig is None or ig is None:
+                ig_prob += unseen
+            else:
+                ig_prob += self.ig_matrix.get(last_ig, ig, unseen)
+        return root_prob + ig_prob
 
     def baseline_model(self, tag1, tag2):
         """
-        Return Pr(tag2 | tag1) according to a baseline bi-gram model.
+        Return Pr(tag2 | tag1) according to a baseline bi-gram model. Scores are memoized
+        by interned roots and IG tuples of the tags, see cache_info.
         :type tag1: Tag
         :type tag2: Tag
         """
-        root_token = self._get_token(tag2)
-        root_prob, ig_prob = 0.0, 1.0
-        if root_token:
-            root_prob = root_token.prob_given(tag1.root)
-        for k in range(tag2.num_ig):
-            ig_token = self._get_token(tag2, is_root=False, pos=k)
-            if ig_token:
-                ig_prob += ig_token.prob_given(tag1.last_ig)
-                # print("Baseline: Pr[%s | %s] = %f" % (tag2, tag1, ig_prob))
-        return root_prob + ig_prob
+        return self._transition_score(tag1.root, tag1.igs[-1], tag2.root, tag2.igs)
 
     def log_prob(self, word_seq, root_seq, ig_seq):
         """
@@ -193,10 +410,94 @@ def print_analysis():
     print('-ln[Pr(%s | %s)] = %f' % (analyzed, ' '.join(word_sequence), log_prob))
 
 
+def prune_hypotheses(scores, beam=None, threshold=None):
+    """
+    Keep the best scoring hypotheses.
+    :param scores: dict of hypothesis to score, higher is better
+    :param beam: int, number of best hypotheses kept, None keeps all
+    :param threshold: float, hypotheses scoring more than threshold below the best one are dropped
+    :return: tuple of dict with the kept hypotheses, in order of decreasing score, and number of pruned ones
+    """
+    if (beam is None or len(scores) <= beam) and threshold is None:
+        return scores, 0
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    if threshold is not None and ranked:
+        best = ranked[0][1]
+        ranked = [item for item in ranked if item[1] >= best - threshold]
+    if beam is not None:
+        ranked = ranked[:beam]
+    return dict(ranked), len(scores) - len(ranked)
+
+
+def record_decoding(ambiguous_seq, cells, num_pruned, seconds):
+    """
+    Record metrics of decoding one sentence.
+    :param ambiguous_seq: lattice, list of lists of Tag objects
+    :param cells: int, number of transitions scored
+    :param num_pruned: int, number of hypotheses dropped by pruning
+    :param seconds: float, decoding time
+    """
+    metrics.inc('viterbi_sentences_total')
+    metrics.inc('viterbi_positions_total', len(ambiguous_seq))
+    metrics.inc('viterbi_cells_total', cells)
+    metrics.inc('viterbi_pruned_total', num_pruned)
+    metrics.observe('viterbi_lattice_tags', sum(len(column) for column in ambiguous_seq), metrics.SIZE_BUCKETS)
+    metrics.observe('viterbi_sentence_seconds', seconds)
+
+
+def best_path(ambiguous_seq, model, beam=None, threshold=None):
+    """
+    Return the highest scoring path through a lattice. Transitions are scored as Pr(tag | previous
+    tag), so the path maximizes the sum of transition scores, i.e. the bigram log probability of
+    the tags if the model scores unseen transitions with backoff (from_lm) or LOG_ZERO. Unlike
+    Viterbi, tags are tracked by position rather than by value, so the backtrace can not fail.
+    :param ambiguous_seq: list of lists of Tag objects framed by the sentence tag
+    :type model: BaselineModel
+    :param beam: int, number of best tags kept at each position, None keeps all
+    :param threshold: float, tags scoring more than threshold below the best one at a position are dropped
+    :return: tuple of list of Tag objects and its score
+    """
+    scores = {j: 0.0 for j in range(len(ambiguous_seq[0]))}
+    pointers = [None]
+    for pos in range(1, len(ambiguous_seq)):
+        prev_column = ambiguous_seq[pos - 1]
+        new_scores, back = {}, {}
+        for k, tag in enumerate(ambiguous_seq[pos]):
+            best_score, best_j = None, None
+            for j, score in scores.items():
+                cur_score = score + model.baseline_model(prev_column[j], tag)
+                if best_score is None or cur_score > best_score:
+                    best_score, best_j = cur_score, j
+            new_scores[k], back[k] = best_score, best_j
+        if pos < len(ambiguous_seq) - 1:
+            new_scores, _ = prune_hypotheses(new_scores, beam, threshold)
+        scores = new_scores
+        pointers.append(back)
+    k = max(scores, key=scores.get)
+    score = scores[k]
+    path = [None] * len(ambiguous_seq)
+    for pos in range(len(ambiguous_seq) - 1, 0, -1):
+        path[pos] = ambiguous_seq[pos][k]
+        k = pointers[pos][k]
+    path[0] = ambiguous_seq[0][k]
+    return path, score
+
+
 class Viterbi:
-    def __init__(self, ambiguous_seq, word_seq):
+    def __init__(self, ambiguous_seq, word_seq, beam=None, threshold=None):
+        """
+        Constructor.
+        :param ambiguous_seq: list of lists of Tag objects framed by the sentence tag
+        :param word_seq: list of words
+        :param beam: int, number of best tags kept at each position, None keeps all
+        :param threshold: float, tags scoring more than threshold below the best one at a position are dropped
+        """
         self.ambiguous_seq = ambiguous_seq
         self.word_seq = word_seq
+        self.beam = beam
+        self.threshold = threshold
+        # Number of tags dropped by beam and threshold pruning
+        self.num_pruned = 0
 
         # Init data structures
         self.delta = [{}]
@@ -211,19 +512,30 @@ class Viterbi:
         """
         :type model:BaselineModel
         """
+        start = time.perf_counter() if metrics.enabled else None
+        cells = 0
         for pos in range(1, len(self.ambiguous_seq)):
             self.delta.append({})
             self.psi.append({})
+            # Only tags that survived pruning at the previous position are extended
+            prev_delta = self.delta[pos - 1]
+            cells += len(self.ambiguous_seq[pos]) * len(prev_delta)
             for tag in self.ambiguous_seq[pos]:
-                max_delta = 0.0
-                max_tag = self.ambiguous_seq[pos][0]
-                for prev_tag in self.ambiguous_seq[pos - 1]:
-                    cur_delta = self.delta[pos - 1][prev_tag] + model.baseline_model(tag, prev_tag)
-                    if cur_delta > max_delta:
+                # As in best_path, scores are not floored and the first best previous tag wins
+                max_delta, max_tag = None, None
+                for prev_tag, prev_score in prev_delta.items():
+                    cur_delta = prev_score + model.baseline_model(prev_tag, tag)
+                    if max_delta is None or cur_delta > max_delta:
                         max_delta = cur_delta
                         max_tag = prev_tag
                 self.delta[pos][tag] = max_delta
                 self.psi[pos][tag] = max_tag
+            if pos < len(self.ambiguous_seq) - 1:
+                # The last position is not pruned, so the sentence tag always survives
+                self.delta[pos], num_pruned = prune_hypotheses(self.delta[pos], self.beam, self.threshold)
+                self.num_pruned += num_pruned
+        if start is not None:
+            record_decoding(self.ambiguous_seq, cells, self.num_pruned, time.perf_counter() - start)
 
     @property
     def path(self):
@@ -0,0 +1,146 @@
+import time
+
+from main import metrics
+from main.viterbi_bigram import Tag, prune_hypotheses, record_decoding
+
+# Number of best states kept at each position by SecondOrderViterbi, None keeps all.
+DEFAULT_BEAM = 16
+# Maximum number of memoized root and IG scores in TrigramModel.
+SCORE_CACHE_SIZE = 100000
+
+
+class TrigramModel:
+    """Class to represent tri-gram root and IG model."""
+
+    def __init__(self, root_lm, ig_lm):
+        """
+        Constructor.
+        :param root_lm: root language model of order 3 with score(context, word) method,
+        e.g. lm.BackoffModel or lmstore.PackedLM
+        :param ig_lm: IG language model of order 3 with score(context, word) method
+        """
+        self.root_lm = root_lm
+        self.ig_lm = ig_lm
+        self._root_scores = {}
+        self._ig_scores = {}
+
+    def _score(self, lm, scores, context, word):
+        key = context + (word,)
+        try:
+            return scores[key]
+        except KeyError:
+            if len(scores) >= SCORE_CACHE_SIZE:
+                scores.clear()
+            scores[key] = lm.score(context, word)
+            return scores[key]
+
+    def trigram_model(self, tag1, tag2, tag3):
+        """
+        Return log10 Pr(tag3 | tag1, tag2), i.e. Pr(root3 | root1, root2) times Pr(IG | last IG1, last IG2)
+        for every IG of tag3.
+        :param tag1: Tag or None at the start of a sentence
+        :type tag2: Tag
+        :type tag3: Tag
+        :rtype : float
+        """
+        if tag1 is None:
+            root_context, ig_context = (tag2.root,), (tag2.last_ig,)
+        else:
+            root_context, ig_context = (tag1.root, tag2.root), (tag1.last_ig, tag2.last_ig)
+        log_prob = self._score(self.root_lm, self._root_scores, root_context, tag3.root)
+        for k in range(tag3.num_ig):
+            log_prob += self._score(self.ig_lm, self._ig_scores, ig_context, tag3.get_ig(k))
+        return log_prob
+
+
+class SecondOrderViterbi:
+    """
+    Viterbi decoder for a tri-gram model. States are pairs of tags at adjacent positions,
+    and only the best states at each position are kept, so that the number of states does
+    not grow quadratically with the number of analyses per word.
+    """
+
+    def __init__(self, ambiguous_seq, word_seq, beam=DEFAULT_BEAM, threshold=None):
+        """
+        Constructor.
+        :param ambiguous_seq: list of lists of Tag objects framed by the sentence tag
+        :param word_seq: list of words
+        :param beam: int, number of best states kept at each position, None keeps all
+        :param threshold: float, states scoring more than threshold below the best one are dropped
+        """
+        self.ambiguous_seq = ambiguous_seq
+        self.word_seq = word_seq
+        self.beam = beam
+        self.threshold = threshold
+        self._sentence_tag = Tag('.', ['sent'])
+        # psi[pos] maps state (j, k) of tag indices at pos - 1 and pos to tag index at pos - 2
+        self.psi = []
+        self.states = {}
+        # Number of states dropped by beam and threshold pruning
+        self.num_pruned = 0
+
+    def train(self, model):
+        """
+        :type model: TrigramModel
+        """
+        start = time.perf_counter() if metrics.enabled else None
+        cells = 0
+        seq = self.ambiguous_seq
+        states = {(None, j): 0.0 for j, tag in enumerate(seq[0]) if tag == self._sentence_tag}
+        self.psi = [{}]
+        for pos in range(1, len(seq)):
+            new_states, back = {}, {}
+            cells += len(states) * len(seq[pos])
+            for (i, j), score in states.items():
+                tag1 = seq[pos - 2][i] if i is not None else None
+                tag2 = seq[pos - 1][j]
+                for k, tag3 in enumerate(seq[pos]):
+                    cur_score = score + model.trigram_model(tag1, tag2, tag3)
+                    if (j, k) not in new_states or cur_score > new_states[(j, k)]:
+                        new_states[(j, k)] = cur_score
+                        back[(j, k)] = i
+            # The last position is not pruned, so the sentence tag always survives
+            if pos < len(seq) - 1:
+                new_states, num_pruned = prune_hypotheses(new_states, self.beam, self.threshold)
+                self.num_pruned += num_pruned
+            states = new_states
+            self.psi.append(back)
+        self.states = states
+        if start is not None:
+            record_decoding(seq, cells, self.num_pruned, time.perf_counter() - start)
+
+    def _best_state(self):
+        last = self.ambiguous_seq[-1]
+        final = [(score, state) for state, score in self.states.items() if last[state[1]] == self._sentence_tag]
+        return max(final, key=lambda item: item[0])
+
+    @property
+    def path(self):
+        seq = self.ambiguous_seq
+        _, (j, k) = self._best_state()
+        path = [None] * len(seq)
+        path[-1] = seq[-1][k]
+        for pos in range(len(seq) - 1, 0, -1):
+            path[pos - 1] = seq[pos - 1][j]
+            j, k = self.psi[pos][(j, k)], j
+        return path
+
+    @property
+    def probability(self):
+        return self._best_state()[0]
+
+
+if __name__ == "__main__":
+    from main.segment import prepare_corpus, build_language_models
+    from main.sentences import ambiguous_sentences
+
+    counters = prepare_corpus(is_test=False, ngram=3)
+    root_lm, ig_lm = build_language_models(ngram=3, counters=counters)
+    trigram_model = TrigramModel(root_lm, ig_lm)
+    for amb_seq, word_seq in ambiguous_sentences:
+        viterbi = SecondOrderViterbi(amb_seq, word_seq.split())
+        viterbi.train(model=trigram_model)
+        print('Sentence: %s' % word_seq)
+        print('Viterbi probability: %f' % viterbi.probability)
+        print('Viterbi path: %s' % viterbi.path)
+        print('-' * 20)
@@ -0,0 +1,74 @@
+# coding=utf-8
+"""
+Shared fixtures of the regression tests.
+
+data/big_roots.txt and data/big_igs.txt hold the roots (one line per file) and the IG bigram
+lines that the original parser extracted from big_tagged_corpus, in file name order.
+"""
+import os
+import random
+
+import pytest
+
+from main import lmstore
+from main.lm import NgramCounter, estimate
+from main.segment import BIG_CORPUS, process_file
+from main.viterbi_bigram import BaselineModel, Tag
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def sentence_tag():
+    return Tag('.', ['sent'])
+
+
+@pytest.fixture(scope='session')
+def big_sentences():
+    """List of the sentences of big_tagged_corpus in file name order."""
+    sentences = []
+    for file_name in sorted(os.listdir(BIG_CORPUS)):
+        sentences.extend(process_file(os.path.join(BIG_CORPUS, file_name)))
+    return sentences
+
+
+@pytest.fixture(scope='session')
+def counters(big_sentences):
+    """Root and IG bigram NgramCounter objects of big_tagged_corpus."""
+    root_counter, ig_counter = NgramCounter(2), NgramCounter(2)
+    for sentence in big_sentences:
+        root_counter.add_sequence(['.'] + sentence.roots)
+        ig_counter.add_sequence(['sent'] + [ig for group in sentence.igs for ig in group.group])
+    return root_counter, ig_counter
+
+
+@pytest.fixture(scope='session')
+def lattices(big_sentences):
+    """
+    Lattices of the sentences of big_tagged_corpus with the gold reading of every word and
+    up to 4 readings of other words, some columns with a repeated reading, so that ties occur.
+    """
+    rnd = random.Random(0)
+    readings = [(root, list(group.group)) for sentence in big_sentences
+                for root, group in zip(sentence.roots, sentence.igs)]
+    result = []
+    for sentence in big_sentences[:120]:
+        lattice = [[sentence_tag()]]
+        for root, group in list(zip(sentence.roots, sentence.igs))[:-1]:
+            column = [Tag(root, list(group.group))] + [Tag(*rnd.choice(readings)) for _ in range(rnd.randint(0, 4))]
+            rnd.shuffle(column)
+            if rnd.random() < 0.1:
+                column.append(Tag(column[0].root, list(column[0].igs)))
+            lattice.append(column)
+        lattice.append([sentence_tag()])
+        result.append(lattice)
+    return result
+
+
+@pytest.fixture(scope='session', params=['matrix', 'packed'])
+def model(request, counters):
+    """BaselineModel built from bigram probability matrices, or from packed language models."""
+    root_lm, ig_lm = estimate(counters[0]), estimate(counters[1])
+    if request.param == 'matrix':
+        return BaselineModel(counters[0].vocab, root_lm.probs(2), counters[1].vocab, ig_lm.probs(2),
+                             is_prob_calculated=True)
+    return BaselineModel.from_lm(lmstore.pack(root_lm), lmstore.pack(ig_lm))
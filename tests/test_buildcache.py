@@ -0,0 +1,61 @@
+# coding=utf-8
+import os
+import shutil
+
+import pytest
+
+from main import lmstore
+from main.buildcache import CachedBuild
+from main.segment import BIG_CORPUS
+from main.viterbi_bigram import BaselineModel, best_path
+
+
+@pytest.fixture()
+def corpus_dir(tmp_path):
+    directory = tmp_path / 'corpus'
+    shutil.copytree(BIG_CORPUS, str(directory))
+    return str(directory)
+
+
+def test_warm_build_loads_model(corpus_dir, tmp_path, lattices):
+    cold = CachedBuild(corpus_dir, cache_dir=str(tmp_path / 'cache'))
+    model = cold.model()
+    assert cold.cache.misses['model'] == 1 and cold.cache.hits['model'] == 0
+    warm = CachedBuild(corpus_dir, cache_dir=str(tmp_path / 'cache'))
+    cached = warm.model()
+    assert warm.cache.hits['model'] == 1 and sum(warm.cache.misses.values()) == 0
+    assert [best_path(lattice, cached) for lattice in lattices] == [best_path(lattice, model) for lattice in lattices]
+
+
+def test_changed_file_is_counted_again(corpus_dir, tmp_path):
+    CachedBuild(corpus_dir, cache_dir=str(tmp_path / 'cache')).model()
+    file_name = sorted(os.listdir(corpus_dir))[0]
+    with open(os.path.join(corpus_dir, file_name), encoding='utf-8') as f:
+        text = f.read()
+    with open(os.path.join(corpus_dir, file_name), 'w', encoding='utf-8') as f:
+        f.write(text[:text.rindex('"<')])
+    build = CachedBuild(corpus_dir, cache_dir=str(tmp_path / 'cache'))
+    build.model()
+    assert build.cache.misses['counts'] == 1
+    assert build.cache.hits['counts'] == len(os.listdir(corpus_dir)) - 1
+    assert build.cache.misses['lm'] == build.cache.misses['model'] == 1
+
+
+def test_model_scores_like_stored_language_models(corpus_dir, tmp_path, lattices):
+    build = CachedBuild(corpus_dir, cache_dir=str(tmp_path / 'cache'))
+    paths = []
+    for name, lm in zip(('roots.bin', 'igs.bin'), build.language_model()):
+        paths.append(str(tmp_path / name))
+        lmstore.write_binary(lm, paths[-1])
+    stored = BaselineModel.from_lm(lmstore.load(paths[0]), lmstore.load(paths[1]))
+    model = build.model()
+    for lattice in lattices:
+        path, score = best_path(lattice, model)
+        assert best_path(lattice, stored) == (path, pytest.approx(score, abs=1e-9))
+
+
+def test_model_needs_bigrams(corpus_dir, tmp_path):
+    build = CachedBuild(corpus_dir, ngram=3, cache_dir=str(tmp_path / 'cache'))
+    assert all(lm.order == 3 for lm in build.language_model())
+    with pytest.raises(ValueError):
+        build.model()
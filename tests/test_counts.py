@@ -0,0 +1,97 @@
+# coding=utf-8
+import functools
+import os
+from collections import Counter
+
+import pytest
+
+from main import segment
+from main.corpusstore import CorpusStore
+from main.lm import NgramCounter, count_file
+from main.segment import BIG_CORPUS, count_file_sentences, prepare_corpus, sentence_chunks, stream_counts
+
+FILE_NAMES = sorted(os.listdir(BIG_CORPUS))
+
+
+def _outputs(lm_corpus_dir):
+    texts = []
+    for name in ('roots.txt', 'igs.txt', 'stats.txt'):
+        with open(os.path.join(lm_corpus_dir, name), encoding='utf-8') as f:
+            texts.append(f.read())
+    return texts
+
+
+@pytest.fixture(scope='module', params=[1, 2, 3])
+def reference(request, tmp_path_factory):
+    """Order, counters and output files of prepare_corpus with one process."""
+    ngram = request.param
+    lm_corpus_dir = str(tmp_path_factory.mktemp('reference'))
+    root_counter, ig_counter = prepare_corpus(ngram=ngram, corpus_dir=BIG_CORPUS, lm_corpus_dir=lm_corpus_dir)
+    return ngram, root_counter, ig_counter, _outputs(lm_corpus_dir)
+
+
+def test_output_files_count_like_counters(reference, tmp_path):
+    ngram, root_counter, ig_counter, texts = reference
+    for name, text, counter in zip(('roots.txt', 'igs.txt'), texts, (root_counter, ig_counter)):
+        (tmp_path / name).write_text(text, encoding='utf-8')
+        assert count_file(str(tmp_path / name), order=ngram, last_only=name == 'igs.txt').counts == counter.counts
+
+
+def test_ig_lines_are_counted_as_transitions(reference):
+    ngram, _, ig_counter, texts = reference
+    lines = [tuple(line.split()) for line in texts[1].splitlines()]
+    # Every line adds the IG after its history, and its suffixes, once to every order
+    for k in range(1, ngram + 1):
+        assert ig_counter.counts[k] == Counter(line[-k:] for line in lines)
+
+
+@pytest.mark.parametrize('processes', [2, 3])
+@pytest.mark.parametrize('chunk_size', [2048, 16384, segment.PARSE_CHUNK_SIZE])
+def test_counts_do_not_depend_on_processes_and_chunk_size(reference, processes, chunk_size, tmp_path,
+                                                          monkeypatch):
+    ngram, root_counter, ig_counter, texts = reference
+    monkeypatch.setattr(segment, 'sentence_chunks', functools.partial(sentence_chunks, chunk_size=chunk_size))
+    counters = prepare_corpus(ngram=ngram, processes=processes, corpus_dir=BIG_CORPUS, lm_corpus_dir=str(tmp_path))
+    assert counters[0].counts == root_counter.counts
+    assert counters[1].counts == ig_counter.counts
+    assert _outputs(str(tmp_path)) == texts
+
+
+@pytest.mark.parametrize('chunk_size', [1024, 4096])
+def test_file_parts_add_up_to_file_counts(reference, chunk_size):
+    ngram = reference[0]
+    for file_name in FILE_NAMES:
+        fpath = os.path.join(BIG_CORPUS, file_name)
+        whole = count_file_sentences(fpath, ngram)
+        root_counter, ig_counter = NgramCounter(ngram), NgramCounter(ngram)
+        root_text = ig_text = ''
+        for chunk in sentence_chunks(fpath, ngram, chunk_size):
+            counts = count_file_sentences(fpath, ngram, chunk)
+            root_counter.update(counts.root_counter)
+            ig_counter.update(counts.ig_counter)
+            root_text += counts.root_text
+            ig_text += counts.ig_text
+        assert root_counter.counts == whole.root_counter.counts
+        assert ig_counter.counts == whole.ig_counter.counts
+        assert (root_text, ig_text) == (whole.root_text, whole.ig_text)
+
+
+def test_streaming_counts_match(reference):
+    ngram, root_counter, ig_counter, _ = reference
+    streamed = NgramCounter(ngram), NgramCounter(ngram)
+    for file_name in FILE_NAMES:
+        fpath = os.path.join(BIG_CORPUS, file_name)
+        stream_counts(segment.iter_sentences(fpath, ngram), streamed[0], streamed[1], ngram)
+    assert streamed[0].counts == root_counter.counts
+    assert streamed[1].counts == ig_counter.counts
+
+
+def test_corpus_store_counts_match(reference, tmp_path):
+    ngram, root_counter, ig_counter, texts = reference
+    store = CorpusStore.from_corpus(BIG_CORPUS)
+    counters = store.ngram_counters(ngram)
+    assert counters[0].counts == root_counter.counts
+    assert counters[1].counts == ig_counter.counts
+    store.write_lm_corpus(str(tmp_path), ngram)
+    assert _outputs(str(tmp_path)) == texts
+
@@ -0,0 +1,148 @@
+# coding=utf-8
+import os
+
+import numpy as np
+import pytest
+
+from main import parallel
+from main.kbest import k_best_paths, posteriors
+from main.online import OnlineViterbi, decode_stream
+from main.lm import estimate
+from main.viterbi_batch import batches, transition_scores, viterbi_batch
+from main.viterbi_bigram import BaselineModel, Tag, Viterbi, best_path, prune_hypotheses
+from tests.conftest import sentence_tag
+
+
+@pytest.fixture(scope='module')
+def expected(lattices, model):
+    return [best_path(lattice, model) for lattice in lattices]
+
+
+def _assert_same(results, expected):
+    assert len(results) == len(expected)
+    for (path, score), (best, best_score) in zip(results, expected):
+        assert path == best
+        assert score == pytest.approx(best_score, abs=1e-9)
+
+
+def test_attested_reading_beats_unattested_one():
+    model = BaselineModel(['.', 'a', 'zzz'], {'.': {'a': -0.5}, 'a': {'.': -0.3}},
+                          ['sent', 'n', 'qqq'], {'sent': {'n': -0.4}, 'n': {'sent': -0.2}}, is_prob_calculated=True)
+    lattice = [[sentence_tag()], [Tag('zzz', ['qqq']), Tag('a', ['n'])], [sentence_tag()]]
+    assert best_path(lattice, model)[0][1] == Tag('a', ['n'])
+
+
+def test_viterbi_matches_best_path(lattices, model, expected):
+    for lattice, (best, best_score) in zip(lattices, expected):
+        viterbi = Viterbi(lattice, [None] * len(lattice))
+        viterbi.train(model)
+        assert viterbi.path == best
+        assert viterbi.probability == pytest.approx(best_score, abs=1e-9)
+
+
+def _path_score(path, model):
+    return sum(model.baseline_model(first, second) for first, second in zip(path, path[1:]))
+
+
+def test_prune_hypotheses_keeps_best_ones():
+    scores = {'a': -1.0, 'b': -3.0, 'c': -0.5, 'd': -2.0}
+    assert prune_hypotheses(scores) == (scores, 0)
+    assert prune_hypotheses(scores, beam=4) == (scores, 0)
+    kept, num_pruned = prune_hypotheses(scores, beam=2)
+    assert list(kept.items()) == [('c', -0.5), ('a', -1.0)] and num_pruned == 2
+    assert prune_hypotheses(scores, threshold=1.5) == ({'c': -0.5, 'a': -1.0, 'd': -2.0}, 1)
+
+
+def test_beam_as_wide_as_lattice_is_exact(lattices, model, expected):
+    for lattice, (best, best_score) in zip(lattices, expected):
+        width = max(map(len, lattice))
+        assert best_path(lattice, model, beam=width) == (best, best_score)
+        viterbi = Viterbi(lattice, [None] * len(lattice), beam=width)
+        viterbi.train(model)
+        assert (viterbi.path, viterbi.num_pruned) == (best, 0)
+        assert best_path(lattice, model, threshold=1e9)[1] == pytest.approx(best_score, abs=1e-9)
+
+
+@pytest.mark.parametrize('beam, threshold', [(1, None), (2, None), (None, 0.5), (2, 0.5)])
+def test_pruned_decoding_scores_its_path(lattices, model, expected, beam, threshold):
+    num_pruned = 0
+    for lattice, (_, best_score) in zip(lattices, expected):
+        viterbi = Viterbi(lattice, [None] * len(lattice), beam=beam, threshold=threshold)
+        viterbi.train(model)
+        # Viterbi keeps distinct tags and best_path positions, so they may prune differently
+        for path, score in (best_path(lattice, model, beam=beam, threshold=threshold),
+                            (viterbi.path, viterbi.probability)):
+            assert score == pytest.approx(_path_score(path, model), abs=1e-9)
+            assert score <= best_score + 1e-9
+        num_pruned += viterbi.num_pruned
+    assert num_pruned
+
+
+def test_batch_matches_best_path(lattices, model, expected):
+    _assert_same(viterbi_batch(lattices, model), expected)
+    _assert_same(viterbi_batch(lattices[:1], model), expected[:1])
+    assert viterbi_batch([], model) == []
+
+
+@pytest.mark.parametrize('max_cells', [1, 4096])
+def test_bounded_batches_match_best_path(lattices, model, expected, max_cells):
+    _assert_same(viterbi_batch(lattices, model, max_cells=max_cells), expected)
+    indices = []
+    for batch in batches(lattices, max_cells):
+        group = [lattices[i] for i in batch]
+        width = max(len(column) for lattice in group for column in lattice)
+        assert len(group) == 1 or len(group) * max(map(len, group)) * width * width <= max_cells
+        indices.extend(batch)
+    assert sorted(indices) == list(range(len(lattices)))
+
+
+def test_transition_scores_equal_baseline_model(lattices, model, counters):
+    tags = [tag for lattice in lattices[:10] for column in lattice for tag in column]
+    tags += [Tag('unknown-root', ['unknown-ig']), Tag(tags[1].root, ['unknown-ig', tags[1].igs[-1]])]
+    other = BaselineModel.from_lm(estimate(counters[0]), estimate(counters[1]))
+    first_index, second_index = np.divmod(np.arange(len(tags) * len(tags)), len(tags))
+    for scored in (model, other):
+        expected = [scored.baseline_model(tags[i], tags[j]) for i, j in zip(first_index, second_index)]
+        assert transition_scores(scored, tags, tags, first_index, second_index).tolist() == expected
+
+
+def test_online_matches_best_path(lattices, model, expected):
+    for lattice, (best, _) in zip(lattices, expected):
+        assert list(decode_stream(lattice[1:-1], model)) == best[1:-1]
+
+
+def test_online_with_lag_bounds_pending(lattices, model):
+    decoder = OnlineViterbi(model, lag=2)
+    for lattice in lattices:
+        for column in lattice[1:-1]:
+            decoder.push(column)
+            assert decoder.pending <= 2
+        decoder.finish()
+
+
+def test_k_best_starts_with_best_path(lattices, model, expected):
+    for lattice, (best, best_score) in zip(lattices, expected):
+        paths = k_best_paths(lattice, model, 3)
+        assert paths[0][1] == pytest.approx(best_score, abs=1e-9)
+        assert paths[0][0] == best
+        assert all(first[1] >= second[1] for first, second in zip(paths, paths[1:]))
+
+
+def test_posteriors_sum_to_one(lattices, model):
+    for lattice in lattices[:20]:
+        probs, _ = posteriors(lattice, model)
+        for column in probs:
+            assert sum(column) == pytest.approx(1.0, abs=1e-6)
+
+
+@pytest.mark.parametrize('processes, batch_size', [(1, 16), (2, 7)])
+def test_parallel_matches_best_path(lattices, model, expected, processes, batch_size, monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    _assert_same(parallel.decode(lattices, model, processes=processes, batch_size=batch_size), expected)
+
+
+def test_one_core_decodes_without_pool(lattices, model, expected, monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 1)
+    monkeypatch.setattr(parallel, 'SharedModelPool', None)
+    assert parallel.worker_count(4) == parallel.worker_count(None) == 1
+    _assert_same(parallel.decode(lattices, model, processes=4), expected)
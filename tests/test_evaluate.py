@@ -0,0 +1,78 @@
+# coding=utf-8
+import os
+from collections import Counter
+
+import pytest
+
+from main.evaluate import COUNTERS, Fold, _count_file_blocks, cross_validate, evaluate_fold
+from main.lm import IncrementalLM, NgramCounter
+from main.segment import BIG_CORPUS
+
+NUM_FOLDS = 3
+
+
+@pytest.fixture(scope='module')
+def file_blocks():
+    """Folds of the held-out blocks of every corpus file."""
+    return [_count_file_blocks((os.path.join(BIG_CORPUS, file_name), 2, NUM_FOLDS))
+            for file_name in sorted(os.listdir(BIG_CORPUS))]
+
+
+def _global_models(file_blocks):
+    root_lm, ig_lm, lexicon = IncrementalLM(2), IncrementalLM(2), Counter()
+    for blocks in file_blocks:
+        for block in blocks:
+            for counts in block.counts:
+                root_lm.add(counts.root_counter)
+                ig_lm.add(counts.ig_counter)
+            lexicon.update(block.lexicon)
+    return root_lm, ig_lm, lexicon
+
+
+def _fold(file_blocks, index):
+    fold = Fold()
+    for blocks in file_blocks:
+        fold.counts.extend(blocks[index].counts)
+        fold.lexicon.update(blocks[index].lexicon)
+        fold.sentences.extend(blocks[index].sentences)
+    return fold
+
+
+def test_subtracted_counts_equal_training_blocks(file_blocks):
+    root_lm, ig_lm, _ = _global_models(file_blocks)
+    for index in range(NUM_FOLDS):
+        training = NgramCounter(2), NgramCounter(2)
+        for blocks in file_blocks:
+            for i, block in enumerate(blocks):
+                if i != index:
+                    training[0].update(block.counts[0].root_counter)
+                    training[1].update(block.counts[0].ig_counter)
+        for lm, counter, held_out in zip((root_lm, ig_lm), training, ('root_counter', 'ig_counter')):
+            subtracted = IncrementalLM(2)
+            subtracted.add(lm.counter)
+            for counts in _fold(file_blocks, index).counts:
+                subtracted.subtract(getattr(counts, held_out))
+            assert subtracted.counter.counts == counter.counts
+            scratch = IncrementalLM(2)
+            scratch.add(counter)
+            for gram in list(counter.counts[2])[::20]:
+                assert subtracted.logprob(gram) == pytest.approx(scratch.logprob(gram), abs=1e-9)
+
+
+def test_evaluation_restores_global_counts(file_blocks):
+    root_lm, ig_lm, lexicon = _global_models(file_blocks)
+    counts = [{k: dict(lm.counter.counts[k]) for k in (1, 2)} for lm in (root_lm, ig_lm)]
+    result = evaluate_fold(0, root_lm, ig_lm, lexicon, _fold(file_blocks, 0))
+    assert [{k: dict(lm.counter.counts[k]) for k in (1, 2)} for lm in (root_lm, ig_lm)] == counts
+    assert result['words'] <= sum(len(sentence) for sentence in _fold(file_blocks, 0).sentences)
+    assert 0 < result['evaluated'] <= result['words'] - result['unknown']
+
+
+def test_cross_validation_does_not_depend_on_processes():
+    serial = cross_validate(num_folds=NUM_FOLDS)
+    parallel = cross_validate(num_folds=NUM_FOLDS, processes=2)
+    assert [serial[counter] for counter in COUNTERS] == [parallel[counter] for counter in COUNTERS]
+    assert serial['correct'] == sum(fold['correct'] for fold in serial['folds'])
+    assert 0 < serial['baseline_accuracy'] <= 1 and 0 < serial['accuracy'] <= 1
+    with pytest.raises(ValueError):
+        cross_validate(num_folds=1)
@@ -0,0 +1,69 @@
+# coding=utf-8
+import os
+import shutil
+
+import pytest
+
+from main.incremental import IncrementalCorpus
+from main.lm import estimate
+from main.segment import BIG_CORPUS, prepare_corpus
+from main.viterbi_bigram import best_path
+
+FILE_NAMES = sorted(os.listdir(BIG_CORPUS))
+
+
+def _copy(file_names, directory):
+    for file_name in file_names:
+        shutil.copy(os.path.join(BIG_CORPUS, file_name), os.path.join(directory, file_name))
+
+
+def test_updates_equal_full_rebuild(tmp_path, lattices):
+    corpus_dir = tmp_path / 'corpus'
+    corpus_dir.mkdir()
+    _copy(FILE_NAMES[:6], str(corpus_dir))
+    corpus = IncrementalCorpus(str(corpus_dir))
+    assert corpus.update() == FILE_NAMES[:6]
+    assert corpus.update() == []
+    # Add files, change one, remove one and touch one
+    _copy(FILE_NAMES[6:], str(corpus_dir))
+    changed = corpus_dir / FILE_NAMES[0]
+    text = changed.read_text(encoding='utf-8')
+    changed.write_text(text[:text.rindex('"<', 0, len(text) // 2)], encoding='utf-8')
+    os.remove(str(corpus_dir / FILE_NAMES[1]))
+    os.utime(str(corpus_dir / FILE_NAMES[2]), ns=(0, 0))
+    assert corpus.update() == sorted(FILE_NAMES[:2] + FILE_NAMES[6:])
+
+    lm_corpus_dir = tmp_path / 'lm'
+    lm_corpus_dir.mkdir()
+    root_counter, ig_counter = prepare_corpus(corpus_dir=str(corpus_dir), lm_corpus_dir=str(lm_corpus_dir))
+    rebuilt = IncrementalCorpus(str(corpus_dir))
+    rebuilt.update()
+    assert corpus.num_sent == rebuilt.num_sent and corpus.ig_lengths == rebuilt.ig_lengths
+    for lm, counter in ((corpus.root_lm, root_counter), (corpus.ig_lm, ig_counter)):
+        assert lm.counter.counts == counter.counts
+        model = estimate(counter)
+        updated = lm.to_model()
+        for k in (1, 2):
+            assert updated.ngrams[k].keys() == model.ngrams[k].keys()
+            for gram, (prob, backoff) in model.ngrams[k].items():
+                assert updated.ngrams[k][gram] == pytest.approx([prob, backoff], abs=1e-9)
+    for lattice in lattices:
+        path, score = best_path(lattice, rebuilt.model)
+        assert best_path(lattice, corpus.model) == (path, pytest.approx(score, abs=1e-9))
+
+    corpus.write_corpus(str(tmp_path))
+    for name in ('roots.txt', 'igs.txt'):
+        assert (tmp_path / name).read_text(encoding='utf-8') == (lm_corpus_dir / name).read_text(encoding='utf-8')
+
+
+def test_saved_corpus_only_parses_changed_files(tmp_path):
+    corpus_dir = tmp_path / 'corpus'
+    corpus_dir.mkdir()
+    _copy(FILE_NAMES[:3], str(corpus_dir))
+    corpus = IncrementalCorpus(str(corpus_dir))
+    corpus.update()
+    corpus.save(str(tmp_path / 'state.pickle'))
+    _copy(FILE_NAMES[3:4], str(corpus_dir))
+    loaded = IncrementalCorpus.load(str(tmp_path / 'state.pickle'))
+    assert loaded.update() == FILE_NAMES[3:4]
+    assert loaded.num_sent > corpus.num_sent
@@ -0,0 +1,87 @@
+# coding=utf-8
+import os
+
+import pytest
+
+from main import lmstore
+from main.lm import IncrementalLM, NgramCounter, estimate
+from main.segment import BIG_CORPUS, count_file_sentences
+
+SMOOTHINGS = ['kn', 'wb']
+
+
+def _counter(sentences, order, tokens):
+    counter = NgramCounter(order)
+    for sentence in sentences:
+        counter.add_sequence(tokens(sentence))
+    return counter
+
+
+def _roots(sentence):
+    return sentence.roots
+
+
+def _igs(sentence):
+    return [ig for group in sentence.igs for ig in group.group]
+
+
+def _contexts(counter, step):
+    """Every step-th context of every order below the model order, and the empty context."""
+    contexts = [()]
+    for k in range(1, counter.order):
+        contexts.extend(sorted(gram for gram in counter.counts[k])[::step])
+    return contexts
+
+
+def _assert_normalized(lm, counter, step):
+    vocab = [gram[0] for gram in counter.counts[1]]
+    for context in _contexts(counter, step):
+        total = sum(10 ** lm.score(context, word) for word in vocab)
+        assert total == pytest.approx(1.0, abs=1e-6), context
+
+
+@pytest.mark.parametrize('smoothing', SMOOTHINGS)
+@pytest.mark.parametrize('order', [2, 3])
+@pytest.mark.parametrize('tokens, step', [(_roots, 40), (_igs, 1)])
+def test_estimate_is_normalized(big_sentences, smoothing, order, tokens, step):
+    counter = _counter(big_sentences, order, tokens)
+    _assert_normalized(estimate(counter, smoothing), counter, step)
+
+
+@pytest.mark.parametrize('smoothing', SMOOTHINGS)
+def test_incremental_lm_matches_estimate(big_sentences, smoothing):
+    half = len(big_sentences) // 2
+    first, second = _counter(big_sentences[:half], 2, _igs), _counter(big_sentences[half:], 2, _igs)
+    lm = IncrementalLM(2, smoothing)
+    lm.add(first)
+    lm.add(second)
+    lm.subtract(second)
+    _assert_normalized(lm, first, 1)
+    model = estimate(first, smoothing)
+    for k in (1, 2):
+        for gram, (prob, backoff) in model.ngrams[k].items():
+            assert lm.logprob(gram) == pytest.approx(prob, abs=1e-9)
+            if k == 1:
+                assert lm.backoff(gram) == pytest.approx(backoff, abs=1e-9)
+
+
+@pytest.mark.parametrize('smoothing', SMOOTHINGS)
+def test_ig_transition_counts_estimate_complete_model(smoothing):
+    counter = NgramCounter(3)
+    for file_name in sorted(os.listdir(BIG_CORPUS)):
+        counter.update(count_file_sentences(os.path.join(BIG_CORPUS, file_name), 3).ig_counter)
+    model = estimate(counter, smoothing)
+    lm = IncrementalLM(3, smoothing)
+    lm.add(counter)
+    # Histories are counted only where they are IGs after a history themselves, so some contexts
+    # are added to the model, every context keeps a backoff weight and the model can be packed
+    contexts = {gram[:-1] for k in (2, 3) for gram in counter.counts[k]}
+    added = [context for context in contexts if context not in counter.counts[len(context)]]
+    assert added
+    for built in (model, lm.to_model()):
+        assert all(context in built.ngrams[len(context)] for context in contexts)
+        lmstore.pack(built)
+    vocab = [gram[0] for gram in counter.counts[1]]
+    for context in sorted(contexts)[::10] + added:
+        assert sum(10 ** model.score(context, word) for word in vocab) == pytest.approx(1.0, abs=1e-6), context
+        assert model.score(context, vocab[0]) == pytest.approx(lm.score(context, vocab[0]), abs=1e-9)
@@ -0,0 +1,48 @@
+# coding=utf-8
+import pytest
+
+from main import lmstore
+from main.lm import LOG_ZERO, NgramCounter, estimate
+
+
+@pytest.fixture(scope='module', params=[2, 3])
+def model(request, big_sentences):
+    counter = NgramCounter(request.param)
+    for sentence in big_sentences:
+        counter.add_sequence(sentence.roots)
+    return estimate(counter)
+
+
+@pytest.fixture(scope='module', params=['packed', 'mapped', 'arpa'])
+def stored(request, model, tmp_path_factory):
+    """The model packed in memory, memory-mapped from a binary file, or read back from ARPA."""
+    if request.param == 'packed':
+        return lmstore.pack(model)
+    directory = tmp_path_factory.mktemp('lmstore')
+    if request.param == 'mapped':
+        lmstore.write_binary(lmstore.pack(model), str(directory / 'model.bin'))
+        return lmstore.load(str(directory / 'model.bin'))
+    model.write_arpa(str(directory / 'model.arpa'))
+    return lmstore.read_arpa(str(directory / 'model.arpa'))
+
+
+def _queries(model):
+    """Contexts and words of all stored n-grams, and of unseen ones that back off."""
+    words = sorted(gram[0] for gram in model.ngrams[1])
+    queries = []
+    for k in range(1, model.order + 1):
+        queries.extend((gram[:-1], gram[-1]) for gram in sorted(model.ngrams[k]))
+    queries.extend(((first,), second) for first, second in zip(words[::7], reversed(words)))
+    queries.extend([(('unknown-word',), words[0]), ((words[0],), 'unknown-word')])
+    return queries
+
+
+def test_lookups_match_in_process_model(model, stored):
+    for k in range(1, model.order + 1):
+        for gram, (prob, backoff) in model.ngrams[k].items():
+            assert stored.logprob(gram) == pytest.approx(prob, abs=1e-5)
+            if k < model.order:
+                assert stored.backoff(gram) == pytest.approx(backoff, abs=1e-5)
+    for context, word in _queries(model):
+        assert stored.score(context, word) == pytest.approx(model.score(context, word), abs=1e-4)
+    assert stored.score(('.',), 'unknown-word') == LOG_ZERO
@@ -0,0 +1,67 @@
+# coding=utf-8
+import json
+import os
+
+import pytest
+
+from main import metrics
+from main.segment import BIG_CORPUS, process_file
+from main.viterbi_bigram import Viterbi
+
+
+@pytest.fixture()
+def registry(monkeypatch):
+    """The default registry, empty and enabled during a test."""
+    monkeypatch.setattr(metrics, 'enabled', True)
+    metrics.reset()
+    yield metrics.REGISTRY
+    metrics.reset()
+
+
+def _decode(lattices, model):
+    for lattice in lattices:
+        Viterbi(lattice, [None] * len(lattice), beam=2).train(model)
+
+
+def test_disabled_metrics_record_nothing(lattices, model, monkeypatch):
+    monkeypatch.setattr(metrics, 'enabled', False)
+    metrics.reset()
+    _decode(lattices[:10], model)
+    process_file(os.path.join(BIG_CORPUS, sorted(os.listdir(BIG_CORPUS))[0]))
+    with metrics.timer('lm_build_seconds'):
+        pass
+    assert metrics.REGISTRY.to_dict() == {'counters': {}, 'gauges': {}, 'histograms': {}}
+
+
+def test_pipeline_stages_are_counted(registry, lattices, model):
+    _decode(lattices, model)
+    file_names = sorted(os.listdir(BIG_CORPUS))[:2]
+    num_sentences = sum(len(process_file(os.path.join(BIG_CORPUS, file_name))) for file_name in file_names)
+    counters = registry.counters
+    assert counters['viterbi_sentences_total'] == len(lattices)
+    assert counters['viterbi_positions_total'] == sum(map(len, lattices))
+    assert 0 < counters['viterbi_cells_total'] <= sum(len(first) * len(second) for lattice in lattices
+                                                      for first, second in zip(lattice, lattice[1:]))
+    assert counters['viterbi_pruned_total'] > 0
+    assert counters['parse_files_total'] == len(file_names)
+    assert counters['parse_sentences_total'] == num_sentences
+    assert registry.histograms['parse_file_seconds'].count == len(file_names)
+
+
+def test_histogram_and_exports(registry, tmp_path):
+    for value in (0.5, 1, 2, 2, 7, 100):
+        metrics.observe('batch_size', value, buckets=(1, 5, 10))
+    metrics.inc('requests_total', 3)
+    metrics.set_gauge('queue_depth', 4)
+    histogram = registry.histograms['batch_size']
+    assert histogram.bucket_counts == [2, 2, 1, 1]
+    assert (histogram.quantile(0.5), histogram.quantile(0.8), histogram.quantile(1.0)) == (5, 10, 100)
+    metrics.write_json(str(tmp_path / 'metrics.json'))
+    exported = json.loads((tmp_path / 'metrics.json').read_text())
+    assert exported['counters'] == {'requests_total': 3} and exported['gauges'] == {'queue_depth': 4}
+    assert exported['histograms']['batch_size']['count'] == 6
+    metrics.write_prometheus(str(tmp_path / 'metrics.prom'))
+    lines = (tmp_path / 'metrics.prom').read_text().splitlines()
+    assert 'kaztagger_requests_total 3' in lines and 'kaztagger_queue_depth 4' in lines
+    assert [line.split()[-1] for line in lines if line.startswith('kaztagger_batch_size_bucket')] == ['2', '4', '5', '6']
+    assert 'kaztagger_batch_size_count 6' in lines
@@ -0,0 +1,72 @@
+# coding=utf-8
+import math
+import pickle
+
+import pytest
+
+from main.lm import LOG_ZERO, estimate
+from main.viterbi_bigram import BaselineModel, SparseMatrix, Tag, best_path
+
+
+def _tags(lattices):
+    tags = list({tag for lattice in lattices[:10] for column in lattice for tag in column})
+    return tags + [Tag('unknown-root', ['unknown-ig']), Tag(tags[1].root, ['unknown-ig', tags[1].igs[-1]])]
+
+
+def test_sparse_matrix_gets_stored_entries():
+    entries = {(0, 3): 0.5, (0, 1): -1.0, (2, 0): 2.0, (2, 2): 0.0}
+    matrix = SparseMatrix(4, [(row, col, value) for (row, col), value in entries.items()])
+    assert matrix.num_rows == 4 and matrix.nnz == len(entries)
+    for row in range(4):
+        for col in range(4):
+            assert matrix.get(row, col, default=LOG_ZERO) == entries.get((row, col), LOG_ZERO)
+
+
+def test_matrix_model_scores_bigram_probabilities(lattices, counters):
+    root_probs, ig_probs = estimate(counters[0]).probs(2), estimate(counters[1]).probs(2)
+    model = BaselineModel(counters[0].vocab, root_probs, counters[1].vocab, ig_probs, is_prob_calculated=True)
+    for tag1 in _tags(lattices):
+        for tag2 in _tags(lattices):
+            ig_prob = 1.0
+            for ig in tag2.igs:
+                ig_prob += ig_probs.get(tag1.last_ig, {}).get(ig, LOG_ZERO)
+            expected = root_probs.get(tag1.root, {}).get(tag2.root, LOG_ZERO) + ig_prob
+            assert model.baseline_model(tag1, tag2) == expected
+
+
+def test_matrix_model_turns_counts_into_costs():
+    model = BaselineModel(['a', 'b'], {'a': {'a': 1, 'b': 3}}, ['n', 'v'], {'n': {'v': 2}})
+    assert model.baseline_model(Tag('a', ['n']), Tag('b', ['v'])) == -math.log(0.75) + 1.0 + -math.log(1.0)
+    # Unseen bigrams and tokens out of vocabulary cost nothing
+    assert model.baseline_model(Tag('b', ['v']), Tag('a', ['n', 'x'])) == pytest.approx(1.0)
+
+
+def _matrix_model(counters, cache_size):
+    root_probs, ig_probs = estimate(counters[0]).probs(2), estimate(counters[1]).probs(2)
+    return BaselineModel(counters[0].vocab, root_probs, counters[1].vocab, ig_probs, is_prob_calculated=True,
+                         cache_size=cache_size)
+
+
+def test_cached_scores_equal_uncached_ones(lattices, counters):
+    uncached, cached, bounded = (_matrix_model(counters, size) for size in (0, None, 50))
+    for lattice in lattices:
+        for model in (cached, bounded):
+            assert best_path(lattice, model) == best_path(lattice, uncached)
+    assert uncached.cache_info().hits == 0
+    assert bounded.cache_info().currsize == 50 and bounded.cache_info().misses > cached.cache_info().misses
+    # Decoding again only looks up memoized scores
+    misses = cached.cache_info().misses
+    for lattice in lattices:
+        best_path(lattice, cached)
+    assert cached.cache_info().misses == misses == cached.cache_info().currsize
+
+
+def test_rebuild_and_pickling_drop_cached_scores(lattices, counters):
+    model = _matrix_model(counters, None)
+    tag1, tag2 = lattices[0][1][0], lattices[0][2][0]
+    score = model.baseline_model(tag1, tag2)
+    copy = pickle.loads(pickle.dumps(model))
+    assert copy.cache_info().currsize == 0 and copy.baseline_model(tag1, tag2) == score
+    model.build([tag1.root, tag2.root], {tag1.root: {tag2.root: -0.25}}, [tag1.last_ig] + list(tag2.igs),
+                {tag1.last_ig: {ig: -0.5 for ig in tag2.igs}}, is_prob_calculated=True)
+    assert model.baseline_model(tag1, tag2) == -0.25 + 1.0 - 0.5 * len(tag2.igs) != score
@@ -0,0 +1,100 @@
+# coding=utf-8
+import gzip
+import os
+import shutil
+
+import pytest
+
+from main import metrics, segment
+from main.segment import (BIG_CORPUS, LM_CORPUS_DIR, SEGMENTATION_RULES, iter_sentences, prepare_corpus, process_file,
+                          segment_ig)
+from main.tagger import parse_reading
+from tests.conftest import DATA_DIR
+
+
+def _read(fpath):
+    with open(fpath, encoding='utf-8') as f:
+        return f.read()
+
+
+def test_small_corpus_matches_baseline(tmp_path):
+    prepare_corpus(is_test=True, lm_corpus_dir=str(tmp_path))
+    # The original roots.txt has the roots of all files on one line
+    assert _read(tmp_path / 'roots.txt').split() == _read(os.path.join(LM_CORPUS_DIR, 'roots.txt')).split()
+    assert _read(tmp_path / 'igs.txt') == _read(os.path.join(LM_CORPUS_DIR, 'igs.txt'))
+
+
+def test_big_corpus_matches_baseline(tmp_path):
+    prepare_corpus(corpus_dir=BIG_CORPUS, lm_corpus_dir=str(tmp_path))
+    roots = [line.split() for line in _read(tmp_path / 'roots.txt').splitlines()]
+    assert roots == [line.split() for line in _read(os.path.join(DATA_DIR, 'big_roots.txt')).splitlines()]
+    assert _read(tmp_path / 'igs.txt') == _read(os.path.join(DATA_DIR, 'big_igs.txt'))
+
+
+def _dump(sentences):
+    return [(sentence.words, sentence.roots, [group.group for group in sentence.igs]) for sentence in sentences]
+
+
+def test_compressed_file_parses_like_plain_file(tmp_path):
+    source = os.path.join(BIG_CORPUS, sorted(os.listdir(BIG_CORPUS))[0])
+    compressed = str(tmp_path / 'corpus.gz')
+    with open(source, 'rb') as f_in, gzip.open(compressed, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    assert _dump(iter_sentences(compressed)) == _dump(process_file(source))
+
+
+def test_file_parts_parse_like_whole_file():
+    for file_name in sorted(os.listdir(BIG_CORPUS)):
+        fpath = os.path.join(BIG_CORPUS, file_name)
+        chunks = segment.sentence_chunks(fpath, chunk_size=4096)
+        parts = [sentence for _, start, end in chunks for sentence in iter_sentences(fpath, start=start, end=end)]
+        assert _dump(parts) == _dump(process_file(fpath))
+
+
+def _original_segment(my_ig):
+    """The segmentation of the original parser, one rule search per IG."""
+    ret_val = []
+    while my_ig:
+        positions = sorted([my_ig.index(rule) for rule in SEGMENTATION_RULES if rule in my_ig])
+        try:
+            pos = positions[0] if positions[0] > 0 else positions[1]
+        except IndexError:
+            pos = len(my_ig)
+        ret_val.append(my_ig[:pos].strip('$'))
+        my_ig = my_ig[pos:]
+    return ret_val
+
+
+def _corpus_igs():
+    igs = set()
+    for file_name in sorted(os.listdir(BIG_CORPUS)):
+        for line in _read(os.path.join(BIG_CORPUS, file_name)).splitlines():
+            if line.startswith('\t') and not line.startswith('\t\t') and '"' in line:
+                igs.add(parse_reading(line)[1])
+    return sorted(igs)
+
+
+EDGE_CASES = ['n', 'v$tv$prc_perf$subst$nom', 'subst$nom', 'v$iv$ger_past$subst$attr$advl', 'n$attr$subst$attr',
+              'v$tv$gpr_ppot$gna_cond$prc_impf', 'adv$advl$advl', 'prc_perf$prc_perf$n', 'v$tv$subst$subst']
+
+
+@pytest.mark.parametrize('cache_size', [segment.SEGMENT_CACHE_SIZE, 5])
+def test_segment_ig_matches_original_segmentation(cache_size, monkeypatch):
+    monkeypatch.setattr(segment, 'SEGMENT_CACHE_SIZE', cache_size)
+    monkeypatch.setattr(segment, '_segmentations', {})
+    igs = _corpus_igs()
+    assert any(len(_original_segment(ig)) > 1 for ig in igs)
+    for ig in igs + EDGE_CASES:
+        assert list(segment_ig(ig)) == _original_segment(ig), ig
+    assert len(segment._segmentations) <= cache_size
+
+
+def test_segment_ig_is_memoized(monkeypatch):
+    monkeypatch.setattr(segment, '_segmentations', {})
+    monkeypatch.setattr(metrics, 'enabled', True)
+    metrics.reset()
+    first = segment_ig('v$tv$prc_perf$subst$nom')
+    assert segment_ig('v$tv$prc_perf$subst$nom') is first
+    assert segment_ig('n$attr') is segment_ig('n$attr')
+    assert metrics.REGISTRY.counters['segment_calls_total'] == 2
+    metrics.reset()
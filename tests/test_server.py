@@ -0,0 +1,91 @@
+# coding=utf-8
+import asyncio
+import json
+
+import pytest
+
+from main import viterbi_bigram
+from main.server import TaggingServer, path_to_json
+from main.viterbi_bigram import IGTable, best_path
+from tests.conftest import sentence_tag
+
+
+def _columns(lattice):
+    return [[[tag.root, list(tag.igs)] for tag in column] for column in lattice[1:-1]]
+
+
+def _run(server, coroutines):
+    """Run the coroutines of server requests together, with the batcher of the server running."""
+    async def run():
+        server.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(server._batcher())
+        try:
+            return await asyncio.gather(*[coroutine() for coroutine in coroutines], return_exceptions=True)
+        finally:
+            batcher.cancel()
+    return asyncio.run(run())
+
+
+def _post(server, request):
+    async def post():
+        status, _, payload = await server._route('POST', '/tag', json.dumps(request).encode('utf-8'))
+        return status, json.loads(payload.decode('utf-8'))
+    return post
+
+
+def _assert_best_path(response, lattice, model):
+    path, probability = best_path(lattice, model)
+    assert response['path'] == path_to_json(path)
+    assert response['probability'] == pytest.approx(probability, abs=1e-9)
+
+
+def test_batched_requests_match_best_path(lattices, model):
+    server = TaggingServer(model, max_wait=0.05)
+    responses = _run(server, [_post(server, {'lattice': _columns(lattice)}) for lattice in lattices[:20]]
+                     + [_post(server, {'lattices': [_columns(lattice) for lattice in lattices[20:30]]})])
+    for (status, response), lattice in zip(responses[:20], lattices):
+        assert status == 200
+        _assert_best_path(response, lattice, model)
+    status, response = responses[-1]
+    for result, lattice in zip(response['results'], lattices[20:30]):
+        _assert_best_path(result, lattice, model)
+    assert server.num_batches < 21
+
+
+@pytest.mark.parametrize('columns', [
+    [[['a', []]]],
+    [[['a', 'n']]],
+    [[['a', ['n', 1]]]],
+    [[[1, ['n']]]],
+    [[['a', ['n'], 'extra']]],
+    [[['a', ['n']]], []],
+])
+def test_bad_reading_is_rejected_without_failing_others(lattices, model, columns):
+    server = TaggingServer(model, max_wait=0.05)
+    (bad_status, bad), (good_status, good) = _run(server, [_post(server, {'lattice': columns}),
+                                                           _post(server, {'lattice': _columns(lattices[0])})])
+    assert bad_status == 400 and 'error' in bad
+    assert good_status == 200
+    _assert_best_path(good, lattices[0], model)
+
+
+def test_failing_lattice_does_not_fail_its_batch(lattices, model):
+    server = TaggingServer(model, max_wait=0.05)
+    bad_lattice = [[sentence_tag()], ['not a tag'], [sentence_tag()]]
+    results = _run(server, [lambda: server.tag(lattices[0]), lambda: server.tag(bad_lattice),
+                            lambda: server.tag(lattices[1])])
+    assert server.num_batches == 1
+    assert isinstance(results[1], Exception)
+    for (path, probability), lattice in zip([results[0], results[2]], lattices[:2]):
+        assert (path, probability) == best_path(lattice, model)
+
+
+def test_client_igs_do_not_grow_ig_table(lattices, model, monkeypatch):
+    monkeypatch.setattr(viterbi_bigram, 'IG_TABLE', IGTable(max_size=50))
+    server = TaggingServer(model, max_wait=0.05)
+    requests = [{'lattice': [[['a', ['n', 'client-ig-%d' % i]], ['a', ['n']]]]} for i in range(200)]
+    responses = _run(server, [_post(server, request) for request in requests]
+                     + [_post(server, {'lattice': _columns(lattices[0])})])
+    assert all(status == 200 for status, _ in responses)
+    _assert_best_path(responses[-1][1], lattices[0], model)
+    assert len(viterbi_bigram.IG_TABLE) <= 50 and len(viterbi_bigram.IG_TABLE.vocab) <= 50
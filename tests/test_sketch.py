@@ -0,0 +1,54 @@
+# coding=utf-8
+import os
+import random
+from collections import Counter
+
+import pytest
+
+from main import lmstore
+from main.lm import NgramCounter, estimate
+from main.segment import BIG_CORPUS, iter_sentences, stream_counts
+from main.sketch import CountMinSketch, count_corpus
+
+
+@pytest.fixture(scope='module', params=[2, 3])
+def exact(request):
+    """Order and exact root and IG counts of the big corpus, counted as count_corpus does."""
+    ngram = request.param
+    counters = NgramCounter(ngram), NgramCounter(ngram)
+    for file_name in sorted(os.listdir(BIG_CORPUS)):
+        stream_counts(iter_sentences(os.path.join(BIG_CORPUS, file_name), ngram), counters[0], counters[1], ngram)
+    return ngram, counters
+
+
+def test_count_min_estimate_is_never_below_count():
+    rng = random.Random(0)
+    keys = [('w%d' % rng.randrange(2000), 'v%d' % rng.randrange(20)) for _ in range(20000)]
+    sketch = CountMinSketch(width=500, depth=4)
+    for key in keys:
+        sketch.add(key)
+    counts = Counter(keys)
+    errors = [sketch.estimate(key) - c for key, c in counts.items()]
+    assert min(errors) >= 0 and max(errors) > 0
+    assert sum(error <= sketch.error_bound() for error in errors) >= 0.95 * len(errors)
+
+
+def test_counts_are_exact_when_nothing_is_pruned(exact):
+    ngram, counters = exact
+    for sketched, counter in zip(count_corpus(ngram=ngram), counters):
+        for k in range(1, ngram + 1):
+            assert sketched.counts[k] == counter.counts[k]
+
+
+def test_sketch_count_is_never_below_exact_count(exact):
+    ngram, counters = exact
+    for sketched, counter in zip(count_corpus(ngram=ngram, max_bytes=200000), counters):
+        report = sketched.report()
+        assert any(sketched.tables[k] and report['orders'][k]['kept'] < len(counter.counts[k])
+                   for k in range(2, ngram + 1))
+        for k in range(1, ngram + 1):
+            for gram, c in counter.counts[k].items():
+                assert sketched.count(gram) >= c
+            for gram, c in sketched.counts[k].items():
+                assert c - counter.counts[k][gram] <= report['orders'][k]['max_error']
+        lmstore.pack(estimate(sketched))
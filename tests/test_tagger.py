@@ -0,0 +1,45 @@
+# coding=utf-8
+import io
+import os
+
+import pytest
+
+from main.segment import BIG_CORPUS
+from main.tagger import tag_online, tag_stream
+
+TAGGERS = [(tag_stream, {}), (tag_stream, {'processes': 2, 'batch_size': 3}), (tag_online, {})]
+
+
+@pytest.fixture(autouse=True)
+def cores(monkeypatch):
+    """Let tag_stream start a pool of processes on machines with fewer cores too."""
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+
+
+def _tag(tagger, text, model, **kwargs):
+    out = io.StringIO()
+    stats = tagger(io.StringIO(text), out, model, **kwargs)
+    return out.getvalue(), stats
+
+
+def _other_lines(text):
+    """Lines that are not readings, i.e. cohort lines and the lines around them."""
+    return [line for line in text.splitlines() if not line.startswith('\t')]
+
+
+@pytest.mark.parametrize('tagger, kwargs', TAGGERS)
+def test_corpus_round_trip(model, tagger, kwargs):
+    for file_name in sorted(os.listdir(BIG_CORPUS)):
+        with open(os.path.join(BIG_CORPUS, file_name), encoding='utf-8') as f:
+            text = f.read()
+        tagged, stats = _tag(tagger, text, model, **kwargs)
+        assert _other_lines(tagged) == _other_lines(text), file_name
+        if not stats['ambiguous']:
+            assert tagged == (text if text.endswith('\n') else text + '\n'), file_name
+
+
+@pytest.mark.parametrize('tagger, kwargs', TAGGERS)
+def test_other_lines_are_passed_through_in_order(model, tagger, kwargs):
+    text = '# header\n\n"<a>"\n\t"a" n nom\n\n"<.>"\n\t"." sent\n\n\n<p>\n"<b>"\n\t"b" n nom\n\n# end\n'
+    assert _tag(tagger, text, model, **kwargs)[0] == text
+    assert _tag(tagger, '\n# no cohorts\n', model, **kwargs)[0] == '\n# no cohorts\n'
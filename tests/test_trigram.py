@@ -0,0 +1,57 @@
+# coding=utf-8
+import itertools
+import math
+import os
+
+import pytest
+
+from main.lm import NgramCounter, estimate
+from main.segment import BIG_CORPUS, count_file_sentences
+from main.viterbi_trigram import SecondOrderViterbi, TrigramModel
+
+MAX_PATHS = 2000
+
+
+@pytest.fixture(scope='module')
+def trigram_model():
+    root_counter, ig_counter = NgramCounter(3), NgramCounter(3)
+    for file_name in sorted(os.listdir(BIG_CORPUS)):
+        counts = count_file_sentences(os.path.join(BIG_CORPUS, file_name), 3)
+        root_counter.update(counts.root_counter)
+        ig_counter.update(counts.ig_counter)
+    return TrigramModel(estimate(root_counter), estimate(ig_counter))
+
+
+def _score(path, model):
+    return sum(model.trigram_model(path[pos - 2] if pos > 1 else None, path[pos - 1], path[pos])
+               for pos in range(1, len(path)))
+
+
+def _small(lattices):
+    small = [lattice for lattice in lattices if math.prod(map(len, lattice)) <= MAX_PATHS]
+    assert any(max(map(len, lattice)) > 1 for lattice in small)
+    return small
+
+
+def test_exact_decoding_finds_best_path(lattices, trigram_model):
+    for lattice in _small(lattices):
+        best = max(_score(list(path), trigram_model) for path in itertools.product(*lattice))
+        viterbi = SecondOrderViterbi(lattice, [None] * len(lattice), beam=None)
+        viterbi.train(trigram_model)
+        assert viterbi.probability == pytest.approx(best, abs=1e-9)
+        assert _score(viterbi.path, trigram_model) == pytest.approx(best, abs=1e-9)
+        assert viterbi.num_pruned == 0
+
+
+@pytest.mark.parametrize('beam, threshold', [(1, None), (2, None), (None, 1.0)])
+def test_pruned_decoding_scores_its_path(lattices, trigram_model, beam, threshold):
+    num_pruned = 0
+    for lattice in lattices:
+        exact = SecondOrderViterbi(lattice, [None] * len(lattice), beam=None)
+        exact.train(trigram_model)
+        pruned = SecondOrderViterbi(lattice, [None] * len(lattice), beam=beam, threshold=threshold)
+        pruned.train(trigram_model)
+        assert pruned.probability == pytest.approx(_score(pruned.path, trigram_model), abs=1e-9)
+        assert pruned.probability <= exact.probability + 1e-9
+        num_pruned += pruned.num_pruned
+    assert num_pruned